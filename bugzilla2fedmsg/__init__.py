@@ -1,21 +1,46 @@
+import functools
+import json
 import logging
 import os
+import signal
 import time
 
 import click
 import fedora_messaging
+from fasjson_client import Client as FasjsonClient
 from stompest.error import StompConnectionError
 
+from bugzilla2fedmsg.aio import AsyncBugzillaConsumer
+from bugzilla2fedmsg.cache import dump_users, EmailStore, fasjson_users
 from bugzilla2fedmsg.consumer import BugzillaConsumer
+from bugzilla2fedmsg.metrics import mark_process_dead
+from bugzilla2fedmsg.metrics import start_http_server as start_metrics_server
 from bugzilla2fedmsg.relay import MessageRelay
+from bugzilla2fedmsg.replay import FileSink
+from bugzilla2fedmsg.replay import replay as replay_messages
+from bugzilla2fedmsg.supervisor import Supervisor
 
 
 LOGGER = logging.getLogger(__name__)
 
+ENGINES = {
+    "threads": BugzillaConsumer,
+    "asyncio": AsyncBugzillaConsumer,
+}
 
-@click.command()
+
+@click.group(invoke_without_command=True)
 @click.option("-c", "--config", envvar="FEDORA_MESSAGING_CONF", help="Configuration file")
-def cli(config):
+@click.option(
+    "-p",
+    "--processes",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of relay processes",
+)
+@click.pass_context
+def cli(ctx, config, processes):
     """Relay Bugzilla changes into Fedora Messaging."""
     if config:
         if not os.path.isfile(config):
@@ -26,11 +51,70 @@ def cli(config):
             raise click.exceptions.BadParameter(str(e)) from e
     fedora_messaging.config.conf.setup_logging()
 
+    if ctx.invoked_subcommand is None:
+        if processes > 1:
+            supervise(processes)
+        else:
+            consume()
+
+
+def _get_consumer_class(conf):
+    engine = conf.get("stomp", {}).get("engine", "threads")
+    try:
+        return ENGINES[engine]
+    except KeyError as e:
+        raise click.ClickException(
+            f"Unknown STOMP engine {engine!r}, choose from: {', '.join(ENGINES)}"
+        ) from e
+
+
+def supervise(processes):
+    """Run the relay in several processes, serving their combined metrics."""
+    conf = fedora_messaging.config.conf["consumer_config"]
+    # Check the configuration before forking
+    _get_consumer_class(conf)
+    try:
+        start_metrics_server(conf.get("metrics", {}), multiprocess_mode=True)
+    except RuntimeError as e:
+        raise click.ClickException(str(e)) from e
+    supervisor = Supervisor(
+        functools.partial(consume, serve_metrics=False), processes, on_exit=mark_process_dead
+    )
+    supervisor.run()
+
+
+def _stop_on_signals(consumer):
+    """Stop the consumer gracefully on SIGTERM or SIGINT, and right away on a second SIGINT."""
+
+    def _on_signal(signum, frame):
+        if consumer.stopping:
+            if signum == signal.SIGINT:
+                raise KeyboardInterrupt
+            return
+        LOGGER.info(
+            f"Received {signal.Signals(signum).name}, stopping once the messages in flight "
+            "are published"
+        )
+        consumer.stop()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, _on_signal)
+
+
+def consume(serve_metrics=True):
     # Now start the consumer.
     conf = fedora_messaging.config.conf["consumer_config"]
+    if serve_metrics:
+        try:
+            start_metrics_server(conf.get("metrics", {}))
+        except RuntimeError as e:
+            raise click.ClickException(str(e)) from e
+    consumer_class = _get_consumer_class(conf)
     relay = MessageRelay(conf)
-    consumer = BugzillaConsumer(conf, relay)
-    while True:
+    consumer = consumer_class(conf, relay)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: consumer.tracer.toggle())
+    _stop_on_signals(consumer)
+    while not consumer.stopping:
         try:
             consumer.consume()
         except StompConnectionError:
@@ -39,3 +123,61 @@ def cli(config):
         except KeyboardInterrupt:
             consumer.stop()
             raise
+    # Publish what the relay still holds, and flush the outbox and the caches
+    relay.close()
+    LOGGER.info("Stopped")
+
+
+@cli.command()
+@click.argument("input_file", metavar="INPUT", type=click.File("r"), default="-")
+@click.option(
+    "-o",
+    "--output",
+    type=click.File("w"),
+    help="Write the messages to this file instead of publishing them",
+)
+def replay(input_file, output):
+    """Relay the messages saved as JSON lines in INPUT (default: stdin).
+
+    Each line must have the "headers" and "body" of a message received from Bugzilla.
+    """
+    conf = fedora_messaging.config.conf["consumer_config"]
+    sink = FileSink(output) if output is not None else None
+    relay = MessageRelay(conf, sink=sink)
+    try:
+        stats = replay_messages(relay, input_file)
+    finally:
+        relay.close()
+    click.echo(str(stats), err=True)
+
+
+@cli.command("warm-cache")
+@click.option(
+    "--dump",
+    type=click.File("r"),
+    help="Read the users from this JSON file instead of querying FASJSON",
+)
+@click.option("--page-size", default=1000, show_default=True, help="Users per FASJSON page")
+def warm_cache(dump, page_size):
+    """Store the Bugzilla email addresses of all FAS users in the FASJSON cache database.
+
+    The dump can be a list of users as returned by FASJSON, or an object mapping
+    email addresses to usernames.
+    """
+    conf = fedora_messaging.config.conf["consumer_config"]
+    cache_config = conf.get("fasjson_cache", {})
+    if not cache_config.get("path"):
+        raise click.ClickException("The fasjson_cache.path setting is required")
+    if dump is not None:
+        try:
+            users = list(dump_users(json.load(dump)))
+        except (ValueError, AttributeError, KeyError) as e:
+            raise click.ClickException(f"Invalid dump: {e}") from e
+    else:
+        users = list(fasjson_users(FasjsonClient(conf["fasjson_url"]), page_size))
+    store = EmailStore(cache_config["path"], max_age=cache_config.get("max_age", 30 * 86400))
+    try:
+        store.update(users)
+    finally:
+        store.close()
+    click.echo(f"Stored {len(users)} email addresses in {cache_config['path']}", err=True)
@@ -0,0 +1,318 @@
+""" STOMP consumer running on an asyncio event loop.
+
+This engine speaks STOMP over asyncio streams, with stompest's protocol layer
+(the session and the frame parser) instead of its blocking client. Receiving
+frames, heartbeating, converting the messages, resolving email addresses from
+the FASJSON cache and acking all happen on the event loop, and many messages
+are relayed at the same time. Only the FASJSON queries for unknown addresses
+and the publication to Fedora Messaging, which are blocking calls, go through
+the loop's default executor.
+"""
+
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from stompest.error import StompConnectionError, StompProtocolError
+from stompest.protocol import StompFailoverTransport, StompParser, StompSession, StompSpec
+
+from . import metrics
+from .consumer import BaseConsumer, make_ssl_context, subscription_headers
+from .decode import find_bug_id
+from .dedup import CLAIMED, IN_FLIGHT
+
+
+LOGGER = logging.getLogger(__name__)
+
+READ_SIZE = 65536
+
+
+def _set_result(future, result):
+    # The future is cancelled if the consumer stopped meanwhile
+    if not future.done():
+        future.set_result(result)
+
+
+class AsyncBugzillaConsumer(BaseConsumer):
+    def __init__(self, conf, relay):
+        super().__init__(conf, relay)
+
+        # STOMP
+        stomp_config = self._conf.get("stomp", {})
+        self._uri = stomp_config["uri"]
+        self._login = stomp_config.get("user")
+        self._passcode = stomp_config.get("pass")
+        self._queue_name = stomp_config.get("queue", "/queue/fedora_from_esb")
+        self._heartbeat = stomp_config.get("heartbeat")
+        self._vhost = stomp_config.get("vhost", "/")
+        self._prefetch_size = stomp_config.get("prefetch_size")
+        # How many messages are relayed at the same time
+        self._concurrency = stomp_config.get("concurrency", 20)
+        self._ssl_context = make_ssl_context(stomp_config)
+
+        self._loop = None
+        self._receiver = None
+        self._session = None
+        self._parser = None
+        self._reader = None
+        self._writer = None
+        self._tasks = set()
+        # Whether the receiver waits for a slot instead of reading, and since when it reads again
+        self._waiting_for_slot = False
+        self._resumed_at = 0
+
+    def consume(self):
+        """Relay the messages until :meth:`stop` is called or the connection is lost."""
+        asyncio.run(self.consume_async())
+
+    def stop(self):
+        """Stop receiving frames, and disconnect once the messages in flight are acked.
+
+        This can be called from any thread, or from a signal handler.
+        """
+        self.stopping = True
+        if self._loop is None or self._receiver is None:
+            return
+        self._loop.call_soon_threadsafe(self._receiver.cancel)
+
+    async def consume_async(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=self._concurrency, thread_name_prefix="bz2fm-aio")
+        )
+        await self._connect()
+        LOGGER.info("STOMP consumer is ready")
+        self._receiver = asyncio.ensure_future(self._receive())
+        if self.stopping:
+            self._receiver.cancel()
+        tasks = {self._receiver}
+        if self._session.clientHeartBeat or self._session.serverHeartBeat:
+            tasks.add(asyncio.ensure_future(self._heartbeat_loop()))
+        try:
+            done, _pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if self._tasks:
+                await self._drain()
+            await self._disconnect()
+            self._receiver = None
+        for task in done:
+            if not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+
+    async def _drain(self):
+        """Let the messages that were already received be relayed and acked.
+
+        The messages that are not acked after ``drain_timeout`` seconds will be redelivered.
+        """
+        LOGGER.info(f"Waiting for the {len(self._tasks)} messages in flight")
+        _done, pending = await asyncio.wait(self._tasks, timeout=self._drain_timeout)
+        if not pending:
+            return
+        LOGGER.warning(
+            f"{len(pending)} messages were not published after {self._drain_timeout}s, "
+            "the broker will redeliver them"
+        )
+        for task in pending:
+            task.cancel()
+        await asyncio.wait(pending)
+
+    async def _connect(self):
+        LOGGER.debug("STOMP consumer is connecting...")
+        for broker, delay in StompFailoverTransport(self._uri):
+            if delay:
+                await asyncio.sleep(delay)
+            LOGGER.info(f"Connecting to {broker['host']}:{broker['port']}...")
+            try:
+                self._reader, self._writer = await asyncio.open_connection(
+                    broker["host"], broker["port"], ssl=self._ssl_context
+                )
+            except OSError as e:
+                LOGGER.warning(f"Could not connect to {broker['host']}:{broker['port']}: {e}")
+                continue
+            break
+
+        self._session = StompSession(version=StompSpec.VERSION_1_2)
+        self._parser = StompParser()
+        heartbeats = None
+        if self._heartbeat:
+            heartbeats = (self._heartbeat, self._heartbeat)
+        self._send(
+            self._session.connect(
+                self._login, self._passcode, host=self._vhost, heartBeats=heartbeats
+            )
+        )
+        frame = await self._read_frame()
+        if frame.command != StompSpec.CONNECTED:
+            raise StompProtocolError(f"Could not connect to the STOMP broker: {frame.info()}")
+        self._session.connected(frame)
+        self._parser.version = self._session.version
+        LOGGER.info(f"Connected to the STOMP broker (version {self._session.version})")
+
+        headers = subscription_headers(self._session.version, self._prefetch_size)
+        frame, _token = self._session.subscribe(self._queue_name, headers)
+        self._send(frame)
+
+    async def _disconnect(self):
+        if self._writer is None:
+            return
+        try:
+            if self._session.state == StompSession.CONNECTED:
+                self._send(self._session.disconnect())
+            self._writer.close()
+            await self._writer.wait_closed()
+        except (OSError, StompConnectionError) as e:
+            LOGGER.warning(f"Could not disconnect cleanly: {e}")
+        self._session.close()
+        self._reader = self._writer = None
+
+    def _send(self, frame):
+        try:
+            self._writer.write(bytes(frame))
+        except OSError as e:
+            raise StompConnectionError(f"Could not send to the STOMP broker: {e}") from e
+        self._session.sent()
+
+    async def _read(self):
+        # Like stompest's blocking client, so that the relay reconnects
+        try:
+            data = await self._reader.read(READ_SIZE)
+        except OSError as e:
+            raise StompConnectionError(f"Connection to the STOMP broker lost: {e}") from e
+        if not data:
+            raise StompConnectionError("Connection closed by the STOMP broker")
+        self._session.received()
+        self._parser.add(data)
+
+    async def _read_frame(self):
+        while True:
+            frame = self._parser.get()
+            # Heartbeats are falsy
+            if frame:
+                return frame
+            if frame is None:
+                await self._read()
+
+    async def _receive(self):
+        # Limits the number of messages being relayed. When they are all busy, stop
+        # reading and let the broker hold the next frames.
+        slots = asyncio.Semaphore(self._concurrency)
+        # The messages about the same bug are relayed one after the other, in the order they
+        # were received
+        bug_locks = [asyncio.Lock() for _index in range(self._concurrency)]
+        while True:
+            await self._read()
+            self.tracer.dump_if_requested()
+            while self._parser.canRead():
+                frame = self._parser.get()
+                if not frame:
+                    continue
+                if frame.command == StompSpec.ERROR:
+                    raise StompProtocolError(
+                        f"Received an error from the STOMP broker: {frame.info()}"
+                    )
+                if frame.command != StompSpec.MESSAGE:
+                    continue
+                received_at = time.monotonic()
+                metrics.MESSAGES_RECEIVED.inc()
+                metrics.FRAMES_IN_FLIGHT.inc()
+                if slots.locked():
+                    # Nothing is read meanwhile, so the broker's heartbeats aren't either
+                    self._waiting_for_slot = True
+                    try:
+                        await slots.acquire()
+                    finally:
+                        self._waiting_for_slot = False
+                        self._resumed_at = time.time()
+                else:
+                    await slots.acquire()
+                bug_id = find_bug_id(frame.body)
+                lock = None if bug_id is None else bug_locks[bug_id % len(bug_locks)]
+                task = asyncio.ensure_future(self._process(frame, received_at, lock))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                task.add_done_callback(lambda _task: slots.release())
+
+    async def _process(self, frame, received_at, lock=None):
+        msg_id = frame.headers.get(StompSpec.MESSAGE_ID_HEADER)
+        trace = self.tracer.begin(msg_id)
+        with self.tracer.activate(trace):
+            body = self._decode_frame(frame, received_at, trace)
+            if body is None:
+                return
+            try:
+                claimed = await self._wait_claim(frame, received_at, trace)
+            except asyncio.CancelledError:
+                # Still waiting for another copy when stopping, the broker will redeliver it
+                metrics.FRAMES_IN_FLIGHT.dec()
+                raise
+            if not claimed:
+                return
+            try:
+                # Nothing is awaited before, so the tasks wait for the lock in the order the
+                # frames were received
+                if lock is None:
+                    await self.relay.on_stomp_message_async(body, frame.headers)
+                else:
+                    async with lock:
+                        await self.relay.on_stomp_message_async(body, frame.headers)
+            except asyncio.CancelledError:
+                # Not relayed in time when stopping, the broker will redeliver it
+                self._on_relayed(frame, done=False)
+                metrics.FRAMES_IN_FLIGHT.dec()
+                raise
+            except Exception:
+                LOGGER.exception("Exception when relaying the message:")
+                ack = False
+            else:
+                ack = True
+            self._on_relayed(frame, done=ack)
+        self._settle(frame, received_at, trace, ack)
+
+    async def _wait_claim(self, frame, received_at, trace):
+        """Return True once the frame can be relayed, or False if it was acked because its
+        other copy was relayed.
+        """
+        while True:
+            released = self._loop.create_future()
+            claim = self._claim(frame, received_at, trace, functools.partial(_set_result, released))
+            if claim != IN_FLIGHT:
+                return claim == CLAIMED
+            if await released:
+                self._skip_duplicate(frame, received_at, trace)
+                return False
+
+    def _send_settlement(self, frame, ack):
+        if self._writer is None or self._session.state != StompSession.CONNECTED:
+            return
+        if ack:
+            self._send(self._session.ack(frame))
+        else:
+            self._send(self._session.nack(frame))
+
+    async def _heartbeat_loop(self):
+        # The negotiated periods are in milliseconds
+        client_period = self._session.clientHeartBeat / 1000
+        server_period = self._session.serverHeartBeat / 1000
+        interval = min(period for period in (client_period, server_period) if period) / 2
+        while True:
+            await asyncio.sleep(interval)
+            now = time.time()
+            # Only send a heartbeat if nothing else was sent meanwhile
+            if client_period and now - self._session.lastSent >= client_period * 0.9:
+                LOGGER.debug("Sending heartbeat")
+                self._send(self._session.beat())
+            # Be lenient with the server, as the STOMP specification suggests. Don't count the
+            # time spent waiting for a slot, when the heartbeats were left in the socket.
+            last_received = max(self._session.lastReceived, self._resumed_at)
+            if (
+                server_period
+                and not self._waiting_for_slot
+                and now - last_received > server_period * 2
+            ):
+                raise StompConnectionError(
+                    f"No heartbeat received from the STOMP broker in {server_period * 2}s"
+                )
@@ -0,0 +1,82 @@
+""" Circuit breaker for the calls to an unhealthy service. """
+
+import logging
+import threading
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    """The service was not called because it is considered unhealthy."""
+
+
+class CircuitBreaker:
+    """Stop calling a service after several consecutive failures.
+
+    After ``failure_threshold`` failures in a row the circuit opens, and the
+    calls fail straight away with :class:`CircuitOpen`. Once ``reset_timeout``
+    seconds have passed, the next call is let through as a probe, while the
+    others keep failing: if it succeeds the circuit closes again, if it fails
+    the circuit stays open for another ``reset_timeout`` seconds.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    @property
+    def is_closed(self):
+        return self.state == self.CLOSED
+
+    def call(self, function, *args, **kwargs):
+        self._before_call()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            self._on_failure()
+            raise
+        self._on_success()
+        return result
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                LOGGER.info(f"Probing {self.name}")
+                self.state = self.HALF_OPEN
+                return
+            raise CircuitOpen(f"{self.name} is unavailable")
+
+    def _on_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                LOGGER.info(f"{self.name} is available again")
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def _on_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self._failures >= self.failure_threshold
+            ):
+                if self.state == self.CLOSED:
+                    LOGGER.warning(
+                        f"{self.name} failed {self._failures} times in a row, "
+                        f"not calling it for {self.reset_timeout}s"
+                    )
+                self.state = self.OPEN
+                self._opened_at = self._clock()
@@ -0,0 +1,134 @@
+""" Compatibility with the messages of Bugzilla 4.
+
+In BZ4 compatibility mode, the bug, event and object dicts of each message
+are modified to look more like the ones Bugzilla 4 used to send. The changes
+are described by the tables below, and :func:`compile_transform` turns them
+into functions once, so that the tables are not interpreted again for each
+message.
+"""
+
+import copy
+
+
+# The changes to the bug dict, in order:
+# - ("copy", target, path): set bug[target] to the value at path in the bug, if it is set.
+#   The path is a key, or a (key, attribute) tuple for a dict such as a user.
+# - ("default", target, value): set bug[target] to value if there is no such key.
+# - ("template", target, template): set bug[target] to template filled with the bug's
+#   fields, if it is not set.
+BUG_FIELDS = (
+    ("copy", "assigned_to", ("assigned_to", "login")),
+    ("copy", "component", ("component", "name")),
+    ("copy", "product", ("product", "name")),
+    ("default", "cc", []),
+    ("copy", "creator", ("reporter", "login")),
+    ("copy", "op_sys", "operating_system"),
+    ("template", "weburl", "https://bugzilla.redhat.com/show_bug.cgi?id={id}"),
+)
+
+# The changes to the event dict, in order:
+# - ("set", target, (key, attribute)): set event[target] to event[key][attribute].
+# - ("default", target, value): as for the bug.
+# - ("each", key, target, source): copy the source field of each dict of the event[key]
+#   list to its target field.
+EVENT_FIELDS = (
+    ("set", "who", ("user", "login")),
+    ("default", "changes", []),
+    ("each", "changes", "field_name", "field"),
+)
+
+# The changes to the dicts of the other objects, by object:
+# - ("event", target, (key, attribute), default): set payload[target] to
+#   event[key][attribute], or to default if it is not set.
+OBJECT_FIELDS = {
+    # I would expect this to be real_name so we're not spaffing
+    # email addresses all over, but I checked and historically
+    # it was definitely login
+    "comment": (("event", "author", ("user", "login"), ""),),
+}
+
+
+def _getter(path):
+    """The function that returns the value at path in a dict, or None if it is not set."""
+    if isinstance(path, str):
+        return lambda d: d.get(path)
+    key, attribute = path
+    return lambda d: d.get(key, {}).get(attribute)
+
+
+def _compile_field(mapping):
+    """The function applying a change to a dict, given the dict and the event dict."""
+    kind, target = mapping[:2]
+    if kind == "copy":
+        get = _getter(mapping[2])
+
+        def _copy(d, event):
+            value = get(d)
+            if value:
+                d[target] = value
+
+        return _copy
+    if kind == "default":
+        default = mapping[2]
+
+        def _default(d, event):
+            if target not in d:
+                # Each message gets its own copy of a mutable default
+                d[target] = copy.deepcopy(default)
+
+        return _default
+    if kind == "template":
+        template = mapping[2]
+
+        def _template(d, event):
+            if not d.get(target):
+                d[target] = template.format_map(d)
+
+        return _template
+    if kind == "set":
+        key, attribute = mapping[2]
+
+        def _set(d, event):
+            d[target] = d[key][attribute]
+
+        return _set
+    if kind == "each":
+        field, source = mapping[2:]
+
+        def _each(d, event):
+            for item in d[target]:
+                item[field] = item[source]
+
+        return _each
+    if kind == "event":
+        (key, attribute), default = mapping[2:]
+
+        def _event(d, event):
+            d[target] = event.get(key, {}).get(attribute, default)
+
+        return _event
+    raise ValueError(f"Unknown kind of BZ4 mapping: {kind!r}")
+
+
+def compile_transform(bug_fields=BUG_FIELDS, event_fields=EVENT_FIELDS, object_fields=None):
+    """Build the function that modifies the bug, event and object dicts of a message in
+    place, given the dicts and the name of the object.
+    """
+    if object_fields is None:
+        object_fields = OBJECT_FIELDS
+    bug_steps = [_compile_field(mapping) for mapping in bug_fields]
+    event_steps = [_compile_field(mapping) for mapping in event_fields]
+    object_steps = {
+        obj: [_compile_field(mapping) for mapping in mappings]
+        for obj, mappings in object_fields.items()
+    }
+
+    def transform(bug, event, payload, obj):
+        for step in bug_steps:
+            step(bug, event)
+        for step in event_steps:
+            step(event, event)
+        for step in object_steps.get(obj, ()):
+            step(payload, event)
+
+    return transform
@@ -0,0 +1,289 @@
+""" Caching of FAS identities looked up in FASJSON. """
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from .utils import open_database
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class EmailCache:
+    """Bounded LRU cache mapping email addresses to FAS usernames.
+
+    A ``None`` value means FASJSON told us there is no user with that email
+    address. Those negative results get their own (usually shorter) TTL, so
+    that people who link their Bugzilla email to their FAS account show up
+    reasonably quickly.
+
+    If a store is given, every result is also written to it, the addresses that
+    are not in memory are looked up in it, and :meth:`warm` fills the cache with
+    the results stored before a restart.
+    """
+
+    def __init__(self, size=10000, ttl=3600, negative_ttl=300, store=None, clock=time.monotonic):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, email):
+        with self._lock:
+            try:
+                username, expires_at = self._entries[email]
+            except KeyError:
+                pass
+            else:
+                if expires_at > self._clock():
+                    self._entries.move_to_end(email)
+                    self.hits += 1
+                    return username
+                # Expired entries stay until they are replaced or evicted, for last_known()
+        if self.store is not None:
+            try:
+                username, age = self.store.entry(email)
+            except KeyError:
+                pass
+            else:
+                ttl = self._ttl(username)
+                if age < ttl:
+                    with self._lock:
+                        self._add(email, username, self._clock() + ttl - age)
+                        self.hits += 1
+                    return username
+        with self._lock:
+            self.misses += 1
+        raise KeyError(email)
+
+    def __setitem__(self, email, username):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._add(email, username, self._clock() + self._ttl(username))
+        if self.store is not None:
+            self.store[email] = username
+
+    def last_known(self, email):
+        """Return the last username looked up for an email address, however old, or None."""
+        with self._lock:
+            entry = self._entries.get(email)
+        if entry is not None:
+            return entry[0]
+        if self.store is None:
+            return None
+        try:
+            return self.store[email]
+        except KeyError:
+            return None
+
+    def update(self, mappings):
+        """Add many (email, username) results at once, return how many were added.
+
+        The addresses that are already in memory are refreshed. The others are written to
+        the store, to be loaded when they are looked up, or only kept in memory while there is
+        room, so that a bulk load doesn't evict the addresses in use.
+        """
+        mappings = list(mappings)
+        if self.size <= 0:
+            return 0
+        now = self._clock()
+        with self._lock:
+            for email, username in mappings:
+                if email in self._entries:
+                    self._entries[email] = (username, now + self._ttl(username))
+                elif self.store is None and len(self._entries) < self.size:
+                    self._add(email, username, now + self._ttl(username))
+        if self.store is not None:
+            self.store.update(mappings)
+        return len(mappings)
+
+    def warm(self):
+        """Fill the cache with the stored results that have not expired yet.
+
+        Returns the number of email addresses that were loaded.
+        """
+        if self.store is None or self.size <= 0:
+            return 0
+        self.store.prune()
+        now = self._clock()
+        loaded = 0
+        with self._lock:
+            # Oldest first, so that the most recent results are the last to be evicted
+            for email, username, age in self.store.items(max(self.ttl, self.negative_ttl)):
+                ttl = self._ttl(username)
+                if age >= ttl:
+                    continue
+                self._add(email, username, now + ttl - age)
+                loaded += 1
+        return loaded
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _ttl(self, username):
+        return self.ttl if username is not None else self.negative_ttl
+
+    def _add(self, email, username, expires_at):
+        # Must be called with the lock held
+        self._entries[email] = (username, expires_at)
+        self._entries.move_to_end(email)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+
+class EmailStore:
+    """Email address to FAS username mappings kept in a SQLite database, with the time they
+    were looked up, so that they survive restarts.
+
+    Each mapping is written as soon as it is known. Mappings older than ``max_age`` seconds
+    are removed by :meth:`prune`.
+    """
+
+    def __init__(self, path, max_age=30 * 86400, clock=time.time):
+        self.path = path
+        self.max_age = max_age
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._db = open_database(
+            path,
+            "CREATE TABLE IF NOT EXISTS emails "
+            "(email TEXT PRIMARY KEY, username TEXT, updated_at REAL NOT NULL)",
+        )
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM emails").fetchone()[0]
+
+    def __getitem__(self, email):
+        """Return the username of an email address, however old."""
+        return self.entry(email)[0]
+
+    def entry(self, email):
+        """Return the username of an email address and its age in seconds."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT username, updated_at FROM emails WHERE email = ?", (email,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(email)
+        username, updated_at = row
+        return username, self._clock() - updated_at
+
+    def __setitem__(self, email, username):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO emails (email, username, updated_at) VALUES (?, ?, ?)",
+                (email, username, self._clock()),
+            )
+
+    def update(self, mappings):
+        """Write many (email, username) mappings in one transaction."""
+        now = self._clock()
+        with self._lock, self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO emails (email, username, updated_at) VALUES (?, ?, ?)",
+                [(email, username, now) for email, username in mappings],
+            )
+
+    def items(self, max_age=None):
+        """List the (email, username, age in seconds) mappings, oldest first."""
+        now = self._clock()
+        oldest = now - max_age if max_age is not None else 0
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT email, username, updated_at FROM emails "
+                "WHERE updated_at > ? ORDER BY updated_at",
+                (oldest,),
+            ).fetchall()
+        return [(email, username, now - updated_at) for email, username, updated_at in rows]
+
+    def prune(self):
+        """Remove the mappings older than ``max_age``, return how many were removed."""
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM emails WHERE updated_at <= ?", (self._clock() - self.max_age,)
+            )
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def fasjson_users(fasjson, page_size=1000):
+    """Iterate over the (email, username) of the FAS users who set their Bugzilla email,
+    going through the pages of FASJSON's user list.
+    """
+    for user in fasjson.list_all_entities("users", page_size=page_size):
+        if user.get("rhbzemail"):
+            yield user["rhbzemail"], user["username"]
+
+
+def dump_users(dump):
+    """Iterate over the (email, username) of the users in a JSON dump.
+
+    The dump is either a list of users as returned by FASJSON, or an object mapping
+    email addresses to usernames.
+    """
+    if isinstance(dump, dict):
+        yield from dump.items()
+        return
+    for user in dump:
+        if user.get("rhbzemail"):
+            yield user["rhbzemail"], user["username"]
+
+
+class CacheRefresher:
+    """Fill the cache with all the users of FASJSON now and then, in a background thread.
+
+    The refresh interval should be shorter than the cache's TTL, so that the
+    addresses don't expire between two refreshes.
+    """
+
+    def __init__(self, cache, fasjson, interval, page_size=1000):
+        self._cache = cache
+        self._fasjson = fasjson
+        self._interval = interval
+        self._page_size = page_size
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="fasjson-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def refresh(self):
+        # Get all the pages before touching the cache
+        users = list(fasjson_users(self._fasjson, self._page_size))
+        count = self._cache.update(users)
+        LOGGER.info(f"Refreshed {count} email addresses from FASJSON")
+        return count
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                LOGGER.exception("Could not refresh the FASJSON cache:")
+            if self._stopped.wait(self._interval):
+                return
@@ -0,0 +1,159 @@
+""" Grouping of the messages about the same bug that arrive in a burst.
+
+Bulk edits in Bugzilla send many messages for the same bug within a few
+milliseconds. When coalescing is enabled, the relay holds the messages of a
+bug for a short window and relays them together, looking up the users of the
+whole group at once. Every event is still published, in order, unless the
+events that only change the CC list are merged.
+"""
+
+import functools
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Coalescer:
+    """Collect the items submitted with the same key during ``window`` seconds, and pass
+    each group to ``flush``, from background threads.
+
+    The window starts with the first item of a group, so an item waits at most ``window``
+    seconds. The groups are flushed by ``workers`` threads, and the groups with the same key
+    are always flushed by the same thread, in the order they were started.
+    """
+
+    def __init__(self, flush, window, workers=1, clock=time.monotonic):
+        self._flush = flush
+        self._window = window
+        self._workers = workers
+        self._clock = clock
+        self._groups = OrderedDict()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = None
+        # The queue of each worker
+        self._lanes = []
+        self._worker_threads = []
+
+    def start(self):
+        self._stopping = False
+        self._lanes = [queue.SimpleQueue() for _index in range(self._workers)]
+        for index, lane in enumerate(self._lanes):
+            thread = threading.Thread(
+                target=self._work, args=(lane,), name=f"coalescer-{index}", daemon=True
+            )
+            thread.start()
+            self._worker_threads.append(thread)
+        self._thread = threading.Thread(target=self._run, name="coalescer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Flush the pending groups without waiting for their window, and stop the threads."""
+        if self._thread is None:
+            return
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join()
+        self._thread = None
+        for lane in self._lanes:
+            lane.put(None)
+        for thread in self._worker_threads:
+            thread.join()
+        self._worker_threads = []
+
+    def submit(self, key, item):
+        with self._condition:
+            try:
+                self._groups[key][1].append(item)
+            except KeyError:
+                self._groups[key] = (self._clock() + self._window, [item])
+                self._condition.notify()
+
+    def _next_group(self):
+        """Wait for the next group to be due and return its key and items, or None when
+        stopping with no groups left.
+        """
+        with self._condition:
+            while True:
+                timeout = None
+                if self._groups:
+                    key, (deadline, items) = next(iter(self._groups.items()))
+                    timeout = deadline - self._clock()
+                    if timeout <= 0 or self._stopping:
+                        del self._groups[key]
+                        return key, items
+                elif self._stopping:
+                    return None
+                self._condition.wait(timeout)
+
+    def _run(self):
+        while True:
+            group = self._next_group()
+            if group is None:
+                return
+            key, items = group
+            self._lanes[hash(key) % len(self._lanes)].put(items)
+
+    def _work(self, lane):
+        while True:
+            items = lane.get()
+            if items is None:
+                return
+            try:
+                self._flush(items)
+            except Exception:
+                LOGGER.exception("Could not relay a group of messages:")
+
+
+def is_cc_only(body, headers):
+    """Whether a message is about a bug change that only touches the CC list."""
+    if not headers["destination"].endswith("bugzilla.bug.modify"):
+        return False
+    changes = body.get("event", {}).get("changes")
+    return bool(changes) and all(change["field"] == "cc" for change in changes)
+
+
+def _join(values):
+    return ", ".join(value for value in values if value)
+
+
+def _call_all(callbacks, error):
+    for callback in callbacks:
+        callback(error)
+
+
+def merge_cc_changes(items):
+    """Merge the consecutive (body, headers, on_published) items that only change the CC list.
+
+    The merged message has the bug and event of the last one, with the CC additions and
+    removals of all of them. Its callback calls the callbacks of all the merged messages.
+    """
+    groups = []
+    for body, headers, on_published in items:
+        if groups and is_cc_only(body, headers) and is_cc_only(*groups[-1][0][:2]):
+            groups[-1].append((body, headers, on_published))
+        else:
+            groups.append([(body, headers, on_published)])
+    merged = []
+    for group in groups:
+        if len(group) == 1:
+            merged.append(group[0])
+            continue
+        body, headers, _on_published = group[-1]
+        changes = [change for item in group for change in item[0]["event"]["changes"]]
+        body["event"]["changes"] = [
+            dict(
+                changes[-1],
+                added=_join(change["added"] for change in changes),
+                removed=_join(change["removed"] for change in changes),
+            )
+        ]
+        callbacks = [item[2] for item in group]
+        merged.append((body, headers, functools.partial(_call_all, callbacks)))
+    return merged
@@ -4,26 +4,210 @@ Authors: Aurelien Bompard <abompard@fedoraproject.org>
 
 """
 
-import json
+import functools
 import logging
+import queue
 import ssl
 import threading
+import time
 
 from stompest.config import StompConfig
 from stompest.error import StompConnectionError, StompProtocolError
 from stompest.protocol import StompSpec
 from stompest.sync import Stomp
 
+from . import metrics
+from .decode import find_bug_id, get_decoder
+from .dedup import CLAIMED, DedupIndex, IN_FLIGHT, RELAYED
+from .flow import FlowControl
+from .tracing import span, Tracer
+
 
 LOGGER = logging.getLogger(__name__)
 
+# How long to wait for an incoming frame before checking if we must stop, in seconds
+POLL_TIMEOUT = 1
+
+
+def make_ssl_context(stomp_config):
+    """The SSL context for the STOMP connection, or None if no client certificate is set."""
+    if not (stomp_config.get("ssl_crt") and stomp_config.get("ssl_key")):
+        return None
+    ssl_context = ssl.create_default_context()
+    # Disable cert validation for demo only
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    ssl_context.load_cert_chain(stomp_config["ssl_crt"], stomp_config["ssl_key"])
+    return ssl_context
+
+
+def make_dedup_index(dedup_config):
+    """The index of the relayed messages, or None if deduplication is disabled."""
+    if not dedup_config.get("window"):
+        return None
+    return DedupIndex(
+        window=dedup_config["window"],
+        size=dedup_config.get("size", 100000),
+        path=dedup_config.get("path"),
+    )
+
+
+def subscription_headers(version, prefetch_size=None):
+    headers = {
+        # client-individual mode is necessary for concurrent processing
+        # (requires ActiveMQ >= 5.2)
+        StompSpec.ACK_HEADER: StompSpec.ACK_CLIENT_INDIVIDUAL
+    }
+    if version == StompSpec.VERSION_1_2:
+        headers["id"] = 0
+    if prefetch_size:
+        # How many unacked messages the broker will send us
+        headers["activemq.prefetchSize"] = str(prefetch_size)
+    return headers
+
+
+class HeartbeatScheduler:
+    """Send the heartbeats of a STOMP connection from one long-lived thread.
+
+    A heartbeat is only sent when no other frame went out during the last half
+    period, so a busy connection doesn't get any. The lock is the one that
+    serializes the use of the connection between threads.
+    """
+
+    def __init__(self, stomp, lock):
+        self._stomp = stomp
+        self._lock = lock
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # The negotiated period is in milliseconds
+        period = self._stomp.clientHeartBeat / 1000
+        if not period or self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(period,), name="bz2fm-heartbeat", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def beat_if_idle(self, period, now=None):
+        """Send a heartbeat if nothing was sent during the last half period."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            last_sent = self._stomp.lastSent
+            if last_sent is not None and now - last_sent < period / 2:
+                return False
+            LOGGER.debug("Sending heartbeat")
+            self._stomp.beat()
+            return True
+
+    def _run(self, period):
+        while not self._stopped.wait(period / 2):
+            try:
+                self.beat_if_idle(period)
+            except StompConnectionError as e:
+                LOGGER.warning(f"Could not send a heartbeat: {e}")
+                return
+
+
+class BaseConsumer:
+    """What the STOMP engines share: the checks of the frames before they are relayed,
+    and the bookkeeping once they are acked or nacked.
+
+    The engines implement :meth:`_send_settlement` to send the ACK or NACK frame.
+    """
 
-class BugzillaConsumer:
     def __init__(self, conf, relay):
         self.relay = relay
-        self._running = False
-        self._heartbeat_timer = None
+        self.stopping = False
         self._conf = conf
+        self.tracer = Tracer(self._conf.get("tracing", {}))
+        self.dedup = make_dedup_index(self._conf.get("dedup", {}))
+        stomp_config = self._conf.get("stomp", {})
+        # How long to wait for the messages in flight when stopping, in seconds
+        self._drain_timeout = stomp_config.get("drain_timeout", 20)
+        self._decode = get_decoder(stomp_config.get("json_backend", "auto"))
+
+    def _decode_frame(self, frame, received_at, trace):
+        """The decoded body of the frame, or None if it was settled without being relayed."""
+        msg_id = frame.headers.get(StompSpec.MESSAGE_ID_HEADER)
+        if not self.relay.prefilter(frame.headers, frame.body):
+            LOGGER.debug(f"Skipping message {msg_id} without decoding it")
+            self._settle(frame, received_at, trace, ack=True)
+            return None
+        try:
+            with span("json_decode"):
+                body = self._decode(frame.body)
+        except ValueError:
+            LOGGER.exception("Could not decode the message:")
+            self._settle(frame, received_at, trace, ack=False)
+            return None
+        LOGGER.debug(f"Received message on STOMP with ID {msg_id}")
+        return body
+
+    def _claim(self, frame, received_at, trace, on_released):
+        """Claim the message of the frame in the deduplication index before relaying it.
+
+        Returns CLAIMED if it must be relayed. A frame that was already relayed is acked.
+        If a copy of the message is being relayed, the frame must not be settled until
+        ``on_released`` is called with whether that copy was relayed.
+        """
+        if self.dedup is None:
+            return CLAIMED
+        claim = self.dedup.claim(frame.headers, on_released)
+        if claim == RELAYED:
+            self._skip_duplicate(frame, received_at, trace)
+        elif claim == IN_FLIGHT:
+            msg_id = frame.headers.get(StompSpec.MESSAGE_ID_HEADER)
+            LOGGER.debug(f"Message {msg_id} is being relayed, waiting for it")
+        return claim
+
+    def _skip_duplicate(self, frame, received_at, trace):
+        msg_id = frame.headers.get(StompSpec.MESSAGE_ID_HEADER)
+        LOGGER.debug(f"Skipping message {msg_id}, it was already relayed")
+        metrics.MESSAGES_DROPPED.labels(reason="duplicate").inc()
+        self._settle(frame, received_at, trace, ack=True)
+
+    def _on_relayed(self, frame, done):
+        if self.dedup is not None:
+            self.dedup.release(frame.headers, done)
+
+    def _settle(self, frame, received_at, trace, ack):
+        try:
+            self._send_settlement(frame, ack)
+        finally:
+            metrics.FRAMES_IN_FLIGHT.dec()
+        if ack:
+            metrics.ACK_LATENCY.observe(time.monotonic() - received_at)
+        else:
+            metrics.MESSAGES_NACKED.inc()
+        if trace is not None:
+            trace.finish()
+
+    def _send_settlement(self, frame, ack):  # pragma: no cover
+        raise NotImplementedError
+
+
+class BugzillaConsumer(BaseConsumer):
+    def __init__(self, conf, relay):
+        super().__init__(conf, relay)
+        # Using the STOMP connection from multiple threads must be serialized
+        self._stomp_lock = threading.Lock()
+        self._worker_threads = []
+        # The queue of each worker
+        self._lanes = []
+        self._next_lane = 0
+        # The frames to relay again because their other copy was not published
+        self._retries = queue.SimpleQueue()
 
         # Bugzilla
         self.products = self._conf.get("bugzilla", {}).get("products", ["Fedora", "Fedora EPEL"])
@@ -33,28 +217,24 @@ class BugzillaConsumer:
         self._queue_name = stomp_config.get("queue", "/queue/fedora_from_esb")
         self._heartbeat = stomp_config.get("heartbeat")
         self._vhost = stomp_config.get("vhost", "/")
-        if stomp_config.get("ssl_crt") and stomp_config.get("ssl_key"):
-            ssl_context = ssl.create_default_context()
-            # Disable cert validation for demo only
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
-            ssl_context.load_cert_chain(stomp_config["ssl_crt"], stomp_config["ssl_key"])
-        else:
-            ssl_context = None
-
+        self._prefetch_size = stomp_config.get("prefetch_size")
+        self._workers = stomp_config.get("workers", 1)
+        self._queue_size = stomp_config.get("queue_size", 100)
+        high_water = stomp_config.get("high_water", 200)
+        self.flow = FlowControl(high_water, stomp_config.get("low_water", high_water // 2))
         stomp_config = StompConfig(
             stomp_config["uri"],
             login=stomp_config.get("user"),
             passcode=stomp_config.get("pass"),
-            sslContext=ssl_context,
+            sslContext=make_ssl_context(stomp_config),
             version=StompSpec.VERSION_1_2,
         )
         self.stomp = Stomp(stomp_config)
+        self._heartbeat_scheduler = HeartbeatScheduler(self.stomp, self._stomp_lock)
 
         LOGGER.debug("Initialized bz2fm STOMP consumer.")
 
     def _connect(self):
-        self._running = True
         LOGGER.debug("STOMP consumer is connecting...")
         heartbeats = None
         if self._heartbeat:
@@ -67,17 +247,12 @@ class BugzillaConsumer:
                 return
             raise
 
-        self.setup_heartbeat()
+        self._heartbeat_scheduler.start()
 
-        headers = {
-            # client-individual mode is necessary for concurrent processing
-            # (requires ActiveMQ >= 5.2)
-            StompSpec.ACK_HEADER: StompSpec.ACK_CLIENT_INDIVIDUAL
-        }
-        if self.stomp.session.version == StompSpec.VERSION_1_2:
-            headers["id"] = 0
+        headers = subscription_headers(self.stomp.session.version, self._prefetch_size)
         try:
-            self.stomp.subscribe(self._queue_name, headers)
+            with self._stomp_lock:
+                self.stomp.subscribe(self._queue_name, headers)
         except StompProtocolError as e:
             if e.args[0].startswith("Already subscribed "):
                 return
@@ -86,38 +261,198 @@ class BugzillaConsumer:
     def consume(self):
         self._connect()
         LOGGER.info("STOMP consumer is ready")
-        while self._running:
-            frame = self.stomp.receiveFrame()
-            if frame.command != StompSpec.MESSAGE:
-                continue
-            body = json.loads(frame.body.decode())
-            msg_id = frame.headers.get(StompSpec.MESSAGE_ID_HEADER)
-            LOGGER.debug(f"Received message on STOMP with ID {msg_id}")
+        self._start_workers()
+        try:
+            while not self.stopping:
+                self.tracer.dump_if_requested()
+                self._relay_retries()
+                # Too many messages are waiting to be published: leave the next ones in
+                # the socket and with the broker. The heartbeats are still sent, but the
+                # broker's are not read, so don't check them.
+                if not self.flow.wait(POLL_TIMEOUT):
+                    continue
+                if not self._wait_readable(POLL_TIMEOUT):
+                    self._check_server_heartbeat()
+                    continue
+                with self._stomp_lock:
+                    # Reading from the socket must not happen while another thread sends
+                    if not self.stomp.canRead(0):
+                        continue
+                    frame = self.stomp.receiveFrame()
+                if frame.command != StompSpec.MESSAGE:
+                    continue
+                received_at = time.monotonic()
+                metrics.MESSAGES_RECEIVED.inc()
+                metrics.FRAMES_IN_FLIGHT.inc()
+                self.flow.acquire()
+                self._dispatch(frame, received_at)
+            # Stopping: relay what was received, and let it be published and acked
+            self._stop_workers()
+            self._drain()
+        finally:
+            self._stop_workers()
+            self._heartbeat_scheduler.stop()
+        with self._stomp_lock:
+            self.stomp.disconnect()
+
+    def _wait_readable(self, timeout):
+        """Wait for data from the broker, without holding the lock so the other threads can
+        send meanwhile. Only this thread reads from the socket.
+        """
+        with self._stomp_lock:
+            # Raises StompConnectionError if the connection was closed
+            transport = self.stomp._transport
+        return transport.canRead(timeout)
+
+    def _drain(self):
+        """Wait for the messages in flight to be published and acked before disconnecting.
+
+        The messages that are not acked after ``drain_timeout`` seconds will be redelivered.
+        """
+        if self.flow.in_flight:
+            LOGGER.info(f"Waiting for the {self.flow.in_flight} messages in flight")
+        deadline = time.monotonic() + self._drain_timeout
+        while not self.flow.drain(min(POLL_TIMEOUT, max(0, deadline - time.monotonic()))):
+            if time.monotonic() >= deadline:
+                LOGGER.warning(
+                    f"{self.flow.in_flight} messages were not published after "
+                    f"{self._drain_timeout}s, the broker will redeliver them"
+                )
+                return
+            # The workers are stopped, relay them from this thread
+            self._relay_retries()
+
+    def _check_server_heartbeat(self):
+        """Raise StompConnectionError if the broker has been silent for too long."""
+        period = self.stomp.serverHeartBeat / 1000
+        if not period or self.stomp.lastReceived is None:
+            return
+        silence = time.time() - self.stomp.lastReceived
+        # Be lenient with the broker, as the STOMP specification suggests
+        if silence > period * 2:
+            with self._stomp_lock:
+                self.stomp.close()
+            raise StompConnectionError(
+                f"No heartbeat received from the STOMP broker in {silence:.1f}s"
+            )
+
+    def _dispatch(self, frame, received_at, trace=None):
+        if self._worker_threads:
+            self._lane_for(frame).put((frame, received_at, trace))
+        else:
+            self._process(frame, received_at, trace)
+
+    def _process(self, frame, received_at, trace=None):
+        if trace is None:
+            trace = self.tracer.begin(frame.headers.get(StompSpec.MESSAGE_ID_HEADER))
+        with self.tracer.activate(trace):
+            body = self._decode_frame(frame, received_at, trace)
+            if body is None:
+                return
+            on_released = functools.partial(self._on_copy_released, frame, received_at, trace)
+            if self._claim(frame, received_at, trace, on_released) != CLAIMED:
+                return
             try:
-                self.relay.on_stomp_message(body, frame.headers)
+                self.relay.on_stomp_message(
+                    body,
+                    frame.headers,
+                    on_published=functools.partial(self._on_published, frame, received_at, trace),
+                )
             except Exception:
                 LOGGER.exception("Exception when relaying the message:")
-                self.stomp.nack(frame)
-            else:
+                self._on_relayed(frame, done=False)
+                self._settle(frame, received_at, trace, ack=False)
+
+    def _on_published(self, frame, received_at, trace, error):
+        # The relay has published (or dropped) the message, it can be acked.
+        if error is not None:
+            msg_id = frame.headers.get(StompSpec.MESSAGE_ID_HEADER)
+            LOGGER.error(f"Could not publish message with ID {msg_id}: {error}")
+        self._on_relayed(frame, done=error is None)
+        self._settle(frame, received_at, trace, ack=error is None)
+
+    def _on_copy_released(self, frame, received_at, trace, done):
+        # Called from the thread that released the other copy of the message
+        if done:
+            self._skip_duplicate(frame, received_at, trace)
+        else:
+            self._retries.put((frame, received_at, trace))
+
+    def _relay_retries(self):
+        """Relay the frames whose other copy was not published, from the receiving thread."""
+        while True:
+            try:
+                frame, received_at, trace = self._retries.get_nowait()
+            except queue.Empty:
+                return
+            self._dispatch(frame, received_at, trace)
+
+    def _settle(self, frame, received_at, trace, ack):
+        try:
+            super()._settle(frame, received_at, trace, ack)
+        finally:
+            self.flow.release()
+
+    def _send_settlement(self, frame, ack):
+        with self._stomp_lock:
+            if ack:
                 self.stomp.ack(frame)
-        self.stomp.disconnect()
+            else:
+                self.stomp.nack(frame)
 
-    def stop(self):
-        self._running = False
-        if self._heartbeat_timer:
-            self._heartbeat_timer.cancel()
+    def lane_depths(self):
+        """The number of messages waiting in the queue of each worker."""
+        return [lane.qsize() for lane in self._lanes]
 
-    def setup_heartbeat(self):
-        if not self._heartbeat:
+    def _lane_for(self, frame):
+        """The queue of the worker that must relay the frame.
+
+        The messages about the same bug always go to the same worker, so that they are
+        relayed in the order they were received. The others are spread over the workers.
+        """
+        bug_id = find_bug_id(frame.body)
+        if bug_id is None:
+            index = self._next_lane
+            self._next_lane = (index + 1) % len(self._lanes)
+        else:
+            index = bug_id % len(self._lanes)
+        return self._lanes[index]
+
+    def _start_workers(self):
+        if self._workers <= 1:
             return
+        self._lanes = [queue.Queue(maxsize=self._queue_size) for _index in range(self._workers)]
+        for index, lane in enumerate(self._lanes):
+            metrics.set_function(metrics.WORKER_LANE_DEPTH.labels(lane=str(index)), lane.qsize)
+            thread = threading.Thread(
+                target=self._work, args=(lane,), name=f"bz2fm-worker-{index}", daemon=True
+            )
+            thread.start()
+            self._worker_threads.append(thread)
 
-        def _send_heartbeat():
-            if not self._running:
+    def _work(self, lane):
+        while True:
+            item = lane.get()
+            if item is None:
                 return
-            LOGGER.debug("Sending heartbeat")
-            self.stomp.beat()
-            self.setup_heartbeat()
+            try:
+                self._process(*item)
+            except Exception:
+                LOGGER.exception("Could not process the frame:")
+
+    def _stop_workers(self):
+        if not self._worker_threads:
+            return
+        # Let the workers finish what has already been received
+        for lane in self._lanes:
+            lane.put(None)
+        for thread in self._worker_threads:
+            thread.join()
+        self._worker_threads = []
+
+    def stop(self):
+        """Stop receiving messages, and disconnect once the messages in flight are acked.
 
-        delay = self._heartbeat - self._heartbeat / 10
-        self._heartbeat_timer = threading.Timer(delay / 1000, _send_heartbeat)
-        self._heartbeat_timer.start()
+        This can be called from any thread, or from a signal handler.
+        """
+        self.stopping = True
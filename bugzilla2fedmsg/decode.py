@@ -0,0 +1,68 @@
+""" Decoding of the JSON bodies of the STOMP frames.
+
+The frames are decoded straight from their bytes. orjson or msgspec are used
+when they are installed, as they are much faster than the json module, which
+is the fallback.
+"""
+
+import json
+import re
+
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover
+    msgspec = None
+
+
+def _json_loads(data):
+    return json.loads(data)
+
+
+def _msgspec_loads(data):
+    try:
+        return msgspec.json.decode(data)
+    except msgspec.DecodeError as e:
+        # Like the other backends, which raise subclasses of ValueError
+        raise ValueError(str(e)) from e
+
+
+BUG_ID_RE = re.compile(rb'"bug_id"\s*:\s*(\d+)')
+
+
+def find_bug_id(data):
+    """The id of the bug a message is about, read from its raw body, or None if it has none."""
+    match = BUG_ID_RE.search(data)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+# By order of preference
+BACKENDS = {}
+if orjson is not None:
+    BACKENDS["orjson"] = orjson.loads
+if msgspec is not None:
+    BACKENDS["msgspec"] = _msgspec_loads
+BACKENDS["json"] = _json_loads
+
+
+def get_decoder(backend="auto"):
+    """The function that decodes a JSON document from bytes with the given backend.
+
+    With "auto", the fastest installed backend is used. The function raises ValueError
+    when the document is invalid.
+    """
+    if backend == "auto":
+        return next(iter(BACKENDS.values()))
+    try:
+        return BACKENDS[backend]
+    except KeyError:
+        raise ValueError(
+            f"The {backend!r} JSON backend is not available, choose from: {', '.join(BACKENDS)}"
+        ) from None
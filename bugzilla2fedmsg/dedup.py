@@ -0,0 +1,138 @@
+""" Detection of the STOMP messages that were already relayed.
+
+The broker redelivers the messages that were nacked or not acked before a
+disconnection, and after a failover the same Bugzilla event can come back
+with a new ``message-id``. The index remembers the messages relayed during
+the last ``window`` seconds, keyed on their ``correlation-id`` header (set
+by Bugzilla for each event) or their ``message-id`` header otherwise, so
+that the copies can be acked without being published again.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from stompest.protocol import StompSpec
+
+from .utils import open_database
+
+
+LOGGER = logging.getLogger(__name__)
+
+# How many messages to remember between two cleanups of the database
+PRUNE_EVERY = 1000
+
+
+def message_key(headers):
+    return headers.get("correlation-id") or headers.get(StompSpec.MESSAGE_ID_HEADER)
+
+
+# The results of DedupIndex.claim()
+CLAIMED = "claimed"
+RELAYED = "relayed"
+IN_FLIGHT = "in-flight"
+
+
+class DedupIndex:
+    """The keys of the messages relayed in the last ``window`` seconds, at most ``size`` of them.
+
+    A message must be claimed with :meth:`claim` before it is relayed, and released with
+    :meth:`release` once it has been published (or not). The copies received meanwhile
+    must wait until then, as the message may still fail. If a path is given, the relayed
+    messages are also written to a SQLite database there, and loaded from it on startup.
+    """
+
+    def __init__(self, window=3600, size=100000, path=None, clock=time.time):
+        self.window = window
+        self.size = size
+        self._clock = clock
+        self._seen = OrderedDict()
+        # The callbacks waiting for each message being relayed
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self._added = 0
+        if path:
+            self._open(path)
+
+    def __len__(self):
+        return len(self._seen)
+
+    def claim(self, headers, on_released=None):
+        """Mark the message as being relayed and return CLAIMED, or return RELAYED if it was
+        already relayed.
+
+        If a copy of the message is being relayed, return IN_FLIGHT, and call
+        ``on_released`` with whether that copy was relayed once it is released.
+        """
+        key = message_key(headers)
+        if key is None:
+            return CLAIMED
+        with self._lock:
+            self._expire(self._clock())
+            if key in self._seen:
+                return RELAYED
+            if key in self._in_flight:
+                if on_released is not None:
+                    self._in_flight[key].append(on_released)
+                return IN_FLIGHT
+            self._in_flight[key] = []
+        return CLAIMED
+
+    def release(self, headers, done):
+        """The message is not being relayed anymore. Remember it if ``done`` is true, so that
+        it can't be relayed again, otherwise let the broker redeliver it.
+        """
+        key = message_key(headers)
+        if key is None:
+            return
+        now = self._clock()
+        with self._lock:
+            waiting = self._in_flight.pop(key, [])
+            if done:
+                self._remember(key, now)
+        for on_released in waiting:
+            on_released(done)
+
+    def _remember(self, key, now):
+        self._seen[key] = now
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.size:
+            self._seen.popitem(last=False)
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO seen (key, seen_at) VALUES (?, ?)", (key, now))
+            self._added += 1
+            if self._added % PRUNE_EVERY == 0:
+                self._prune(now)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _expire(self, now):
+        # Oldest first, since they are added in order
+        oldest = now - self.window
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if seen_at > oldest:
+                break
+            del self._seen[key]
+
+    def _open(self, path):
+        self._db = open_database(
+            path, "CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, seen_at REAL NOT NULL)"
+        )
+        now = self._clock()
+        self._prune(now)
+        rows = self._db.execute(
+            "SELECT key, seen_at FROM seen ORDER BY seen_at DESC LIMIT ?", (self.size,)
+        ).fetchall()
+        for key, seen_at in reversed(rows):
+            self._seen[key] = seen_at
+        LOGGER.info(f"Loaded {len(self._seen)} relayed messages from {path}")
+
+    def _prune(self, now):
+        self._db.execute("DELETE FROM seen WHERE seen_at <= ?", (now - self.window,))
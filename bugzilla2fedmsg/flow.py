@@ -0,0 +1,61 @@
+""" Flow control between receiving the STOMP messages and publishing them. """
+
+import logging
+import threading
+
+from . import metrics
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FlowControl:
+    """Count the messages that were received and not acked or nacked yet, and tell the
+    receiver to pause when there are too many of them.
+
+    Receiving pauses when ``high_water`` messages are in flight, and resumes once they are
+    down to ``low_water``, so that it doesn't flap around a single limit.
+    """
+
+    def __init__(self, high_water, low_water):
+        if not 0 <= low_water < high_water:
+            raise ValueError(
+                f"The low water mark ({low_water}) must be lower than the high water mark "
+                f"({high_water})"
+            )
+        self.high_water = high_water
+        self.low_water = low_water
+        self.in_flight = 0
+        self.paused = False
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """A message was received."""
+        with self._condition:
+            self.in_flight += 1
+            if not self.paused and self.in_flight >= self.high_water:
+                LOGGER.info(f"{self.in_flight} messages in flight, pausing the reception")
+                self.paused = True
+                metrics.RECEIVE_PAUSED.set(1)
+
+    def release(self):
+        """A message was acked or nacked."""
+        with self._condition:
+            self.in_flight -= 1
+            if self.paused and self.in_flight <= self.low_water:
+                LOGGER.info(f"{self.in_flight} messages in flight, resuming the reception")
+                self.paused = False
+                metrics.RECEIVE_PAUSED.set(0)
+                self._condition.notify_all()
+            elif self.in_flight == 0:
+                self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        """Wait until the reception is not paused, return False if it still is after timeout."""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self.paused, timeout)
+
+    def drain(self, timeout=None):
+        """Wait until no message is in flight, return False if some still are after timeout."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self.in_flight == 0, timeout)
@@ -0,0 +1,200 @@
+""" Prometheus metrics for the consumer and the relay.
+
+The prometheus_client library is optional: without it the metrics below
+are no-ops, and the metrics HTTP endpoint can't be started.
+"""
+
+import contextlib
+import logging
+import os
+import threading
+import time
+
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:  # pragma: no cover
+    prometheus_client = None
+
+
+LOGGER = logging.getLogger(__name__)
+
+# How often to set the gauges that are computed by a function, in multiprocess mode
+SAMPLE_INTERVAL = 5
+
+
+class _NoopMetric:
+    """Stand-in for the Prometheus metrics when prometheus_client isn't installed."""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def set_function(self, function):
+        pass
+
+    def observe(self, amount):
+        pass
+
+    def time(self):
+        return contextlib.nullcontext()
+
+
+def _metric(kind, name, documentation, **kwargs):
+    if prometheus_client is None:  # pragma: no cover
+        return _NoopMetric()
+    return getattr(prometheus_client, kind)(f"bugzilla2fedmsg_{name}", documentation, **kwargs)
+
+
+MESSAGES_RECEIVED = _metric("Counter", "messages_received", "Messages received on STOMP")
+MESSAGES_DROPPED = _metric(
+    "Counter", "messages_dropped", "Messages that were not relayed", labelnames=["reason"]
+)
+MESSAGES_PUBLISHED = _metric(
+    "Counter", "messages_published", "Messages published to Fedora Messaging"
+)
+MESSAGES_REJECTED = _metric(
+    "Counter", "messages_rejected", "Messages rejected by the Fedora Messaging broker"
+)
+MESSAGES_FAILED = _metric(
+    "Counter", "messages_failed", "Messages that could not be sent to Fedora Messaging"
+)
+MESSAGES_OUTBOXED = _metric(
+    "Counter", "messages_outboxed", "Messages kept in the outbox to be published later"
+)
+MESSAGES_NACKED = _metric("Counter", "messages_nacked", "Messages nacked on STOMP")
+MESSAGES_DEGRADED = _metric(
+    "Counter",
+    "messages_degraded",
+    "Messages published with usernames that could not be looked up in FASJSON",
+)
+ACK_LATENCY = _metric(
+    "Histogram", "ack_latency_seconds", "Time between receiving a message and acking it"
+)
+FASJSON_LOOKUP_TIME = _metric(
+    "Histogram", "fasjson_lookup_seconds", "Time spent looking up a user in FASJSON"
+)
+PUBLISH_TIME = _metric(
+    "Histogram", "publish_seconds", "Time spent publishing a message to Fedora Messaging"
+)
+# In multiprocess mode, the gauges of the processes that exited are discarded: they are
+# summed (or maxed) over the live processes only
+FRAMES_IN_FLIGHT = _metric(
+    "Gauge",
+    "frames_in_flight",
+    "Messages received on STOMP and not acked or nacked yet",
+    multiprocess_mode="livesum",
+)
+WORKER_LANE_DEPTH = _metric(
+    "Gauge",
+    "worker_lane_depth",
+    "Messages received on STOMP and waiting for a worker, by worker lane",
+    labelnames=["lane"],
+    multiprocess_mode="livesum",
+)
+OUTBOX_DEPTH = _metric(
+    "Gauge", "outbox_depth", "Messages waiting in the outbox", multiprocess_mode="livesum"
+)
+RECEIVE_PAUSED = _metric(
+    "Gauge",
+    "receive_paused",
+    "Whether receiving STOMP messages is paused, with too many messages in flight",
+    multiprocess_mode="livemax",
+)
+FASJSON_CACHE_SIZE = _metric(
+    "Gauge",
+    "fasjson_cache_size",
+    "Number of email addresses in the FASJSON cache",
+    multiprocess_mode="livemax",
+)
+FASJSON_CIRCUIT_OPEN = _metric(
+    "Gauge",
+    "fasjson_circuit_open",
+    "Whether FASJSON calls are suspended after failures",
+    multiprocess_mode="livemax",
+)
+
+
+_sampled_gauges = {}
+_sampler_lock = threading.Lock()
+_sampler = None
+
+
+def set_function(gauge, function):
+    """Make the gauge report the value returned by the function.
+
+    In multiprocess mode, prometheus_client only serves the values that the processes
+    wrote, and never calls the function: a thread sets the gauge with it every
+    ``SAMPLE_INTERVAL`` seconds instead.
+    """
+    global _sampler
+    if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        gauge.set_function(function)
+        return
+    with _sampler_lock:
+        _sampled_gauges[gauge] = function
+        # After a fork, the thread of the parent process is not running
+        if _sampler is None or not _sampler.is_alive():
+            _sampler = threading.Thread(target=_sample_forever, name="metrics", daemon=True)
+            _sampler.start()
+
+
+def sample_gauges():
+    """Set the gauges computed by a function, in multiprocess mode."""
+    with _sampler_lock:
+        gauges = list(_sampled_gauges.items())
+    for gauge, function in gauges:
+        try:
+            gauge.set(function())
+        except Exception:
+            LOGGER.exception("Could not compute a gauge:")
+
+
+def _sample_forever():
+    while True:
+        sample_gauges()
+        time.sleep(SAMPLE_INTERVAL)
+
+
+def start_http_server(config, multiprocess_mode=False):
+    """Start the HTTP endpoint serving the metrics, if it is configured.
+
+    In multiprocess mode, the endpoint serves the metrics of all the relay processes,
+    which prometheus_client writes to the PROMETHEUS_MULTIPROC_DIR directory. The gauges
+    computed by a function, such as the FASJSON cache size, lag by up to
+    ``SAMPLE_INTERVAL`` seconds.
+    """
+    port = config.get("port")
+    if not port:
+        return
+    if prometheus_client is None:  # pragma: no cover
+        raise RuntimeError("The prometheus_client library is required to serve metrics")
+    address = config.get("address", "0.0.0.0")  # noqa: S104
+    if multiprocess_mode:
+        if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+            raise RuntimeError(
+                "The PROMETHEUS_MULTIPROC_DIR environment variable must be set to serve the "
+                "metrics of several processes"
+            )
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        prometheus_client.start_http_server(port, addr=address, registry=registry)
+    else:
+        prometheus_client.start_http_server(port, addr=address)
+    LOGGER.info(f"Serving metrics on {address}:{port}")
+
+
+def mark_process_dead(pid):
+    """Forget the live gauges of a relay process that exited, in multiprocess mode."""
+    if prometheus_client is None or not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        return
+    multiprocess.mark_process_dead(pid)
@@ -0,0 +1,54 @@
+""" The Bugzilla messages, as they go through the relay.
+
+A message is decoded once from the STOMP body, converted in place, and turned
+into the body of the Fedora Messaging message once its users are known. The
+bug, event and object payloads are kept as the dicts decoded from the STOMP
+body: Bugzilla sends many custom fields, and the published body must contain
+all of them, in the order they were received.
+"""
+
+
+class BugzillaMessage:
+    """A message received from Bugzilla about an object (a bug, a comment, an attachment...)."""
+
+    __slots__ = ("obj", "bug", "event", "payload", "headers", "agent_email", "emails")
+
+    def __init__(self, obj, bug, event, payload, headers):
+        # The name of the object, and the dict of the object without its bug (None for bugs)
+        self.obj = obj
+        self.bug = bug
+        self.event = event
+        self.payload = payload
+        self.headers = headers
+        # The email address of the user who triggered the event
+        self.agent_email = None
+        # The email addresses of all the users affected by the event
+        self.emails = []
+
+    @classmethod
+    def from_stomp(cls, obj, body, headers):
+        """Split the body of a STOMP message about ``obj``, in place."""
+        if obj == "bug":
+            return cls(obj, body["bug"], body.get("event"), None, headers)
+        payload = body[obj]
+        return cls(obj, payload.pop("bug"), body.get("event"), payload, headers)
+
+    @property
+    def all_emails(self):
+        """The email addresses to look up in FASJSON."""
+        return set(self.emails) | {self.agent_email}
+
+    def to_body(self, fas_names):
+        """The body of the message to publish, given the FAS username of each email address."""
+        agent_name = fas_names[self.agent_email]
+        # usernames: all FAS usernames affected by the action
+        usernames = {fas_names[email] for email in self.emails}
+        usernames.discard(None)
+        if agent_name is not None:
+            usernames.add(agent_name)
+        body = {"bug": self.bug, "event": self.event, "headers": self.headers}
+        if self.payload is not None:
+            body[self.obj] = self.payload
+        body["agent_name"] = agent_name
+        body["usernames"] = sorted(usernames)
+        return body
@@ -0,0 +1,143 @@
+""" Keeping the messages that could not be published, to publish them later.
+
+When the Fedora Messaging broker can't be reached, the relay writes the
+messages to the outbox, a SQLite database, and the STOMP messages are acked.
+A background thread publishes them again, in order, once the broker is back.
+Until the outbox is empty, new messages are added to it too, so that they are
+not published before the older ones.
+"""
+
+import logging
+import threading
+
+from fedora_messaging.message import dumps, loads
+
+from .utils import open_database
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class OutboxFull(Exception):
+    """The outbox already holds as many messages as it can."""
+
+
+class Outbox:
+    """Messages waiting to be published, in a SQLite database, at most ``max_size`` of them.
+
+    In WAL mode with ``synchronous=NORMAL``, the messages survive the process crashing as
+    soon as they are written, and they are synced to the disk in batches, at checkpoints
+    (see :meth:`sync`).
+    """
+
+    def __init__(self, path, max_size=100000):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._db = open_database(
+            path,
+            "CREATE TABLE IF NOT EXISTS outbox "
+            "(id INTEGER PRIMARY KEY AUTOINCREMENT, message TEXT NOT NULL)",
+        )
+        # Kept in memory, it is checked before publishing every message
+        self._count = self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        if self._count:
+            LOGGER.info(f"{self._count} messages are waiting in the outbox {path}")
+
+    def __len__(self):
+        return self._count
+
+    def append(self, message):
+        """Add a message at the end of the outbox, raise OutboxFull if there is no room."""
+        serialized = dumps(message)
+        with self._lock:
+            if self._count >= self.max_size:
+                raise OutboxFull(f"The outbox already holds {self._count} messages")
+            self._db.execute("INSERT INTO outbox (message) VALUES (?)", (serialized,))
+            self._count += 1
+
+    def peek(self, limit=100):
+        """List the (id, message) of the oldest messages."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, message FROM outbox ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+        return [(row_id, loads(serialized)[0]) for row_id, serialized in rows]
+
+    def remove(self, row_id):
+        with self._lock:
+            cursor = self._db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+            self._count -= cursor.rowcount
+
+    def sync(self):
+        """Write the messages added since the last checkpoint to the disk."""
+        with self._lock:
+            self._db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class OutboxDrainer:
+    """Publish the messages of the outbox in a background thread, oldest first.
+
+    ``publish`` is called with each message, and the message is removed from the outbox
+    once it returns. When it raises, the drainer waits ``interval`` seconds before trying
+    again with the same message. The outbox is synced to the disk at the same interval.
+    """
+
+    def __init__(self, outbox, publish, interval=10, batch_size=100):
+        self.outbox = outbox
+        self.interval = interval
+        self.batch_size = batch_size
+        self._publish = publish
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="outbox-drain", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def drain(self):
+        """Publish the messages until the outbox is empty or publishing fails.
+
+        Returns the number of messages that were published.
+        """
+        published = 0
+        while not self._stopping.is_set():
+            batch = self.outbox.peek(self.batch_size)
+            if not batch:
+                break
+            for row_id, message in batch:
+                if self._stopping.is_set():
+                    return published
+                try:
+                    self._publish(message)
+                except Exception as e:
+                    LOGGER.warning(
+                        f"Could not publish the {len(self.outbox)} messages of the outbox, "
+                        f"trying again in {self.interval}s: {e}"
+                    )
+                    return published
+                self.outbox.remove(row_id)
+                published += 1
+        if published:
+            LOGGER.info(f"Published {published} messages from the outbox")
+        return published
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.outbox.sync()
+                self.drain()
+            except Exception:
+                LOGGER.exception("Could not drain the outbox:")
@@ -0,0 +1,80 @@
+""" Publishing to Fedora Messaging with several messages in flight. """
+
+import contextvars
+import logging
+import queue
+import threading
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Publisher:
+    """Publish messages from a pool of threads.
+
+    Fedora Messaging's ``publish()`` blocks until the broker has confirmed the
+    message, on a connection and channel that are kept open between calls.
+    Running it from several threads keeps several messages waiting for their
+    confirmation at the same time. The callback given with each message is
+    called once it is confirmed (with ``None``) or once publishing failed (with
+    the exception).
+
+    Each thread has its own queue. The messages submitted with the same key go to
+    the same thread, and are published in the order they were submitted.
+    """
+
+    def __init__(self, publish, in_flight=10, queue_size=100):
+        self._publish = publish
+        self._in_flight = in_flight
+        # The queue size is shared between the threads
+        self._queues = [
+            queue.Queue(maxsize=max(1, queue_size // in_flight)) for _index in range(in_flight)
+        ]
+        self._next_queue = 0
+        self._threads = []
+
+    def start(self):
+        for index, lane in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._work, args=(lane,), name=f"publisher-{index}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Publish what has already been submitted and stop the threads."""
+        for lane in self._queues:
+            lane.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, message, callback, key=None):
+        """Queue a message for publication, waiting if the queue is full.
+
+        The messages without a key are spread over the threads in turn.
+        """
+        if key is None:
+            index = self._next_queue
+            self._next_queue = (index + 1) % self._in_flight
+        else:
+            index = hash(key) % self._in_flight
+        # Keep the context of the caller (the trace of the message)
+        self._queues[index].put((message, callback, contextvars.copy_context()))
+
+    def _work(self, lane):
+        while True:
+            item = lane.get()
+            if item is None:
+                return
+            message, callback, context = item
+            try:
+                context.run(self._publish, message)
+            except Exception as e:
+                error = e
+            else:
+                error = None
+            try:
+                context.run(callback, error)
+            except Exception:
+                LOGGER.exception(f"Error in the callback for message {message.id}:")
@@ -1,70 +1,298 @@
-import datetime
+import asyncio
+import json
 import logging
+import re
+import sqlite3
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
-import pytz
 from bugzilla2fedmsg_schema import MessageV1, MessageV1BZ4
 from fasjson_client import Client as FasjsonClient
 from fedora_messaging.api import publish
-from fedora_messaging.exceptions import ConnectionException, PublishReturned
+from fedora_messaging.exceptions import ConnectionException, PublishReturned, PublishTimeout
 from fedora_messaging.message import INFO
 
-from .utils import convert_datetimes, email_to_fas, needinfo_email
+from . import metrics
+from .breaker import CircuitBreaker, CircuitOpen
+from .bz4compat import compile_transform
+from .cache import CacheRefresher, EmailCache, EmailStore
+from .coalesce import Coalescer, merge_cc_changes
+from .model import BugzillaMessage
+from .outbox import Outbox, OutboxDrainer, OutboxFull
+from .publisher import Publisher
+from .supervisor import process_slot
+from .tracing import span
+from .utils import cached_email_to_fas, convert_datetimes, needinfo_email, query_email_to_fas
 
 
 LOGGER = logging.getLogger(__name__)
 
+# Set on the messages whose usernames could not all be looked up in FASJSON
+DEGRADED_HEADER = "bugzilla2fedmsg_degraded"
 
-def _bz4_compat_transform(bug, event, objdict, obj):
-    """Modify the bug, event and obj dicts for a message to look more
-    like a Bugzilla 4-era message's dicts did. Returns nothing as it
-    modifies the dicts in place.
+
+def _product_markers(products):
+    """The bytes that the raw JSON body of a message must contain for its product to be one
+    of ``products``, or None if the names could be encoded in several ways.
     """
-    if bug.get("assigned_to", {}).get("login"):
-        bug["assigned_to"] = bug["assigned_to"]["login"]
-    if bug.get("component", {}).get("name"):
-        bug["component"] = bug["component"]["name"]
-    if bug.get("product", {}).get("name"):
-        bug["product"] = bug["product"]["name"]
-    bug["cc"] = bug.get("cc", [])
-    if bug.get("reporter", {}).get("login"):
-        bug["creator"] = bug["reporter"]["login"]
-    if bug.get("operating_system"):
-        bug["op_sys"] = bug["operating_system"]
-    if not bug.get("weburl"):
-        bug["weburl"] = f"https://bugzilla.redhat.com/show_bug.cgi?id={bug['id']}"
-    event["who"] = event["user"]["login"]
-    event["changes"] = event.get("changes", [])
-    for change in event["changes"]:
-        change["field_name"] = change["field"]
-    if obj == "comment":
-        # I would expect this to be real_name so we're not spaffing
-        # email addresses all over, but I checked and historically
-        # it was definitely login
-        objdict[obj]["author"] = event.get("user", {}).get("login", "")
+    markers = []
+    for product in products:
+        marker = json.dumps(product)
+        # Non-ASCII characters, quotes or slashes may or may not be escaped by Bugzilla
+        if marker != f'"{product}"' or not product.isascii() or "/" in product:
+            return None
+        markers.append(marker.encode())
+    return markers or None
 
 
 class DropMessage(Exception):
-    def __init__(self, message):
+    def __init__(self, message, reason="other"):
         self.message = message
+        self.reason = reason
 
     def __str__(self):
         return self.message
 
 
 class MessageRelay:
-    def __init__(self, config):
+    def __init__(self, config, sink=None):
         self.config = config
+        # Where to send the messages instead of publishing them to Fedora Messaging
+        self._sink = sink
         self._allowed_products = self.config.get("bugzilla", {}).get("products", [])
+        self._product_markers = _product_markers(self._allowed_products)
         self._bz4_compat_mode = self.config.get("bugzilla", {}).get("bz4compat", True)
+        self._bz4_compat_transform = compile_transform()
+        # Number of messages that were not relayed, by reason
+        self.dropped = Counter()
         self._fasjson = FasjsonClient(self.config["fasjson_url"])
+        breaker_config = self.config.get("fasjson_breaker", {})
+        self._fasjson_breaker = CircuitBreaker(
+            "FASJSON",
+            failure_threshold=breaker_config.get("failure_threshold", 5),
+            reset_timeout=breaker_config.get("reset_timeout", 30),
+        )
+        metrics.set_function(
+            metrics.FASJSON_CIRCUIT_OPEN, lambda: not self._fasjson_breaker.is_closed
+        )
+        cache_config = self.config.get("fasjson_cache", {})
+        store = None
+        if cache_config.get("path"):
+            store = EmailStore(
+                cache_config["path"], max_age=cache_config.get("max_age", 30 * 86400)
+            )
+        self._fasjson_cache = EmailCache(
+            size=cache_config.get("size", 10000),
+            ttl=cache_config.get("ttl", 3600),
+            negative_ttl=cache_config.get("negative_ttl", 300),
+            store=store,
+        )
+        if store is not None:
+            loaded = self._fasjson_cache.warm()
+            LOGGER.info(f"Loaded {loaded} email addresses from {store.path}")
+        self._cache_refresher = None
+        # The relay processes share the database, so only one of them refreshes it. The
+        # others only see the addresses it fetched when they look them up.
+        if cache_config.get("refresh_interval") and process_slot() == 0:
+            self._cache_refresher = CacheRefresher(
+                self._fasjson_cache,
+                self._fasjson,
+                interval=cache_config["refresh_interval"],
+                page_size=cache_config.get("refresh_page_size", 1000),
+            )
+            self._cache_refresher.start()
+        metrics.set_function(metrics.FASJSON_CACHE_SIZE, lambda: len(self._fasjson_cache))
+        fasjson_workers = self.config.get("fasjson_workers", 8)
+        self._fasjson_pool = None
+        if fasjson_workers > 1:
+            self._fasjson_pool = ThreadPoolExecutor(
+                max_workers=fasjson_workers, thread_name_prefix="fasjson"
+            )
+        publisher_config = self.config.get("publisher", {})
+        self._publisher = None
+        if publisher_config.get("in_flight", 0) > 0:
+            self._publisher = Publisher(
+                self._publish,
+                in_flight=publisher_config["in_flight"],
+                queue_size=publisher_config.get("queue_size", 100),
+            )
+            self._publisher.start()
+        outbox_config = self.config.get("outbox", {})
+        self._outbox = None
+        self._outbox_drainer = None
+        if outbox_config.get("path"):
+            # Each relay process needs its own outbox
+            path = outbox_config["path"].format(process=process_slot())
+            self._outbox = Outbox(path, max_size=outbox_config.get("max_size", 100000))
+            metrics.set_function(metrics.OUTBOX_DEPTH, lambda: len(self._outbox))
+            self._outbox_drainer = OutboxDrainer(
+                self._outbox, self._republish, interval=outbox_config.get("retry_interval", 10)
+            )
+            self._outbox_drainer.start()
+        coalesce_config = self.config.get("coalesce", {})
+        self._merge_cc = coalesce_config.get("merge_cc", False)
+        self._coalescer = None
+        if coalesce_config.get("window"):
+            # The window is in milliseconds. The groups are converted and their users looked
+            # up by as many threads as there are STOMP workers, unless told otherwise.
+            self._coalescer = Coalescer(
+                self._relay_group,
+                coalesce_config["window"] / 1000,
+                workers=coalesce_config.get(
+                    "workers", self.config.get("stomp", {}).get("workers", 1)
+                ),
+            )
+            self._coalescer.start()
+
+    def close(self):
+        """Publish the messages that are still queued and stop the background threads."""
+        if self._coalescer is not None:
+            self._coalescer.stop()
+        if self._cache_refresher is not None:
+            self._cache_refresher.stop()
+        if self._publisher is not None:
+            self._publisher.stop()
+        if self._outbox_drainer is not None:
+            self._outbox_drainer.stop()
+            self._outbox.close()
+        if self._fasjson_pool is not None:
+            self._fasjson_pool.shutdown()
+        if self._fasjson_cache.store is not None:
+            self._fasjson_cache.store.close()
+
+    def on_stomp_message(self, body, headers, on_published=None):
+        """Relay a message received on STOMP to Fedora Messaging.
+
+        If given, ``on_published`` is called with ``None`` once the message has been published
+        (or dropped), or with the exception if publishing failed. When a publisher is
+        configured this happens in another thread, after this method has returned.
+
+        When coalescing is enabled, the messages given an ``on_published`` callback are held
+        for a short while, and relayed with the other messages about the same bug.
+        """
+        if self._coalescer is not None and on_published is not None:
+            try:
+                obj = self._check_scope(body, headers)
+            except DropMessage as e:
+                self._drop(e)
+                on_published(None)
+                return
+            bug = body[obj] if obj == "bug" else body[obj]["bug"]
+            self._coalescer.submit(bug["id"], (body, headers, on_published))
+            return
+
+        try:
+            message_body, degraded = self._get_message_body(body, headers)
+        except DropMessage as e:
+            self._drop(e)
+            if on_published is not None:
+                on_published(None)
+            return
+
+        message = self._make_message(message_body, headers, degraded)
+        if self._publisher is not None and on_published is not None:
+            self._publisher.submit(message, on_published, key=message_body["bug"]["id"])
+            return
+        self._publish(message)
+        if on_published is not None:
+            on_published(None)
+
+    async def on_stomp_message_async(self, body, headers):
+        """Relay a message received on STOMP to Fedora Messaging, from an asyncio event loop.
 
-    def on_stomp_message(self, body, headers):
+        Everything runs on the loop except the FASJSON queries for the email addresses that
+        are not in the cache, and the publication, which block and are sent to the loop's
+        default executor. This returns once the message has been published (or dropped).
+        """
         try:
-            message_body = self._get_message_body(body, headers)
+            bz_message = self._convert_body(body, headers)
         except DropMessage as e:
-            LOGGER.debug(f"DROP: {e}")
+            self._drop(e)
             return
+        with span("fasjson"):
+            fas_names, unresolved = await self._emails_to_fas_async(bz_message.all_emails)
+        message = self._make_message(bz_message.to_body(fas_names), headers, bool(unresolved))
+        await asyncio.to_thread(self._publish, message)
 
+    def prefilter(self, headers, data):
+        """Decide whether a message may be relayed from its headers and its raw body, before
+        decoding it. Returns False, and counts the message as dropped, if it must not be.
+
+        This only catches the messages that can be ruled out cheaply, the others are checked
+        again once decoded.
+        """
+        try:
+            obj = self._get_object_name(headers)
+            if not re.search(rf'"{re.escape(obj)}"\s*:'.encode(), data):
+                raise DropMessage("message has no object field. Non public.", reason="private")
+            if self._product_markers is not None and not any(
+                marker in data for marker in self._product_markers
+            ):
+                raise DropMessage(
+                    f"none of {self._allowed_products} in the message", reason="product"
+                )
+        except DropMessage as e:
+            self._drop(e)
+            return False
+        return True
+
+    def _relay_group(self, items):
+        """Relay the (body, headers, on_published) items of messages about the same bug, that
+        arrived within the coalescing window, looking up all their users at once.
+
+        Each callback is called, even if the group as a whole fails.
+        """
+        converted = []
+        # The callbacks to call once the group is converted, and with what
+        settled = []
+        try:
+            if self._merge_cc:
+                items = merge_cc_changes(items)
+            all_group_emails = set()
+            for body, headers, on_published in items:
+                try:
+                    bz_message = self._convert_body(body, headers)
+                except DropMessage as e:
+                    self._drop(e)
+                    settled.append((on_published, None))
+                    continue
+                except Exception as e:
+                    LOGGER.exception("Exception when relaying the message:")
+                    settled.append((on_published, e))
+                    continue
+                all_group_emails.update(bz_message.all_emails)
+                converted.append((bz_message, on_published))
+            with span("fasjson"):
+                fas_names, unresolved = self._emails_to_fas(all_group_emails)
+        except Exception as e:
+            LOGGER.exception("Could not relay a group of messages:")
+            for _body, _headers, on_published in items:
+                on_published(e)
+            return
+        for on_published, error in settled:
+            on_published(error)
+        for bz_message, on_published in converted:
+            try:
+                message = self._make_message(
+                    bz_message.to_body(fas_names),
+                    bz_message.headers,
+                    degraded=not unresolved.isdisjoint(bz_message.all_emails),
+                )
+                if self._publisher is not None:
+                    self._publisher.submit(message, on_published, key=bz_message.bug["id"])
+                    continue
+                self._publish(message)
+            except Exception as e:
+                on_published(e)
+            else:
+                on_published(None)
+
+    def _drop(self, error):
+        LOGGER.debug(f"DROP: {error}")
+        self.dropped[error.reason] += 1
+        metrics.MESSAGES_DROPPED.labels(reason=error.reason).inc()
+
+    def _make_message(self, message_body, headers, degraded=False):
         topic = "bug.update"
         if "bug.create" in headers["destination"]:
             topic = "bug.new"
@@ -73,19 +301,77 @@ class MessageRelay:
         messageclass = MessageV1
         if self._bz4_compat_mode:
             messageclass = MessageV1BZ4
+        message_headers = None
+        if degraded:
+            message_headers = {DEGRADED_HEADER: True}
+            metrics.MESSAGES_DEGRADED.inc()
+        return messageclass(
+            topic=f"bugzilla.{topic}",
+            body=message_body,
+            headers=message_headers,
+            severity=INFO,
+        )
+
+    def _publish(self, message):
+        if self._outbox is not None and len(self._outbox):
+            # The messages waiting in the outbox must be published first
+            self._defer(message)
+            return
         try:
-            message = messageclass(
-                topic=f"bugzilla.{topic}",
-                body=message_body,
-                severity=INFO,
-            )
-            publish(message)
+            self._send(message)
         except PublishReturned as e:
             LOGGER.warning(f"Fedora Messaging broker rejected message {message.id}: {e}")
+            metrics.MESSAGES_REJECTED.inc()
         except ConnectionException as e:
-            LOGGER.warning(f"Error sending message {message.id}: {e}")
+            if self._outbox is None:
+                LOGGER.warning(f"Error sending message {message.id}: {e}")
+                metrics.MESSAGES_FAILED.inc()
+                return
+            LOGGER.warning(f"Error sending message {message.id}, keeping it in the outbox: {e}")
+            self._defer(message)
+        except PublishTimeout as e:
+            # The broker is unreachable, publish() gave up waiting for the connection
+            if self._outbox is None:
+                raise
+            LOGGER.warning(f"Timeout sending message {message.id}, keeping it in the outbox: {e}")
+            self._defer(message)
+        else:
+            metrics.MESSAGES_PUBLISHED.inc()
 
-    def _get_message_body(self, body, headers):
+    def _republish(self, message):
+        """Publish a message from the outbox. Raises an exception if it must stay there."""
+        try:
+            self._send(message)
+        except PublishReturned as e:
+            LOGGER.warning(f"Fedora Messaging broker rejected message {message.id}: {e}")
+            metrics.MESSAGES_REJECTED.inc()
+        else:
+            metrics.MESSAGES_PUBLISHED.inc()
+
+    def _send(self, message):
+        with metrics.PUBLISH_TIME.time(), span("publish"):
+            if self._sink is None:
+                publish(message)
+            else:
+                self._sink(message)
+
+    def _defer(self, message):
+        """Add a message to the outbox. Raises OutboxFull if it can't be kept, so that the
+        STOMP message is not acked.
+        """
+        try:
+            self._outbox.append(message)
+        except OutboxFull:
+            LOGGER.error(f"Could not keep message {message.id}, the outbox is full")
+            metrics.MESSAGES_FAILED.inc()
+            raise
+        metrics.MESSAGES_OUTBOXED.inc()
+
+    def _check_scope(self, body, headers):
+        """Decide whether the message must be relayed, before doing any work on it.
+
+        Raises DropMessage if it must not, returns the name of the message's object otherwise.
+        """
         # in BZ 5.0+, public messages include a key for the 'object',
         # whatever the object is. So 'bug.*' messages have a 'bug'
         # dict...but 'comment.*' messages have a 'comment' dict,
@@ -93,77 +379,145 @@ class MessageRelay:
         # For all non-'bug' objects, this dict has the bug dict within
         # it. See:
         # https://bugzilla.redhat.com/docs/en/html/integrating/api/Bugzilla/Extension/Push.html
-        # destination looks something like
-        # "/topic/VirtualTopic.eng.bugzilla.bug.modify"
-        # this splits out the 'bug' part
-        obj = headers["destination"].split("bugzilla.")[1].split(".")[0]
+        obj = self._get_object_name(headers)
         if obj not in body:
-            raise DropMessage("message has no object field. Non public.")
-        objdict = {}
-        bug = None
-        if obj == "bug":
-            # just take the bug dict, converting datetimes
-            bug = convert_datetimes(body["bug"])
-        else:
-            # unpick the bug dict from the object dict
-            bug = convert_datetimes(body[obj].pop("bug"))
-            objdict[obj] = convert_datetimes(body[obj])
+            raise DropMessage("message has no object field. Non public.", reason="private")
+        bug = body[obj] if obj == "bug" else body[obj]["bug"]
 
         # As of https://bugzilla.redhat.com/show_bug.cgi?id=1248259, bugzilla
         # will send the product along with the initial message, so let's check
         # it.
         product_name = bug["product"]["name"]
         if product_name not in self._allowed_products:
-            raise DropMessage(f"{product_name!r} not in {self._allowed_products}")
+            raise DropMessage(f"{product_name!r} not in {self._allowed_products}", reason="product")
+        return obj
 
-        body["timestamp"] = datetime.datetime.fromtimestamp(
-            int(headers["timestamp"]) / 1000.0, pytz.UTC
-        )
-        event = body.get("event")
-        event = convert_datetimes(event)
+    def _get_object_name(self, headers):
+        # destination looks something like
+        # "/topic/VirtualTopic.eng.bugzilla.bug.modify"
+        # this splits out the 'bug' part
+        destination = headers.get("destination", "")
+        if "bugzilla." not in destination:
+            raise DropMessage(f"{destination!r} is not a Bugzilla topic", reason="destination")
+        return destination.split("bugzilla.")[1].split(".")[0]
 
-        if self._bz4_compat_mode:
-            _bz4_compat_transform(bug, event, objdict, obj)
+    def _get_message_body(self, body, headers):
+        """Build the body of the message to publish.
+
+        Returns the body, and whether some usernames could not be looked up in FASJSON.
+        """
+        bz_message = self._convert_body(body, headers)
+        # look them all up at once
+        with span("fasjson"):
+            fas_names, unresolved = self._emails_to_fas(bz_message.all_emails)
+        return bz_message.to_body(fas_names), bool(unresolved)
+
+    def _convert_body(self, body, headers):
+        """Decode the message received on STOMP and convert it in place, without looking up
+        the FAS usernames. Returns a BugzillaMessage.
+        """
+        obj = self._check_scope(body, headers)
+        message = BugzillaMessage.from_stomp(obj, body, headers)
+        with span("convert_datetimes"):
+            convert_datetimes(message.bug)
+            if message.payload is not None:
+                convert_datetimes(message.payload)
+            convert_datetimes(message.event)
 
-        # construct message dict, add the object dict we got earlier
-        # (for non-'bug' object messages)
-        body = dict(bug=bug, event=event, headers=headers)
-        body.update(objdict)
+        if self._bz4_compat_mode:
+            with span("bz4_compat_transform"):
+                self._bz4_compat_transform(message.bug, message.event, message.payload, obj)
 
         # user from the event dict: person who triggered the event
-        agent_name = email_to_fas(event["user"]["login"], self._fasjson)
-        body["agent_name"] = agent_name
-
-        # usernames: all FAS usernames affected by the action
-        all_emails = self._get_all_emails(body)
-        usernames = set()
-        for email in all_emails:
-            username = email_to_fas(email, self._fasjson)
-            if username is None:
-                continue
-            usernames.add(username)
-        if agent_name is not None:
-            usernames.add(agent_name)
-        usernames = list(usernames)
-        usernames.sort()
-        body["usernames"] = usernames
-
-        return body
-
-    def _get_all_emails(self, body):
+        message.agent_email = message.event["user"]["login"]
+        # all users affected by the action
+        message.emails = self._get_all_emails(message.bug, message.event)
+        return message
+
+    def _emails_to_fas(self, emails):
+        """Map each email address to its FAS username (or None), querying FASJSON for
+        the unknown addresses concurrently.
+
+        Returns the mapping, and the set of addresses that could not be looked up.
+        """
+        emails = list(emails)
+        if self._fasjson_pool is None or len(emails) < 2:
+            results = [self._email_to_fas(email) for email in emails]
+        else:
+            results = self._fasjson_pool.map(self._email_to_fas, emails)
+        fas_names = {}
+        unresolved = set()
+        for email, (username, failed) in zip(emails, results):
+            fas_names[email] = username
+            if failed:
+                unresolved.add(email)
+        return fas_names, unresolved
+
+    async def _emails_to_fas_async(self, emails):
+        """Map each email address to its FAS username (or None). The addresses that are not
+        in the cache are looked up in FASJSON concurrently, in the loop's default executor.
+
+        Returns the mapping, and the set of addresses that could not be looked up.
+        """
+        fas_names = {}
+        unknown = []
+        for email in emails:
+            try:
+                fas_names[email] = cached_email_to_fas(email, self._fasjson_cache)
+            except KeyError:
+                unknown.append(email)
+        unresolved = set()
+        if unknown:
+            results = await asyncio.gather(
+                *(asyncio.to_thread(self._query_fasjson, email) for email in unknown)
+            )
+            for email, (username, failed) in zip(unknown, results):
+                fas_names[email] = username
+                if failed:
+                    unresolved.add(email)
+        return fas_names, unresolved
+
+    def _email_to_fas(self, email):
+        try:
+            return cached_email_to_fas(email, self._fasjson_cache), False
+        except KeyError:
+            return self._query_fasjson(email)
+
+    def _query_fasjson(self, email):
+        """Look up an email address in FASJSON, through the circuit breaker.
+
+        If FASJSON can't be queried, fall back to the last known username of the address (or
+        None). Returns the username, and whether the fallback was used.
+        """
+        try:
+            # Only FASJSON's failures count, not the cache's
+            username = self._fasjson_breaker.call(query_email_to_fas, email, self._fasjson)
+        except CircuitOpen:
+            pass
+        except Exception as e:
+            LOGGER.warning(f"Could not look up {email} in FASJSON: {e}")
+        else:
+            try:
+                self._fasjson_cache[email] = username
+            except sqlite3.Error as e:
+                LOGGER.warning(f"Could not store the FAS username of {email}: {e}")
+            return username, False
+        return self._fasjson_cache.last_known(email), True
+
+    def _get_all_emails(self, bug, event):
         """List of email addresses of all users relevant to the action
         that generated this message.
         """
         emails = set()
 
         # bug reporter and assignee
-        emails.add(body["bug"]["reporter"]["login"])
+        emails.add(bug["reporter"]["login"])
         if self._bz4_compat_mode:
-            emails.add(body["bug"]["assigned_to"])
+            emails.add(bug["assigned_to"])
         else:
-            emails.add(body["bug"]["assigned_to"]["login"])
+            emails.add(bug["assigned_to"]["login"])
 
-        for change in body["event"].get("changes", []):
+        for change in event.get("changes", []):
             if change["field"] == "cc":
                 # anyone added to CC list
                 for email in change["added"].split(","):
@@ -0,0 +1,67 @@
+""" Replay of STOMP messages saved as JSON lines.
+
+Each line is a JSON object with the ``headers`` and ``body`` of a message
+received from Bugzilla, like the messages archived by datanommer. They are
+pushed through the relay one at a time, so the input can be of any size.
+"""
+
+import json
+import logging
+import time
+
+from fedora_messaging.message import dumps
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FileSink:
+    """Write the messages to a file, in the format of the ``fedora-messaging publish``
+    command, instead of publishing them.
+    """
+
+    def __init__(self, output):
+        self._output = output
+
+    def __call__(self, message):
+        self._output.write(dumps(message))
+
+
+class ReplayStats:
+    def __init__(self):
+        self.read = 0
+        self.dropped = 0
+        self.errors = 0
+        self.duration = 0
+
+    @property
+    def rate(self):
+        if not self.duration:
+            return 0
+        return self.read / self.duration
+
+    def __str__(self):
+        return (
+            f"Replayed {self.read} messages in {self.duration:.1f}s "
+            f"({self.rate:.0f} messages/sec), {self.dropped} dropped, {self.errors} errors"
+        )
+
+
+def replay(relay, lines):
+    """Relay the messages read from lines, an iterable of JSON strings."""
+    stats = ReplayStats()
+    dropped = sum(relay.dropped.values())
+    start = time.perf_counter()
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        stats.read += 1
+        try:
+            record = json.loads(line)
+            relay.on_stomp_message(record["body"], record["headers"])
+        except Exception:
+            LOGGER.exception(f"Could not replay the message on line {line_number}:")
+            stats.errors += 1
+    stats.duration = time.perf_counter() - start
+    stats.dropped = sum(relay.dropped.values()) - dropped
+    return stats
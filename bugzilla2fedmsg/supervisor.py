@@ -0,0 +1,138 @@
+""" Running the relay in several processes.
+
+The CPU work of the relay (decoding the messages, converting them, building
+the Fedora Messaging messages) is bound by the GIL. The supervisor forks
+several relay processes, each with its own STOMP subscription and its own
+connection to the Fedora Messaging broker, restarts the ones that exit, and
+stops them all when it receives SIGTERM or SIGINT.
+"""
+
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+
+# The number of the slot a relay process runs in
+PROCESS_ENV = "BUGZILLA2FEDMSG_PROCESS"
+
+
+def process_slot():
+    """The number of the slot this relay process runs in, 0 without --processes."""
+    return int(os.environ.get(PROCESS_ENV) or 0)
+
+
+def _run_child(target, slot):
+    # A process restarted in the same slot gets the same number, and uses the same files
+    os.environ[PROCESS_ENV] = str(slot)
+    # Stop like the single process relay does on Ctrl-C, and not like the supervisor, until
+    # the relay installs its own handlers to stop gracefully
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    try:
+        target()
+    except KeyboardInterrupt:
+        pass
+
+
+class Supervisor:
+    """Run ``target`` in ``processes`` forked processes until stopped.
+
+    A process that exits is started again after ``restart_delay`` seconds. When stopping,
+    the processes are sent SIGTERM, and killed if they are still running after
+    ``stop_timeout`` seconds. ``on_exit`` is called with the pid of each process that
+    exited.
+    """
+
+    def __init__(self, target, processes, restart_delay=3, stop_timeout=30, on_exit=None):
+        self.target = target
+        self.processes = processes
+        self.restart_delay = restart_delay
+        self.stop_timeout = stop_timeout
+        self.on_exit = on_exit
+        self._context = multiprocessing.get_context("fork")
+        # The process running in each slot, or the time at which to start it again
+        self._children = {}
+        self._restarts = {}
+        self._stopping = False
+
+    def run(self):
+        previous_handlers = {
+            signum: signal.signal(signum, self._on_signal)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            for slot in range(self.processes):
+                self._start(slot)
+            while not self._stopping:
+                self._watch()
+        finally:
+            self._stop_children()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+    def stop(self):
+        self._stopping = True
+
+    def _on_signal(self, signum, frame):
+        LOGGER.info(f"Received {signal.Signals(signum).name}, stopping the relay processes")
+        self.stop()
+
+    def _start(self, slot):
+        process = self._context.Process(
+            target=_run_child, args=(self.target, slot), name=f"bz2fm-relay-{slot}", daemon=False
+        )
+        process.start()
+        LOGGER.info(f"Started relay process {slot} (pid {process.pid})")
+        self._children[slot] = process
+
+    def _watch(self):
+        """Wait for a process to exit for at most a second, and restart the ones that are due."""
+        sentinels = [process.sentinel for process in self._children.values()]
+        timeout = 1
+        if self._restarts:
+            timeout = max(0, min(min(self._restarts.values()) - time.monotonic(), timeout))
+        if sentinels:
+            multiprocessing.connection.wait(sentinels, timeout)
+        else:
+            time.sleep(timeout)
+        for slot, process in list(self._children.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del self._children[slot]
+            self._on_exit(process)
+            if not self._stopping:
+                LOGGER.warning(
+                    f"Relay process {slot} (pid {process.pid}) exited with code "
+                    f"{process.exitcode}, restarting it in {self.restart_delay}s"
+                )
+                self._restarts[slot] = time.monotonic() + self.restart_delay
+        now = time.monotonic()
+        for slot, restart_at in list(self._restarts.items()):
+            if restart_at <= now and not self._stopping:
+                del self._restarts[slot]
+                self._start(slot)
+
+    def _stop_children(self):
+        for process in self._children.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.stop_timeout
+        for slot, process in self._children.items():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                LOGGER.warning(f"Relay process {slot} (pid {process.pid}) did not stop, killing it")
+                process.kill()
+                process.join()
+            self._on_exit(process)
+        self._children = {}
+        self._restarts = {}
+
+    def _on_exit(self, process):
+        if self.on_exit is not None:
+            self.on_exit(process.pid)
@@ -0,0 +1,156 @@
+""" Per-message timing of the relay stages, and sampled profiling.
+
+When tracing is enabled, each message received on STOMP gets a trace, and
+the stages it goes through (JSON decoding, datetime conversion, FASJSON
+lookups, publishing...) are timed with :func:`span`. The timings are logged
+once the message is acked. Some messages can also be run under cProfile,
+their statistics are accumulated and dumped to a pstats file.
+
+Tracing can be switched on and off at runtime with :meth:`Tracer.toggle`,
+which the cli connects to the SIGUSR1 signal. The consumers then dump the
+profile with :meth:`Tracer.dump_if_requested`. When it is off, :func:`span`
+costs a context variable lookup.
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+
+CURRENT_TRACE = contextvars.ContextVar("bugzilla2fedmsg_trace", default=None)
+_NO_SPAN = contextlib.nullcontext()
+
+
+def span(name):
+    """Time a stage of the current message, if it is being traced."""
+    trace = CURRENT_TRACE.get()
+    if trace is None:
+        return _NO_SPAN
+    return trace.span(name)
+
+
+class Trace:
+    """The timings of the stages of a message."""
+
+    def __init__(self, tracer, msg_id):
+        self.msg_id = msg_id
+        self.spans = []
+        self.profiler = None
+        self._tracer = tracer
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((name, time.perf_counter() - start))
+
+    def finish(self):
+        self._tracer.report(self, time.perf_counter() - self._start)
+
+
+class Tracer:
+    def __init__(self, config):
+        self.enabled = config.get("enabled", False)
+        # In milliseconds
+        self._slow_threshold = config.get("slow_threshold", 0)
+        self._profile_every = config.get("profile_every", 0)
+        self._profile_dir = config.get("profile_dir", ".")
+        self._profile_dump_every = config.get("profile_dump_every", 100)
+        self._lock = threading.Lock()
+        self._profiling = threading.Lock()
+        self._seen = 0
+        self._stats = None
+        self._profiled = 0
+        self._dump_requested = False
+
+    def toggle(self):
+        """Switch tracing on or off.
+
+        This is called from a signal handler, maybe while the lock is held in the same
+        thread, so the profile is only dumped at the next :meth:`dump_if_requested`.
+        """
+        self.enabled = not self.enabled
+        LOGGER.info(f"Tracing is now {'enabled' if self.enabled else 'disabled'}")
+        if not self.enabled:
+            self._dump_requested = True
+
+    def dump_if_requested(self):
+        """Dump the profile if tracing was switched off since the last call."""
+        if not self._dump_requested:
+            return None
+        self._dump_requested = False
+        return self.dump_profile()
+
+    def begin(self, msg_id):
+        """Start tracing a message, return its trace or None if tracing is disabled."""
+        if not self.enabled:
+            return None
+        trace = Trace(self, msg_id)
+        with self._lock:
+            self._seen += 1
+            if self._profile_every and self._seen % self._profile_every == 0:
+                trace.profiler = cProfile.Profile()
+        return trace
+
+    @contextlib.contextmanager
+    def activate(self, trace):
+        """Make the trace the current one, and profile the code run meanwhile if the
+        message was sampled for profiling.
+        """
+        token = CURRENT_TRACE.set(trace)
+        profiler = trace.profiler if trace is not None else None
+        # Only one profiler can be active at a time
+        if profiler is not None and not self._profiling.acquire(blocking=False):
+            profiler = None
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._profiling.release()
+                self._add_profile(profiler)
+            CURRENT_TRACE.reset(token)
+
+    def report(self, trace, duration):
+        duration_ms = duration * 1000
+        if duration_ms < self._slow_threshold:
+            return
+        timings = " ".join(f"{name}={seconds * 1000:.2f}ms" for name, seconds in trace.spans)
+        LOGGER.info(f"Message {trace.msg_id} took {duration_ms:.2f}ms: {timings}")
+
+    def _add_profile(self, profiler):
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profiler)
+            else:
+                self._stats.add(profiler)
+            self._profiled += 1
+            must_dump = self._profiled >= self._profile_dump_every
+        if must_dump:
+            self.dump_profile()
+
+    def dump_profile(self):
+        """Write the profiling statistics accumulated so far to a pstats file."""
+        with self._lock:
+            stats, self._stats = self._stats, None
+            profiled, self._profiled = self._profiled, 0
+        if stats is None:
+            return None
+        path = os.path.join(
+            self._profile_dir, f"bugzilla2fedmsg-{os.getpid()}-{time.time_ns()}.pstats"
+        )
+        stats.dump_stats(path)
+        LOGGER.info(f"Wrote the profile of {profiled} messages to {path}")
+        return path
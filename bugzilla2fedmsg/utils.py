@@ -6,35 +6,71 @@ Authors:    Ralph Bean <rbean@redhat.com>
 
 import datetime
 import logging
+import re
+import sqlite3
 
 import pytz
 
+from . import metrics
+
 
 LOGGER = logging.getLogger(__name__)
 
 
+# the string we get is YYYY-MM-DDTHH:MM:SS, no timezone, no
+# microseconds.
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+DATETIME_RE = re.compile(r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)", re.ASCII)
+
+
+def convert_datetime(value):
+    """Convert an ISO-8601ish date/time string to an epoch timestamp, return
+    any other string unchanged.
+    """
+    # Strings that strptime could parse with DATETIME_FORMAT are 14 to 19
+    # characters long and have a dash after the year: this cheaply rules out
+    # almost everything that is not a date, without raising and catching an
+    # exception.
+    if not 14 <= len(value) <= 19 or value[4] != "-":
+        return value
+    try:
+        match = DATETIME_RE.fullmatch(value)
+        if match is not None:
+            ourdate = datetime.datetime(*[int(part) for part in match.groups()])
+        else:
+            # Not the usual zero-padded form, let strptime decide.
+            ourdate = datetime.datetime.strptime(value, DATETIME_FORMAT)
+    except ValueError:
+        return value
+    # The previous code (for handling results from querying Bugzilla
+    # directly) assumed this was a UTC date, and from comparing some test
+    # messages to the web UI it does indeed seem to be.
+    ourdate = ourdate.replace(tzinfo=pytz.UTC)
+    return ourdate.timestamp()
+
+
 def convert_datetimes(obj):
     """Recursively convert the ISO-8601ish date/time strings we get
     from stomp to epoch integers (because this is what fedmsg used to
     emit when we sent it datetime instances).
-    """
 
-    if isinstance(obj, list):
-        return [convert_datetimes(item) for item in obj]
-    elif isinstance(obj, dict):
-        return dict([(k, convert_datetimes(v)) for k, v in obj.items()])
-    else:
-        try:
-            # the string we get is YYYY-MM-DDTHH:MM:SS, no timezone,
-            # no microseconds. The previous code (for handling results
-            # from querying Bugzilla directly) assumed this was a UTC
-            # date, and from comparing some test messages to the web
-            # UI it does indeed seem to be.
-            ourdate = datetime.datetime.strptime(obj, "%Y-%m-%dT%H:%M:%S")
-            ourdate = ourdate.replace(tzinfo=pytz.UTC)
-            return ourdate.timestamp()
-        except (ValueError, TypeError):
-            return obj
+    Lists and dicts are converted in place and returned.
+    """
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if isinstance(value, str):
+                obj[key] = convert_datetime(value)
+            elif isinstance(value, (dict, list)):
+                convert_datetimes(value)
+    elif isinstance(obj, list):
+        for index, value in enumerate(obj):
+            if isinstance(value, str):
+                obj[index] = convert_datetime(value)
+            elif isinstance(value, (dict, list)):
+                convert_datetimes(value)
+    elif isinstance(obj, str):
+        return convert_datetime(obj)
+    return obj
 
 
 def needinfo_email(flag_content):
@@ -47,14 +83,56 @@ def needinfo_email(flag_content):
         return None
 
 
-def email_to_fas(email, fasjson):
-    """Try to get a FAS username from an email address, return None if no FAS username is found"""
+def cached_email_to_fas(email, cache=None):
+    """Get a FAS username from an email address without querying FASJSON.
+
+    Raises KeyError if the email address is not in the cache.
+    """
     if email.endswith("@fedoraproject.org"):
         return email.rsplit("@", 1)[0]
+    if cache is None:
+        raise KeyError(email)
+    return cache[email]
+
+
+def query_email_to_fas(email, fasjson, cache=None):
+    """Query FASJSON for the FAS username of an email address, return None if there is none.
+
+    If a cache is given, it is updated with the result.
+    """
     LOGGER.debug("Looking for a FAS user with rhbzemail = %s", email)
-    results = fasjson.search(rhbzemail=email).result
+    with metrics.FASJSON_LOOKUP_TIME.time():
+        results = fasjson.search(rhbzemail=email).result
     if len(results) == 1:
         LOGGER.debug("Found %s", results[0]["username"])
-        return results[0]["username"]
-    LOGGER.debug("No match")
-    return None
+        username = results[0]["username"]
+    else:
+        LOGGER.debug("No match")
+        username = None
+    if cache is not None:
+        cache[email] = username
+    return username
+
+
+def email_to_fas(email, fasjson, cache=None):
+    """Try to get a FAS username from an email address, return None if no FAS username is found
+
+    If a cache is given, it is checked before querying FASJSON and it is updated with the result.
+    """
+    try:
+        return cached_email_to_fas(email, cache)
+    except KeyError:
+        return query_email_to_fas(email, fasjson, cache)
+
+
+def open_database(path, schema):
+    """Open the SQLite database at path, and create its table with the schema statement.
+
+    The connection can be shared by several threads, provided they hold a lock.
+    """
+    # Autocommit, the rows are written one at a time
+    db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(schema)
+    return db
@@ -0,0 +1,290 @@
+""" Benchmark of the relay hot path.
+
+Replay the sample messages through MessageRelay with a stubbed FASJSON
+client and a stubbed publisher, and report the throughput, the latency of
+each stage and the memory allocated per message. Run it from the root of
+the repository with::
+
+    python -m tests.benchmark --messages 10000
+
+Results can be saved with ``--save-baseline`` and later compared with
+``--baseline``: the command exits with an error if the throughput dropped or
+a stage got slower by more than the tolerance.
+"""
+
+import argparse
+import copy
+import gc
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+from unittest import mock
+
+from bugzilla2fedmsg import relay as relay_module
+from bugzilla2fedmsg.bz4compat import compile_transform
+from bugzilla2fedmsg.utils import convert_datetimes
+
+from .conftest import FASJSON_USER_MAP, load_message
+from .test_bz4compat import reference_transform
+
+
+SAMPLE_MESSAGES = [
+    "bug_create",
+    "bug_modify",
+    "bug_modify_four_changes",
+    "comment_create",
+    "attachment_create",
+    "attachment_modify",
+    "private",
+    "other_product",
+]
+PERCENTILES = (50, 90, 99)
+
+
+class StubFasjson:
+    """A FASJSON client that answers from FASJSON_USER_MAP."""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = 0
+
+    def search(self, rhbzemail):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            return SimpleNamespace(result=[{"username": FASJSON_USER_MAP[rhbzemail]}])
+        except KeyError:
+            return SimpleNamespace(result=[])
+
+
+class StubPublisher:
+    """A publish() function that only counts messages."""
+
+    def __init__(self):
+        self.published = 0
+
+    def __call__(self, message):
+        self.published += 1
+
+
+def _percentiles(timings):
+    if len(timings) < 2:
+        return {f"p{p}": timings[0] if timings else 0 for p in PERCENTILES}
+    quantiles = statistics.quantiles(timings, n=100, method="inclusive")
+    return {f"p{p}": quantiles[p - 1] for p in PERCENTILES}
+
+
+def _time_stage(function, inputs):
+    """Run function on each of the inputs, return the latencies in microseconds."""
+    timings = []
+    for args in inputs:
+        start = time.perf_counter_ns()
+        function(*args)
+        timings.append((time.perf_counter_ns() - start) / 1000)
+    return timings
+
+
+def _stage_inputs(relay, samples, count):
+    """Prepare the arguments of each stage for count messages, outside of the timings."""
+    inputs = {
+        "json_decode": [],
+        "convert_datetimes": [],
+        "bz4_compat_transform": [],
+        "bz4_compat_reference": [],
+        "get_all_emails": [],
+        "get_message_body": [],
+    }
+    relayed = [s for s in samples if _is_relayed(relay, s)]
+    for index in range(count):
+        sample = samples[index % len(samples)]
+        inputs["json_decode"].append((json.dumps(sample["body"]).encode(),))
+        inputs["get_message_body"].append(
+            (copy.deepcopy(sample["body"]), copy.deepcopy(sample["headers"]))
+        )
+        sample = relayed[index % len(relayed)]
+        obj = sample["headers"]["destination"].split("bugzilla.")[1].split(".")[0]
+        bug = sample["body"]["bug"] if obj == "bug" else sample["body"][obj]["bug"]
+        inputs["convert_datetimes"].append((copy.deepcopy(bug),))
+        message_body, _degraded = relay._get_message_body(
+            copy.deepcopy(sample["body"]), copy.deepcopy(sample["headers"])
+        )
+        inputs["get_all_emails"].append((message_body["bug"], message_body["event"]))
+        body = copy.deepcopy(sample["body"])
+        payload = None
+        if obj != "bug":
+            bug = body[obj].pop("bug")
+            payload = body[obj]
+        else:
+            bug = body["bug"]
+        inputs["bz4_compat_transform"].append((bug, body["event"], payload, obj))
+        inputs["bz4_compat_reference"].append(copy.deepcopy((bug, body["event"], payload, obj)))
+    return inputs
+
+
+def _is_relayed(relay, sample):
+    try:
+        relay._check_scope(sample["body"], sample["headers"])
+    except relay_module.DropMessage:
+        return False
+    return True
+
+
+def _measure_allocations(relay, samples, count):
+    """Average peak of memory allocated by on_stomp_message for a message, in KiB."""
+    count = min(count, 1000)
+    messages = [copy.deepcopy(samples[i % len(samples)]) for i in range(count)]
+    peaks = []
+    tracemalloc.start()
+    for message in messages:
+        tracemalloc.reset_peak()
+        start, _peak = tracemalloc.get_traced_memory()
+        relay.on_stomp_message(message["body"], message["headers"])
+        _current, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - start)
+    tracemalloc.stop()
+    return statistics.mean(peaks) / 1024
+
+
+def run(count, fasjson_latency=0, bz4compat=True):
+    """Run the benchmark over count messages and return the results as a dict."""
+    samples = [load_message(name) for name in SAMPLE_MESSAGES]
+    fasjson = StubFasjson(latency=fasjson_latency)
+    publisher = StubPublisher()
+    config = {
+        "fasjson_url": "https://fasjson.example.com",
+        "bugzilla": {"products": ["Fedora", "Fedora EPEL"], "bz4compat": bz4compat},
+    }
+    patch_fasjson = mock.patch.object(relay_module, "FasjsonClient", return_value=fasjson)
+    patch_publish = mock.patch.object(relay_module, "publish", publisher)
+    with patch_fasjson, patch_publish:
+        relay = relay_module.MessageRelay(config)
+        try:
+            inputs = _stage_inputs(relay, samples, count)
+            messages = [copy.deepcopy(samples[i % len(samples)]) for i in range(count)]
+            # Warm up the caches
+            for sample in samples:
+                message = copy.deepcopy(sample)
+                relay.on_stomp_message(message["body"], message["headers"])
+
+            gc.collect()
+            stages = {
+                "json_decode": _time_stage(json.loads, inputs["json_decode"]),
+                "convert_datetimes": _time_stage(convert_datetimes, inputs["convert_datetimes"]),
+                "bz4_compat_transform": _time_stage(
+                    compile_transform(), inputs["bz4_compat_transform"]
+                ),
+                "bz4_compat_reference": _time_stage(
+                    reference_transform, inputs["bz4_compat_reference"]
+                ),
+                "get_all_emails": _time_stage(relay._get_all_emails, inputs["get_all_emails"]),
+                "get_message_body": _time_stage(
+                    lambda body, headers: _ignore_drops(relay._get_message_body, body, headers),
+                    inputs["get_message_body"],
+                ),
+            }
+            published_before = publisher.published
+            start = time.perf_counter()
+            stages["on_stomp_message"] = _time_stage(
+                relay.on_stomp_message, [(m["body"], m["headers"]) for m in messages]
+            )
+            elapsed = time.perf_counter() - start
+            published = publisher.published - published_before
+            peak_kib = _measure_allocations(relay, samples, count)
+        finally:
+            relay.close()
+
+    return {
+        "messages": count,
+        "published": published,
+        "messages_per_second": count / elapsed,
+        "fasjson_calls": fasjson.calls,
+        "stages": {name: _percentiles(timings) for name, timings in stages.items()},
+        "peak_kib_per_message": peak_kib,
+    }
+
+
+def _ignore_drops(function, *args):
+    try:
+        function(*args)
+    except relay_module.DropMessage:
+        pass
+
+
+def compare(results, baseline, tolerance):
+    """Return the list of regressions of results compared to the baseline."""
+    regressions = []
+    minimum = baseline["messages_per_second"] * (1 - tolerance)
+    if results["messages_per_second"] < minimum:
+        regressions.append(
+            f"throughput: {results['messages_per_second']:.0f} msg/s, "
+            f"baseline {baseline['messages_per_second']:.0f} msg/s"
+        )
+    for stage, baseline_timings in baseline["stages"].items():
+        if stage not in results["stages"]:
+            continue
+        current = results["stages"][stage]["p50"]
+        maximum = baseline_timings["p50"] * (1 + tolerance)
+        if current > maximum:
+            regressions.append(
+                f"{stage}: p50 {current:.1f}us, baseline {baseline_timings['p50']:.1f}us"
+            )
+    return regressions
+
+
+def format_results(results):
+    lines = [
+        f"{results['messages']} messages, {results['published']} published, "
+        f"{results['fasjson_calls']} FASJSON calls",
+        f"Throughput: {results['messages_per_second']:.0f} messages/sec",
+        "",
+        f"{'stage':<24}" + "".join(f"{f'p{p} (us)':>12}" for p in PERCENTILES),
+    ]
+    for stage, timings in results["stages"].items():
+        lines.append(f"{stage:<24}" + "".join(f"{timings[f'p{p}']:>12.1f}" for p in PERCENTILES))
+    lines.extend(["", f"Allocations: {results['peak_kib_per_message']:.1f} KiB peak per message"])
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--messages", type=int, default=10000)
+    parser.add_argument(
+        "--fasjson-latency", type=float, default=0, help="Delay of each FASJSON call in seconds"
+    )
+    parser.add_argument("--no-bz4compat", action="store_true")
+    parser.add_argument("--save-baseline", metavar="FILE", help="Save the results to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare the results with FILE")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.3,
+        help="Allowed slowdown compared to the baseline (default: 0.3, meaning 30%%)",
+    )
+    args = parser.parse_args(argv)
+
+    results = run(
+        args.messages, fasjson_latency=args.fasjson_latency, bz4compat=not args.no_bz4compat
+    )
+    print(format_results(results))
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions compared to the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("\nNo regression compared to the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
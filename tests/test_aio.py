@@ -0,0 +1,500 @@
+import asyncio
+import copy
+import json
+import logging
+import socket
+import struct
+from unittest import mock
+
+import pytest
+from prometheus_client import REGISTRY
+from stompest.error import StompConnectionError, StompProtocolError
+from stompest.protocol import StompParser, StompSession, StompSpec
+from stompest.protocol.frame import StompFrame
+
+import bugzilla2fedmsg.relay
+from bugzilla2fedmsg.aio import AsyncBugzillaConsumer
+from bugzilla2fedmsg.dedup import CLAIMED
+
+
+# Resets the connection when given in the frames to send after the messages
+RESET = object()
+
+
+class FakeBroker:
+    """A STOMP broker that sends some messages and records what the client sends back."""
+
+    def __init__(
+        self, messages, heartbeat="0,0", beat_interval=None, after_messages=(), connected=True
+    ):
+        self.messages = messages
+        self.heartbeat = heartbeat
+        self.beat_interval = beat_interval
+        # The frames to send after the messages, None closes the connection and RESET
+        # resets it
+        self.after_messages = after_messages
+        # Whether to accept the connection
+        self.connected = connected
+        self.frames = []
+        self.on_settled = None
+        self.server = None
+
+    @property
+    def settled(self):
+        return [frame for frame in self.frames if frame.command in ("ACK", "NACK")]
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _beat(self, writer):
+        while not writer.is_closing():
+            writer.write(StompSpec.LINE_DELIMITER.encode())
+            await asyncio.sleep(self.beat_interval)
+
+    async def _handle(self, reader, writer):
+        parser = StompParser(StompSpec.VERSION_1_2)
+        beats = None
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            parser.add(data)
+            while parser.canRead():
+                frame = parser.get()
+                if not frame:
+                    continue
+                self.frames.append(frame)
+                if frame.command == StompSpec.CONNECT and not self.connected:
+                    writer.write(bytes(StompFrame(StompSpec.ERROR, {"message": "Bad login"})))
+                elif frame.command == StompSpec.CONNECT:
+                    connected = StompFrame(
+                        StompSpec.CONNECTED,
+                        {"version": "1.2", "server": "testing", "heart-beat": self.heartbeat},
+                    )
+                    writer.write(bytes(connected))
+                    if self.beat_interval:
+                        beats = asyncio.ensure_future(self._beat(writer))
+                elif frame.command == StompSpec.SUBSCRIBE:
+                    for index, message in enumerate(self.messages):
+                        headers = dict(message["headers"])
+                        headers.pop(StompSpec.CONTENT_LENGTH_HEADER, None)
+                        headers.update(
+                            {
+                                StompSpec.MESSAGE_ID_HEADER: f"msg-{index}",
+                                "subscription": frame.headers["id"],
+                                "ack": f"ack-{index}",
+                            }
+                        )
+                        body = message["body"]
+                        if not isinstance(body, bytes):
+                            body = json.dumps(body).encode()
+                        writer.write(
+                            bytes(
+                                StompFrame(
+                                    StompSpec.MESSAGE, headers, body, version=StompSpec.VERSION_1_2
+                                )
+                            )
+                        )
+                    for extra in self.after_messages:
+                        if extra is None:
+                            writer.close()
+                            return
+                        if extra is RESET:
+                            # Send a TCP RST instead of closing cleanly
+                            sock = writer.get_extra_info("socket")
+                            sock.setsockopt(
+                                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+                            )
+                            writer.transport.abort()
+                            return
+                        writer.write(bytes(extra))
+                elif frame.command in ("ACK", "NACK"):
+                    if len(self.settled) == len(self.messages) and self.on_settled:
+                        self.on_settled()
+        if beats is not None:
+            beats.cancel()
+        writer.close()
+
+    def stop(self):
+        self.server.close()
+
+
+@pytest.fixture
+def consumer_config():
+    return {
+        "fasjson_url": "https://fasjson.example.com",
+        "stomp": {
+            "engine": "asyncio",
+            "uri": "tcp://127.0.0.1:61613",
+            "user": "username",
+            "pass": "password",
+            "queue": "/queue/testing",
+            "prefetch_size": 100,
+            "concurrency": 4,
+        },
+        "bugzilla": {
+            "products": ["Fedora", "Fedora EPEL"],
+            "bz4compat": True,
+        },
+    }
+
+
+def run_consumer(consumer, broker, uri="tcp://127.0.0.1:{port}"):
+    async def _main():
+        port = await broker.start()
+        consumer._uri = uri.format(port=port)
+        broker.on_settled = consumer.stop
+        try:
+            await asyncio.wait_for(consumer.consume_async(), 10)
+        finally:
+            broker.stop()
+
+    asyncio.run(_main())
+
+
+def test_consume(consumer_config, fakefasjson, fakepublish, bug_create_message, private_message):
+    """Check that the messages are relayed and acked."""
+    relay = bugzilla2fedmsg.relay.MessageRelay(consumer_config)
+    consumer = AsyncBugzillaConsumer(consumer_config, relay)
+    broker = FakeBroker([bug_create_message, private_message])
+    run_consumer(consumer, broker)
+
+    assert fakepublish.call_count == 1
+    message = fakepublish.call_args[0][0]
+    assert message.topic == "bugzilla.bug.new"
+    assert message.body["usernames"] == ["dgunchev", "lv"]
+    assert [frame.command for frame in broker.settled] == ["ACK", "ACK"]
+    assert sorted(frame.headers["id"] for frame in broker.settled) == ["ack-0", "ack-1"]
+    assert relay.dropped["private"] == 1
+    commands = [frame.command for frame in broker.frames]
+    assert commands[:2] == ["CONNECT", "SUBSCRIBE"]
+    assert commands[-1] == "DISCONNECT"
+    subscribe = broker.frames[1]
+    assert subscribe.headers["destination"] == "/queue/testing"
+    assert subscribe.headers["ack"] == "client-individual"
+    assert subscribe.headers["activemq.prefetchSize"] == "100"
+
+
+def test_consume_error(consumer_config, bug_create_message, caplog):
+    """Check that the message is nacked when relaying fails."""
+    caplog.set_level(logging.INFO)
+    consumer_config["tracing"] = {"enabled": True}
+    relay = mock.Mock(name="relay")
+    relay.on_stomp_message_async = mock.AsyncMock(side_effect=ValueError("dummy error"))
+    consumer = AsyncBugzillaConsumer(consumer_config, relay)
+    broker = FakeBroker([bug_create_message])
+    run_consumer(consumer, broker)
+
+    assert [frame.command for frame in broker.settled] == ["NACK"]
+    assert "Exception when relaying the message:" in caplog.messages
+    # The message was traced
+    assert "Message msg-0 took " in caplog.text
+
+
+def test_consume_concurrency(consumer_config, bug_create_message):
+    """Check that messages about different bugs are relayed at the same time, up to the
+    configured concurrency."""
+    active = 0
+    max_active = 0
+
+    async def _relay(body, headers):
+        nonlocal active, max_active
+        active += 1
+        max_active = max(max_active, active)
+        await asyncio.sleep(0.05)
+        active -= 1
+
+    relay = mock.Mock(name="relay")
+    relay.on_stomp_message_async.side_effect = _relay
+    consumer_config["stomp"]["concurrency"] = 2
+    consumer = AsyncBugzillaConsumer(consumer_config, relay)
+    messages = []
+    for index in range(5):
+        message = copy.deepcopy(bug_create_message)
+        message["body"]["event"]["bug_id"] += index
+        messages.append(message)
+    broker = FakeBroker(messages)
+    run_consumer(consumer, broker)
+
+    assert len(broker.settled) == 5
+    assert max_active == 2
+
+
+def test_consume_ordering(consumer_config, bug_create_message, bug_modify_message):
+    """Check that the messages about the same bug are relayed in order, and the others
+    meanwhile."""
+    bug_id = bug_create_message["body"]["event"]["bug_id"]
+    other_bug = copy.deepcopy(bug_modify_message)
+    other_bug["body"]["bug"]["id"] = other_bug["body"]["event"]["bug_id"] = bug_id + 1
+    bug_modify_message["body"]["bug"]["id"] = bug_modify_message["body"]["event"]["bug_id"] = bug_id
+    relayed = []
+
+    async def _relay(body, headers):
+        # The first message is the slowest
+        await asyncio.sleep(0.1 if body["event"]["action"] == "create" else 0)
+        relayed.append((body["event"]["bug_id"], body["event"]["action"]))
+
+    relay = mock.Mock(name="relay")
+    relay.on_stomp_message_async.side_effect = _relay
+    consumer = AsyncBugzillaConsumer(consumer_config, relay)
+    broker = FakeBroker([bug_create_message, other_bug, bug_modify_message])
+    run_consumer(consumer, broker)
+
+    assert relayed == [(bug_id + 1, "modify"), (bug_id, "create"), (bug_id, "modify")]
+
+
+def test_consume_decode_error(consumer_config, bug_create_message, caplog):
+    """Check that the messages that can't be decoded are nacked."""
+    relay = mock.Mock(name="relay")
+    relay.on_stomp_message_async = mock.AsyncMock()
+    consumer = AsyncBugzillaConsumer(consumer_config, relay)
+    broker = FakeBroker([{"headers": bug_create_message["headers"], "body": b"{not json"}])
+    run_consumer(consumer, broker)
+
+    relay.on_stomp_message_async.assert_not_called()
+    assert [frame.command for frame in broker.settled] == ["NACK"]
+    assert "Could not decode the message" in caplog.text
+
+
+def test_consume_without_bug_id(consumer_config, bug_create_message):
+    """Check that the messages that are not about a bug are relayed too."""
+    relay = mock.Mock(name="relay")
+    relay.on_stomp_message_async = mock.AsyncMock()
+    consumer = AsyncBugzillaConsumer(consumer_config, relay)
+    broker = FakeBroker([{"headers": bug_create_message["headers"], "body": {"event": {}}}])
+    run_consumer(consumer, broker)
+
+    relay.on_stomp_message_async.assert_awaited_once()
+    assert [frame.command for frame in broker.settled] == ["ACK"]
+
+
+def test_heartbeat_timeout(consumer_config):
+    """Check that the connection is closed when the broker stops sending heartbeats."""
+    consumer_config["stomp"]["heartbeat"] = 100
+    consumer = AsyncBugzillaConsumer(consumer_config, mock.Mock(name="relay"))
+    broker = FakeBroker([], heartbeat="100,100")
+    with pytest.raises(StompConnectionError, match="No heartbeat received"):
+        run_consumer(consumer, broker)
+    # The consumer still disconnected cleanly
+    assert broker.frames[-1].command == StompSpec.DISCONNECT
+
+
+def test_heartbeat_while_busy(consumer_config, bug_create_message):
+    """Check that the broker's heartbeats are not expected while waiting for a slot."""
+    consumer_config["stomp"]["heartbeat"] = 100
+    consumer_config["stomp"]["concurrency"] = 1
+
+    async def _relay(body, headers):
+        await asyncio.sleep(0.6)
+
+    relay = mock.Mock(name="relay")
+    relay.on_stomp_message_async.side_effect = _relay
+    consumer = AsyncBugzillaConsumer(consumer_config, relay)
+    broker = FakeBroker([bug_create_message] * 2, heartbeat="100,100", beat_interval=0.05)
+    run_consumer(consumer, broker)
+
+    assert [frame.command for frame in broker.settled] == ["ACK", "ACK"]
+
+
+def test_consume_dedup(consumer_config, bug_create_message):
+    """Check that redelivered messages are acked without being relayed again."""
+    consumer_config["stomp"]["concurrency"] = 1
+    consumer_config["dedup"] = {"window": 60}
+    relay = mock.Mock(name="relay")
+    relay.on_stomp_message_async = mock.AsyncMock()
+    consumer = AsyncBugzillaConsumer(consumer_config, relay)
+    # The broker sends the same Bugzilla event twice
+    broker = FakeBroker([bug_create_message, bug_create_message])
+    run_consumer(consumer, broker)
+
+    assert relay.on_stomp_message_async.call_count == 1
+    assert [frame.command for frame in broker.settled] == ["ACK", "ACK"]
+
+
+@pytest.mark.parametrize("published", [True, False])
+def test_consume_dedup_in_flight(consumer_config, bug_create_message, published):
+    """Check that a copy of a message being relayed waits for it: it is acked if the
+    message is published, and relayed otherwise."""
+    consumer_config["dedup"] = {"window": 60}
+    relayed = []
+
+    async def _relay(body, headers):
+        relayed.append(headers[StompSpec.MESSAGE_ID_HEADER])
+        await asyncio.sleep(0.1)
+        if not published and len(relayed) == 1:
+            raise ValueError("Could not publish")
+
+    relay = mock.Mock(name="relay")
+    relay.on_stomp_message_async.side_effect = _relay
+    consumer = AsyncBugzillaConsumer(consumer_config, relay)
+    # The broker sends the same Bugzilla event twice, without waiting for the first ack
+    broker = FakeBroker([bug_create_message, bug_create_message])
+    run_consumer(consumer, broker)
+
+    settled = [(frame.command, frame.headers["id"]) for frame in broker.settled]
+    if published:
+        assert relayed == ["msg-0"]
+        assert settled == [("ACK", "ack-0"), ("ACK", "ack-1")]
+    else:
+        assert relayed == ["msg-0", "msg-1"]
+        assert settled == [("NACK", "ack-0"), ("ACK", "ack-1")]
+
+
+def test_drain_timeout(consumer_config, bug_create_message, caplog):
+    """Check that the consumer disconnects when the messages in flight take too long."""
+    consumer_config["stomp"]["drain_timeout"] = 0.1
+    consumer_config["dedup"] = {"window": 60}
+    in_flight = REGISTRY.get_sample_value("bugzilla2fedmsg_frames_in_flight")
+
+    async def _relay(body, headers):
+        # Let the copy be received
+        await asyncio.sleep(0.05)
+        consumer.stop()
+        await asyncio.sleep(10)
+
+    relay = mock.Mock(name="relay")
+    relay.on_stomp_message_async.side_effect = _relay
+    consumer = AsyncBugzillaConsumer(consumer_config, relay)
+    # The copy waits for the first message
+    broker = FakeBroker([bug_create_message, bug_create_message])
+    run_consumer(consumer, broker)
+
+    assert broker.settled == []
+    assert broker.frames[-1].command == StompSpec.DISCONNECT
+    assert "2 messages were not published after 0.1s" in caplog.text
+    assert REGISTRY.get_sample_value("bugzilla2fedmsg_frames_in_flight") == in_flight
+    # The message can be relayed when the broker redelivers it
+    assert consumer.dedup.claim(relay.on_stomp_message_async.call_args[0][1]) == CLAIMED
+
+
+def test_drain(consumer_config, bug_create_message):
+    """Check that the messages in flight are acked before disconnecting."""
+
+    async def _relay(body, headers):
+        consumer.stop()
+        await asyncio.sleep(0.1)
+
+    relay = mock.Mock(name="relay")
+    relay.on_stomp_message_async.side_effect = _relay
+    consumer = AsyncBugzillaConsumer(consumer_config, relay)
+    broker = FakeBroker([bug_create_message])
+    run_consumer(consumer, broker)
+
+    assert [frame.command for frame in broker.settled] == ["ACK"]
+    assert broker.frames[-1].command == StompSpec.DISCONNECT
+
+
+def test_stop_before_start(consumer_config, bug_create_message):
+    """Check that a consumer stopped while connecting disconnects without relaying anything."""
+    relay = mock.Mock(name="relay")
+    relay.on_stomp_message_async = mock.AsyncMock()
+    consumer = AsyncBugzillaConsumer(consumer_config, relay)
+    consumer.stop()
+    broker = FakeBroker([bug_create_message])
+    run_consumer(consumer, broker)
+
+    relay.on_stomp_message_async.assert_not_called()
+    assert broker.settled == []
+    assert broker.frames[-1].command == StompSpec.DISCONNECT
+
+
+def test_consume_sync(consumer_config, mocker):
+    """Check that the blocking variant runs the consumer on an event loop."""
+    consumer = AsyncBugzillaConsumer(consumer_config, mock.Mock(name="relay"))
+    consume_async = mocker.patch.object(consumer, "consume_async", new=mock.AsyncMock())
+    # Not started yet, nothing to stop
+    consumer.stop()
+    consumer.consume()
+    consume_async.assert_awaited_once_with()
+
+
+def test_connect_retry(consumer_config, bug_create_message, caplog):
+    """Check that the next broker is tried when the connection fails."""
+    # A port where nothing listens
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        closed_port = sock.getsockname()[1]
+    relay = mock.Mock(name="relay")
+    relay.on_stomp_message_async = mock.AsyncMock()
+    consumer = AsyncBugzillaConsumer(consumer_config, relay)
+    broker = FakeBroker([bug_create_message])
+    uri = (
+        f"failover:(tcp://127.0.0.1:{closed_port},tcp://127.0.0.1:{{port}})"
+        "?randomize=false,initialReconnectDelay=1,startupMaxReconnectAttempts=2"
+    )
+    run_consumer(consumer, broker, uri=uri)
+
+    assert f"Could not connect to 127.0.0.1:{closed_port}: " in caplog.text
+    assert [frame.command for frame in broker.settled] == ["ACK"]
+
+
+def test_connect_error(consumer_config):
+    """Check that the consumer fails when the broker refuses the connection."""
+    consumer = AsyncBugzillaConsumer(consumer_config, mock.Mock(name="relay"))
+    broker = FakeBroker([], connected=False)
+    with pytest.raises(StompProtocolError, match="Could not connect to the STOMP broker"):
+        run_consumer(consumer, broker)
+
+
+def test_error_frame(consumer_config):
+    """Check that the consumer stops on an ERROR frame, and ignores the other frames."""
+    consumer = AsyncBugzillaConsumer(consumer_config, mock.Mock(name="relay"))
+    receipt = StompFrame(StompSpec.RECEIPT, {StompSpec.RECEIPT_ID_HEADER: "1"})
+    error = StompFrame(StompSpec.ERROR, {"message": "Something went wrong"})
+    broker = FakeBroker([], after_messages=[receipt, error])
+    with pytest.raises(StompProtocolError, match="Received an error from the STOMP broker"):
+        run_consumer(consumer, broker)
+    assert broker.frames[-1].command == StompSpec.DISCONNECT
+
+
+def test_connection_closed(consumer_config):
+    """Check that the consumer stops when the broker closes the connection."""
+    consumer = AsyncBugzillaConsumer(consumer_config, mock.Mock(name="relay"))
+    broker = FakeBroker([], after_messages=[None])
+    with pytest.raises(StompConnectionError, match="Connection closed by the STOMP broker"):
+        run_consumer(consumer, broker)
+
+
+def test_connection_reset(consumer_config, bug_create_message):
+    """Check that a connection reset is raised as a STOMP connection error, so that the
+    relay reconnects."""
+    relay = mock.Mock(name="relay")
+    relay.on_stomp_message_async = mock.AsyncMock()
+    consumer = AsyncBugzillaConsumer(consumer_config, relay)
+    broker = FakeBroker([bug_create_message], after_messages=[RESET])
+    with pytest.raises(StompConnectionError, match="Connection to the STOMP broker lost"):
+        run_consumer(consumer, broker)
+    assert consumer._writer is None
+
+
+def test_send_error(consumer_config):
+    consumer = AsyncBugzillaConsumer(consumer_config, mock.Mock(name="relay"))
+    consumer._session = StompSession(version=StompSpec.VERSION_1_2)
+    consumer._writer = mock.Mock(name="writer")
+    consumer._writer.write.side_effect = BrokenPipeError("Broken pipe")
+    with pytest.raises(StompConnectionError, match="Could not send to the STOMP broker"):
+        consumer._send(consumer._session.beat())
+
+
+def test_settle_disconnected(consumer_config):
+    """Check that the frames settled after the connection was lost are not sent."""
+    consumer = AsyncBugzillaConsumer(consumer_config, mock.Mock(name="relay"))
+    consumer._session = StompSession(version=StompSpec.VERSION_1_2)
+    consumer._writer = mock.Mock(name="writer")
+    frame = StompFrame(StompSpec.MESSAGE, {StompSpec.MESSAGE_ID_HEADER: "1"})
+    consumer._send_settlement(frame, True)
+    consumer._writer.write.assert_not_called()
+
+
+def test_disconnect_error(consumer_config, caplog):
+    """Check that failing to close the connection is only logged."""
+    consumer = AsyncBugzillaConsumer(consumer_config, mock.Mock(name="relay"))
+    # Not connected
+    asyncio.run(consumer._disconnect())
+    consumer._session = StompSession(version=StompSpec.VERSION_1_2)
+    consumer._writer = mock.Mock(name="writer")
+    consumer._writer.wait_closed = mock.AsyncMock(side_effect=ConnectionResetError("reset"))
+    asyncio.run(consumer._disconnect())
+    assert "Could not disconnect cleanly: reset" in caplog.text
+    assert consumer._writer is None
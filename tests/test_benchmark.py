@@ -0,0 +1,53 @@
+""" Tests for the relay benchmark harness. """
+
+import json
+
+from . import benchmark
+
+
+def test_run():
+    results = benchmark.run(16)
+    assert results["messages"] == 16
+    # The private and other product messages are dropped
+    assert results["published"] == 12
+    assert results["messages_per_second"] > 0
+    assert set(results["stages"]) == {
+        "json_decode",
+        "convert_datetimes",
+        "bz4_compat_transform",
+        "bz4_compat_reference",
+        "get_all_emails",
+        "get_message_body",
+        "on_stomp_message",
+    }
+    assert set(results["stages"]["on_stomp_message"]) == {"p50", "p90", "p99"}
+    assert results["peak_kib_per_message"] > 0
+
+
+def test_compare():
+    baseline = {
+        "messages_per_second": 1000,
+        "stages": {"convert_datetimes": {"p50": 10.0}, "removed_stage": {"p50": 1.0}},
+    }
+    results = {"messages_per_second": 900, "stages": {"convert_datetimes": {"p50": 11.0}}}
+    assert benchmark.compare(results, baseline, 0.2) == []
+    results = {"messages_per_second": 700, "stages": {"convert_datetimes": {"p50": 13.0}}}
+    assert benchmark.compare(results, baseline, 0.2) == [
+        "throughput: 700 msg/s, baseline 1000 msg/s",
+        "convert_datetimes: p50 13.0us, baseline 10.0us",
+    ]
+
+
+def test_main(tmp_path, capsys):
+    baseline_path = tmp_path / "baseline.json"
+    assert benchmark.main(["-n", "8", "--save-baseline", str(baseline_path)]) == 0
+    assert "Throughput:" in capsys.readouterr().out
+    baseline = json.loads(baseline_path.read_text())
+    assert baseline["messages"] == 8
+    assert benchmark.main(["-n", "8", "--baseline", str(baseline_path), "--tolerance", "100"]) == 0
+    assert "No regression" in capsys.readouterr().out
+    # Make the baseline impossible to reach
+    baseline["messages_per_second"] = float("inf")
+    baseline_path.write_text(json.dumps(baseline))
+    assert benchmark.main(["-n", "8", "--baseline", str(baseline_path)]) == 1
+    assert "Regressions compared to the baseline" in capsys.readouterr().out
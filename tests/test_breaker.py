@@ -0,0 +1,81 @@
+""" Tests for bugzilla2fedmsg.breaker. """
+
+from unittest import mock
+
+import pytest
+
+from bugzilla2fedmsg.breaker import CircuitBreaker, CircuitOpen
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def _fail():
+    raise ValueError("oops")
+
+
+def test_closed(clock):
+    breaker = CircuitBreaker("service", failure_threshold=2, clock=clock)
+    assert breaker.call(lambda x: x * 2, 21) == 42
+    with pytest.raises(ValueError):
+        breaker.call(_fail)
+    # A success resets the failure count
+    breaker.call(lambda: None)
+    with pytest.raises(ValueError):
+        breaker.call(_fail)
+    assert breaker.is_closed
+
+
+def test_open(clock):
+    breaker = CircuitBreaker("service", failure_threshold=2, reset_timeout=30, clock=clock)
+    for _i in range(2):
+        with pytest.raises(ValueError):
+            breaker.call(_fail)
+    assert breaker.state == CircuitBreaker.OPEN
+    function = mock.Mock()
+    with pytest.raises(CircuitOpen, match="service is unavailable"):
+        breaker.call(function)
+    function.assert_not_called()
+
+
+def test_probe_success(clock):
+    breaker = CircuitBreaker("service", failure_threshold=1, reset_timeout=30, clock=clock)
+    with pytest.raises(ValueError):
+        breaker.call(_fail)
+    clock.now += 30
+
+    def _probe():
+        # Only one call goes through while probing
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        with pytest.raises(CircuitOpen):
+            breaker.call(lambda: None)
+        return "ok"
+
+    assert breaker.call(_probe) == "ok"
+    assert breaker.is_closed
+
+
+def test_probe_failure(clock):
+    breaker = CircuitBreaker("service", failure_threshold=1, reset_timeout=30, clock=clock)
+    with pytest.raises(ValueError):
+        breaker.call(_fail)
+    clock.now += 30
+    with pytest.raises(ValueError):
+        breaker.call(_fail)
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now += 29
+    with pytest.raises(CircuitOpen):
+        breaker.call(lambda: None)
+    clock.now += 1
+    breaker.call(lambda: None)
+    assert breaker.is_closed
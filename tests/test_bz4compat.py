@@ -0,0 +1,100 @@
+""" Tests for bugzilla2fedmsg.bz4compat. """
+
+import copy
+import json
+
+import pytest
+
+from bugzilla2fedmsg.bz4compat import compile_transform
+
+from .conftest import load_message
+
+
+def reference_transform(bug, event, payload, obj):
+    """The BZ4 compatibility transform as it was written by hand, before the tables."""
+    if bug.get("assigned_to", {}).get("login"):
+        bug["assigned_to"] = bug["assigned_to"]["login"]
+    if bug.get("component", {}).get("name"):
+        bug["component"] = bug["component"]["name"]
+    if bug.get("product", {}).get("name"):
+        bug["product"] = bug["product"]["name"]
+    bug["cc"] = bug.get("cc", [])
+    if bug.get("reporter", {}).get("login"):
+        bug["creator"] = bug["reporter"]["login"]
+    if bug.get("operating_system"):
+        bug["op_sys"] = bug["operating_system"]
+    if not bug.get("weburl"):
+        bug["weburl"] = f"https://bugzilla.redhat.com/show_bug.cgi?id={bug['id']}"
+    event["who"] = event["user"]["login"]
+    event["changes"] = event.get("changes", [])
+    for change in event["changes"]:
+        change["field_name"] = change["field"]
+    if obj == "comment":
+        payload["author"] = event.get("user", {}).get("login", "")
+
+
+def _split(name):
+    message = load_message(name)
+    obj = message["headers"]["destination"].split("bugzilla.")[1].split(".")[0]
+    body = message["body"]
+    if obj == "bug":
+        return body["bug"], body["event"], None, obj
+    return body[obj].pop("bug"), body["event"], body[obj], obj
+
+
+def _variants():
+    """The bug, event and object dicts of the sample messages, and some unusual ones."""
+    for name in (
+        "bug_create",
+        "bug_modify",
+        "bug_modify_four_changes",
+        "comment_create",
+        "attachment_create",
+        "attachment_modify",
+    ):
+        yield name, _split(name)
+    bug, event, payload, obj = _split("comment_create")
+    bug["weburl"] = "https://bugzilla.example.com/1"
+    bug["operating_system"] = ""
+    bug["cc"] = ["someone@example.com"]
+    del bug["component"]
+    bug["assigned_to"] = {"id": 1}
+    yield "unusual", (bug, event, payload, obj)
+
+
+@pytest.mark.parametrize("name,dicts", list(_variants()))
+def test_equivalence(name, dicts):
+    """Check that the compiled transform does what the hand written one did, key order included."""
+    expected = copy.deepcopy(dicts)
+    reference_transform(*expected)
+    compile_transform()(*dicts)
+    assert json.dumps(dicts) == json.dumps(expected)
+
+
+def test_extra_mapping():
+    """Check that mappings can be added to the tables."""
+    transform = compile_transform(
+        bug_fields=[("copy", "status", ("status", "name"))],
+        event_fields=[],
+        object_fields={"attachment": [("event", "uploader", ("user", "login"), "")]},
+    )
+    bug = {"status": {"id": 1, "name": "NEW"}}
+    attachment = {}
+    transform(bug, {"user": {"login": "a@example.com"}}, attachment, "attachment")
+    assert bug == {"status": "NEW"}
+    assert attachment == {"uploader": "a@example.com"}
+
+
+def test_unknown_mapping():
+    with pytest.raises(ValueError, match="Unknown kind of BZ4 mapping: 'dummy'"):
+        compile_transform(bug_fields=[("dummy", "field")])
+
+
+def test_default_not_shared():
+    """Check that each message gets its own copy of a mutable default."""
+    transform = compile_transform(bug_fields=[("default", "cc", [])], event_fields=[])
+    first, second = {}, {}
+    transform(first, {}, None, "bug")
+    transform(second, {}, None, "bug")
+    first["cc"].append("someone@example.com")
+    assert second == {"cc": []}
@@ -0,0 +1,243 @@
+""" Tests for bugzilla2fedmsg.cache. """
+
+import pytest
+
+from bugzilla2fedmsg.cache import CacheRefresher, dump_users, EmailCache, EmailStore
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_hit_and_miss(clock):
+    cache = EmailCache(clock=clock)
+    with pytest.raises(KeyError):
+        cache["dgunchev@gmail.com"]
+    cache["dgunchev@gmail.com"] = "dgunchev"
+    assert cache["dgunchev@gmail.com"] == "dgunchev"
+    assert cache.hits == 1
+    assert cache.misses == 1
+    assert len(cache) == 1
+
+
+def test_negative_result(clock):
+    cache = EmailCache(clock=clock)
+    cache["nobody@example.com"] = None
+    assert cache["nobody@example.com"] is None
+    assert cache.hits == 1
+
+
+def test_ttl(clock):
+    cache = EmailCache(ttl=60, negative_ttl=10, clock=clock)
+    cache["dgunchev@gmail.com"] = "dgunchev"
+    cache["nobody@example.com"] = None
+    clock.now += 10
+    # The negative result has expired, the positive one has not.
+    with pytest.raises(KeyError):
+        cache["nobody@example.com"]
+    assert cache["dgunchev@gmail.com"] == "dgunchev"
+    clock.now += 50
+    with pytest.raises(KeyError):
+        cache["dgunchev@gmail.com"]
+    assert cache.misses == 2
+    # The expired results are still known, for when FASJSON is down
+    assert len(cache) == 2
+    assert cache.last_known("dgunchev@gmail.com") == "dgunchev"
+    assert cache.last_known("nobody@example.com") is None
+    assert cache.last_known("unknown@example.com") is None
+
+
+def test_lru_eviction(clock):
+    cache = EmailCache(size=2, clock=clock)
+    cache["a@example.com"] = "a"
+    cache["b@example.com"] = "b"
+    # Use a, so that b is the least recently used entry.
+    assert cache["a@example.com"] == "a"
+    cache["c@example.com"] = "c"
+    assert len(cache) == 2
+    with pytest.raises(KeyError):
+        cache["b@example.com"]
+    assert cache["a@example.com"] == "a"
+    assert cache["c@example.com"] == "c"
+
+
+def test_disabled(clock):
+    cache = EmailCache(size=0, clock=clock)
+    cache["a@example.com"] = "a"
+    assert len(cache) == 0
+    with pytest.raises(KeyError):
+        cache["a@example.com"]
+    assert cache.update([("a@example.com", "a")]) == 0
+    assert cache.warm() == 0
+
+
+def test_clear(clock):
+    cache = EmailCache(clock=clock)
+    cache["a@example.com"] = "a"
+    cache.clear()
+    assert len(cache) == 0
+
+
+class FakeWallClock(FakeClock):
+    def __init__(self):
+        self.now = 1700000000.0
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = EmailStore(str(tmp_path / "cache.sqlite"), max_age=3600, clock=FakeWallClock())
+    yield store
+    store.close()
+
+
+def test_store(store):
+    store["dgunchev@gmail.com"] = "dgunchev"
+    store["nobody@example.com"] = None
+    assert store["dgunchev@gmail.com"] == "dgunchev"
+    assert store["nobody@example.com"] is None
+    with pytest.raises(KeyError):
+        store["unknown@example.com"]
+    assert len(store) == 2
+
+
+def test_store_items_and_prune(store):
+    store["old@example.com"] = "old"
+    store._clock.now += 3000
+    store["new@example.com"] = "new"
+    assert store.items() == [("old@example.com", "old", 3000), ("new@example.com", "new", 0)]
+    assert store.items(max_age=1000) == [("new@example.com", "new", 0)]
+    store._clock.now += 1000
+    assert store.prune() == 1
+    assert store.items() == [("new@example.com", "new", 1000)]
+
+
+def test_store_reopen(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    store = EmailStore(path)
+    store["dgunchev@gmail.com"] = "dgunchev"
+    store.close()
+    store = EmailStore(path)
+    assert store["dgunchev@gmail.com"] == "dgunchev"
+    store.close()
+
+
+def test_cache_writes_to_store(clock, store):
+    cache = EmailCache(store=store, clock=clock)
+    cache["dgunchev@gmail.com"] = "dgunchev"
+    assert store["dgunchev@gmail.com"] == "dgunchev"
+
+
+def test_warm(clock, store):
+    store["dgunchev@gmail.com"] = "dgunchev"
+    store["nobody@example.com"] = None
+    store._clock.now += 20
+    store["lvrabec@redhat.com"] = "lv"
+    store._clock.now += 10
+    cache = EmailCache(ttl=60, negative_ttl=20, store=store, clock=clock)
+    # The negative result is too old to be loaded
+    assert cache.warm() == 2
+    assert cache["dgunchev@gmail.com"] == "dgunchev"
+    assert cache["lvrabec@redhat.com"] == "lv"
+    with pytest.raises(KeyError):
+        cache["nobody@example.com"]
+    # The remaining TTL is kept
+    clock.now += 30
+    store._clock.now += 30
+    with pytest.raises(KeyError):
+        cache["dgunchev@gmail.com"]
+    assert cache["lvrabec@redhat.com"] == "lv"
+
+
+def test_warm_size(clock, store):
+    for index in range(5):
+        store[f"{index}@example.com"] = str(index)
+        store._clock.now += 1
+    cache = EmailCache(size=2, store=store, clock=clock)
+    cache.warm()
+    # The most recent lookups are kept
+    assert len(cache) == 2
+    assert cache["4@example.com"] == "4"
+    assert cache["3@example.com"] == "3"
+
+
+def test_store_fallback(clock, store):
+    cache = EmailCache(size=1, ttl=60, store=store, clock=clock)
+    cache["dgunchev@gmail.com"] = "dgunchev"
+    cache["lvrabec@redhat.com"] = "lv"
+    # Evicted from memory, but still in the store
+    assert len(cache) == 1
+    assert cache["dgunchev@gmail.com"] == "dgunchev"
+    assert cache.hits == 1
+    store._clock.now += 60
+    clock.now += 60
+    with pytest.raises(KeyError):
+        cache["lvrabec@redhat.com"]
+    assert cache.misses == 1
+
+
+def test_update(clock, store):
+    cache = EmailCache(size=2, store=store, clock=clock)
+    cache["hot@example.com"] = None
+    users = [("a@example.com", "a"), ("b@example.com", "b"), ("hot@example.com", "hot")]
+    assert cache.update(users) == 3
+    # Only the address in use is refreshed in memory, the others are loaded from the store
+    assert len(cache) == 1
+    assert cache["hot@example.com"] == "hot"
+    assert len(store) == 3
+    assert cache["a@example.com"] == "a"
+    assert cache.hits == 2
+
+
+def test_update_without_store(clock):
+    cache = EmailCache(size=2, clock=clock)
+    cache["hot@example.com"] = "hot"
+    users = [("a@example.com", "a"), ("b@example.com", "b")]
+    assert cache.update(users) == 2
+    # The address in use is not evicted
+    assert cache["hot@example.com"] == "hot"
+    assert cache["a@example.com"] == "a"
+    with pytest.raises(KeyError):
+        cache["b@example.com"]
+
+
+def test_dump_users():
+    assert list(dump_users({"a@example.com": "a"})) == [("a@example.com", "a")]
+    users = [
+        {"username": "a", "rhbzemail": "a@example.com"},
+        {"username": "b", "rhbzemail": None},
+        {"username": "c"},
+    ]
+    assert list(dump_users(users)) == [("a@example.com", "a")]
+
+
+def test_refresher(mocker, clock):
+    fasjson = mocker.Mock(name="fasjson")
+    fasjson.list_all_entities.return_value = [
+        {"username": "a", "rhbzemail": "a@example.com"},
+        {"username": "b", "rhbzemail": None},
+    ]
+    cache = EmailCache(clock=clock)
+    refresher = CacheRefresher(cache, fasjson, interval=60, page_size=10)
+    refresher.start()
+    refresher.stop()
+    fasjson.list_all_entities.assert_called_once_with("users", page_size=10)
+    assert cache["a@example.com"] == "a"
+    assert len(cache) == 1
+
+
+def test_refresher_error(mocker, clock, caplog):
+    fasjson = mocker.Mock(name="fasjson")
+    fasjson.list_all_entities.side_effect = ValueError("oops")
+    refresher = CacheRefresher(EmailCache(clock=clock), fasjson, interval=60)
+    refresher.start()
+    refresher.stop()
+    assert "Could not refresh the FASJSON cache:" in caplog.messages
@@ -0,0 +1,192 @@
+""" Tests for the bugzilla2fedmsg command. """
+
+import json
+import os
+import signal
+
+import pytest
+from click.testing import CliRunner
+
+from bugzilla2fedmsg import cli, ENGINES
+from bugzilla2fedmsg.cache import EmailStore
+
+
+def test_default_command(mocker, tmp_path):
+    mocker.patch("fedora_messaging.config.conf.setup_logging")
+    consume = mocker.patch("bugzilla2fedmsg.consume")
+    config_path = tmp_path / "config.toml"
+    config_path.write_text('[consumer_config]\nfasjson_url = "https://fasjson.example.com"\n')
+    result = CliRunner().invoke(cli, ["-c", str(config_path)])
+    assert result.exit_code == 0, result.output
+    consume.assert_called_once_with()
+
+
+def test_processes(mocker, tmp_path):
+    mocker.patch("fedora_messaging.config.conf.setup_logging")
+    supervisor_class = mocker.patch("bugzilla2fedmsg.Supervisor")
+    start_metrics_server = mocker.patch("bugzilla2fedmsg.start_metrics_server")
+    config_path = tmp_path / "config.toml"
+    config_path.write_text('[consumer_config]\nfasjson_url = "https://fasjson.example.com"\n')
+    result = CliRunner().invoke(cli, ["-c", str(config_path), "--processes", "4"])
+    assert result.exit_code == 0, result.output
+    start_metrics_server.assert_called_once_with({}, multiprocess_mode=True)
+    target, processes = supervisor_class.call_args[0]
+    assert processes == 4
+    assert target.keywords == {"serve_metrics": False}
+    supervisor_class.return_value.run.assert_called_once_with()
+
+
+@pytest.mark.parametrize("args", [[], ["--processes", "4"]])
+def test_metrics_error(mocker, tmp_path, args):
+    mocker.patch("fedora_messaging.config.conf.setup_logging")
+    supervisor_class = mocker.patch("bugzilla2fedmsg.Supervisor")
+    mocker.patch(
+        "bugzilla2fedmsg.start_metrics_server",
+        side_effect=RuntimeError("PROMETHEUS_MULTIPROC_DIR must be set"),
+    )
+    config_path = tmp_path / "config.toml"
+    config_path.write_text('[consumer_config]\nfasjson_url = "https://fasjson.example.com"\n')
+    result = CliRunner().invoke(cli, ["-c", str(config_path), *args])
+    assert result.exit_code == 1
+    assert "Error: PROMETHEUS_MULTIPROC_DIR must be set" in result.output
+    supervisor_class.assert_not_called()
+
+
+class FakeConsumer:
+    """A consumer that gets some signals while consuming."""
+
+    signals = []
+
+    def __init__(self, conf, relay):
+        self.stopping = False
+        self.tracer = None
+
+    def consume(self):
+        for signum in self.signals:
+            os.kill(os.getpid(), signum)
+
+    def stop(self):
+        self.stopping = True
+
+
+@pytest.fixture
+def fake_consumer(mocker):
+    mocker.patch("fedora_messaging.config.conf.setup_logging")
+    mocker.patch("bugzilla2fedmsg.start_metrics_server")
+    mocker.patch.dict(ENGINES, {"threads": FakeConsumer})
+    previous_handlers = {
+        signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+    yield FakeConsumer
+    for signum, handler in previous_handlers.items():
+        signal.signal(signum, handler)
+
+
+def test_stop_on_signal(mocker, tmp_path, fake_consumer):
+    """Check that the relay is closed once the consumer has stopped."""
+    relay_class = mocker.patch("bugzilla2fedmsg.MessageRelay")
+    # The second SIGTERM doesn't interrupt the graceful stop
+    mocker.patch.object(fake_consumer, "signals", [signal.SIGTERM, signal.SIGTERM])
+    config_path = tmp_path / "config.toml"
+    config_path.write_text('[consumer_config]\nfasjson_url = "https://fasjson.example.com"\n')
+    result = CliRunner().invoke(cli, ["-c", str(config_path)])
+    assert result.exit_code == 0, result.output
+    relay_class.return_value.close.assert_called_once_with()
+
+
+def test_stop_on_second_sigint(mocker, tmp_path, fake_consumer):
+    """Check that a second SIGINT stops right away."""
+    relay_class = mocker.patch("bugzilla2fedmsg.MessageRelay")
+    mocker.patch.object(fake_consumer, "signals", [signal.SIGINT, signal.SIGINT])
+    config_path = tmp_path / "config.toml"
+    config_path.write_text('[consumer_config]\nfasjson_url = "https://fasjson.example.com"\n')
+    result = CliRunner().invoke(cli, ["-c", str(config_path)])
+    assert result.exit_code == 1
+    relay_class.return_value.close.assert_not_called()
+
+
+def test_missing_config(tmp_path):
+    result = CliRunner().invoke(cli, ["-c", str(tmp_path / "missing.toml")])
+    assert result.exit_code == 2
+    assert "is not a file" in result.output
+
+
+def test_unknown_engine(mocker, tmp_path):
+    mocker.patch("fedora_messaging.config.conf.setup_logging")
+    config_path = tmp_path / "config.toml"
+    config_path.write_text(
+        '[consumer_config]\nfasjson_url = "https://fasjson.example.com"\n'
+        '[consumer_config.stomp]\nengine = "gevent"\n'
+    )
+    result = CliRunner().invoke(cli, ["-c", str(config_path)])
+    assert result.exit_code == 1
+    assert "Unknown STOMP engine 'gevent', choose from: threads, asyncio" in result.output
+
+
+def test_warm_cache_dump(mocker, tmp_path):
+    mocker.patch("fedora_messaging.config.conf.setup_logging")
+    cache_path = tmp_path / "cache.sqlite"
+    config_path = tmp_path / "config.toml"
+    config_path.write_text(
+        '[consumer_config]\nfasjson_url = "https://fasjson.example.com"\n'
+        f'[consumer_config.fasjson_cache]\npath = "{cache_path}"\n'
+    )
+    dump_path = tmp_path / "users.json"
+    dump_path.write_text(
+        json.dumps(
+            [
+                {"username": "dgunchev", "rhbzemail": "dgunchev@gmail.com"},
+                {"username": "adamw", "rhbzemail": None},
+            ]
+        )
+    )
+    result = CliRunner().invoke(cli, ["-c", str(config_path), "warm-cache", "--dump", dump_path])
+    assert result.exit_code == 0, result.output
+    assert f"Stored 1 email addresses in {cache_path}" in result.output
+    store = EmailStore(str(cache_path))
+    assert store["dgunchev@gmail.com"] == "dgunchev"
+    assert len(store) == 1
+    store.close()
+
+
+def test_warm_cache_invalid_dump(mocker, tmp_path):
+    mocker.patch("fedora_messaging.config.conf.setup_logging")
+    cache_path = tmp_path / "cache.sqlite"
+    config_path = tmp_path / "config.toml"
+    config_path.write_text(
+        '[consumer_config]\nfasjson_url = "https://fasjson.example.com"\n'
+        f'[consumer_config.fasjson_cache]\npath = "{cache_path}"\n'
+    )
+    dump_path = tmp_path / "users.json"
+    dump_path.write_text(json.dumps([{"name": "dgunchev", "rhbzemail": "dgunchev@gmail.com"}]))
+    result = CliRunner().invoke(cli, ["-c", str(config_path), "warm-cache", "--dump", dump_path])
+    assert result.exit_code == 1
+    assert "Invalid dump: 'username'" in result.output
+    assert not cache_path.exists()
+
+
+def test_warm_cache_fasjson(mocker, tmp_path):
+    mocker.patch("fedora_messaging.config.conf.setup_logging")
+    client = mocker.patch("bugzilla2fedmsg.FasjsonClient").return_value
+    client.list_all_entities.return_value = [{"username": "lv", "rhbzemail": "lvrabec@redhat.com"}]
+    cache_path = tmp_path / "cache.sqlite"
+    config_path = tmp_path / "config.toml"
+    config_path.write_text(
+        '[consumer_config]\nfasjson_url = "https://fasjson.example.com"\n'
+        f'[consumer_config.fasjson_cache]\npath = "{cache_path}"\n'
+    )
+    result = CliRunner().invoke(cli, ["-c", str(config_path), "warm-cache", "--page-size", "50"])
+    assert result.exit_code == 0, result.output
+    client.list_all_entities.assert_called_once_with("users", page_size=50)
+    store = EmailStore(str(cache_path))
+    assert store["lvrabec@redhat.com"] == "lv"
+    store.close()
+
+
+def test_warm_cache_no_path(mocker, tmp_path):
+    mocker.patch("fedora_messaging.config.conf.setup_logging")
+    config_path = tmp_path / "config.toml"
+    config_path.write_text('[consumer_config]\nfasjson_url = "https://fasjson.example.com"\n')
+    result = CliRunner().invoke(cli, ["-c", str(config_path), "warm-cache"])
+    assert result.exit_code == 1
+    assert "The fasjson_cache.path setting is required" in result.output
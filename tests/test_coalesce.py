@@ -0,0 +1,123 @@
+""" Tests for bugzilla2fedmsg.coalesce. """
+
+import copy
+import threading
+from unittest import mock
+
+from bugzilla2fedmsg.coalesce import Coalescer, is_cc_only, merge_cc_changes
+
+
+def test_coalescer_groups():
+    """Check that the items are grouped by key, in the order the groups were started."""
+    groups = []
+    coalescer = Coalescer(groups.append, window=60)
+    coalescer.start()
+    for key, item in [(1, "a"), (2, "b"), (1, "c"), (3, "d"), (2, "e")]:
+        coalescer.submit(key, item)
+    # Stopping flushes the pending groups without waiting for the window
+    coalescer.stop()
+    assert groups == [["a", "c"], ["b", "e"], ["d"]]
+    # Stopping again does nothing
+    coalescer.stop()
+
+
+def test_coalescer_window():
+    """Check that a group is flushed once its window has passed."""
+    flushed = threading.Event()
+    groups = []
+
+    def _flush(items):
+        groups.append(items)
+        flushed.set()
+
+    coalescer = Coalescer(_flush, window=0.01)
+    coalescer.start()
+    coalescer.submit(1, "a")
+    coalescer.submit(1, "b")
+    assert flushed.wait(5)
+    coalescer.submit(1, "c")
+    coalescer.stop()
+    assert groups == [["a", "b"], ["c"]]
+
+
+def test_coalescer_workers():
+    """Check that the groups of different keys are flushed in parallel."""
+    flushed = []
+    both_started = threading.Barrier(2, timeout=5)
+
+    def _flush(items):
+        if items[0] in ("a", "b"):
+            # The groups of keys 1 and 2 are flushed at the same time
+            both_started.wait()
+        flushed.append(items)
+
+    coalescer = Coalescer(_flush, window=60, workers=2)
+    coalescer.start()
+    for key, item in [(1, "a"), (2, "b"), (1, "c")]:
+        coalescer.submit(key, item)
+    coalescer.stop()
+    assert sorted(flushed) == [["a", "c"], ["b"]]
+
+
+def test_coalescer_error(caplog):
+    """Check that an error when flushing a group doesn't stop the thread."""
+    groups = []
+
+    def _flush(items):
+        if items == ["a"]:
+            raise ValueError("dummy error")
+        groups.append(items)
+
+    coalescer = Coalescer(_flush, window=60)
+    coalescer.start()
+    coalescer.submit(1, "a")
+    coalescer.submit(2, "b")
+    coalescer.stop()
+    assert groups == [["b"]]
+    assert "Could not relay a group of messages:" in caplog.messages
+
+
+def test_is_cc_only(bug_modify_message, bug_modify_message_four_changes, bug_create_message):
+    assert is_cc_only(bug_modify_message["body"], bug_modify_message["headers"])
+    assert not is_cc_only(
+        bug_modify_message_four_changes["body"], bug_modify_message_four_changes["headers"]
+    )
+    assert not is_cc_only(bug_create_message["body"], bug_create_message["headers"])
+
+
+def test_merge_cc_changes(bug_modify_message, bug_create_message):
+    """Check that consecutive CC changes are merged, and the other messages left alone."""
+    first = copy.deepcopy(bug_modify_message)
+    second = copy.deepcopy(bug_modify_message)
+    second["body"]["event"]["changes"] = [
+        {"field": "cc", "added": "lvrabec@redhat.com", "removed": "dgunchev@gmail.com"}
+    ]
+    callbacks = [mock.Mock(name=f"callback{index}") for index in range(4)]
+    items = [
+        (bug_create_message["body"], bug_create_message["headers"], callbacks[0]),
+        (first["body"], first["headers"], callbacks[1]),
+        (second["body"], second["headers"], callbacks[2]),
+        (bug_modify_message["body"], bug_modify_message["headers"], callbacks[3]),
+    ]
+    bug_modify_message["body"]["event"]["changes"].append(
+        {"field": "status", "added": "ASSIGNED", "removed": "NEW"}
+    )
+
+    merged = merge_cc_changes(items)
+
+    assert len(merged) == 3
+    assert merged[0] == items[0]
+    assert merged[2] == items[3]
+    body, _headers, on_published = merged[1]
+    assert body is second["body"]
+    assert body["event"]["changes"] == [
+        {
+            "field": "cc",
+            "added": "awilliam@redhat.com, lvrabec@redhat.com",
+            "removed": "dgunchev@gmail.com",
+        }
+    ]
+    on_published(None)
+    callbacks[1].assert_called_once_with(None)
+    callbacks[2].assert_called_once_with(None)
+    callbacks[0].assert_not_called()
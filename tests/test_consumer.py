@@ -1,9 +1,14 @@
+import logging
+import threading
+import time
+
 import pytest
+from prometheus_client import REGISTRY
 from stompest.error import StompConnectionError, StompProtocolError
 from stompest.protocol import StompSpec
-from stompest.protocol.frame import StompFrame
+from stompest.protocol.frame import StompFrame, StompHeartBeat
 
-from bugzilla2fedmsg.consumer import BugzillaConsumer
+from bugzilla2fedmsg.consumer import BugzillaConsumer, HeartbeatScheduler, make_ssl_context
 
 
 @pytest.fixture
@@ -30,8 +35,13 @@ def consumer_config():
 def consumer(mocker, consumer_config):
     relay = mocker.Mock(name="relay")
     consumer = BugzillaConsumer(consumer_config, relay)
+
     # Stop after the first message
-    relay.on_stomp_message.side_effect = lambda *args: consumer.stop()
+    def _on_message(body, headers, on_published):
+        consumer.stop()
+        on_published(None)
+
+    relay.on_stomp_message.side_effect = _on_message
     # Setup the transport
     transport = mocker.Mock(name="transport")
     transport.messages = []
@@ -66,6 +76,21 @@ def message_frame():
     return StompFrame(StompSpec.MESSAGE, {StompSpec.MESSAGE_ID_HEADER: "1312"}, b"true")
 
 
+@pytest.fixture
+def message_frame_v12():
+    # Nacking a message requires the STOMP 1.2 headers
+    return StompFrame(
+        StompSpec.MESSAGE,
+        {
+            StompSpec.MESSAGE_ID_HEADER: "1312",
+            StompSpec.ACK_HEADER: "1312",
+            StompSpec.SUBSCRIPTION_HEADER: "0",
+        },
+        b"true",
+        version=StompSpec.VERSION_1_2,
+    )
+
+
 def test_connect(consumer, connected_frame, message_frame):
     transport_factory = consumer.stomp._transportFactory
     transport = transport_factory.return_value
@@ -116,3 +141,501 @@ def test_subscribe_twice(consumer, connected_frame, message_frame):
         consumer.consume()
     except StompProtocolError as e:
         pytest.fail(f"Must not fail when already subscribed: {e}")
+
+
+def test_subscribe_error(mocker, consumer, connected_frame):
+    """Check that the subscription errors other than being already subscribed are raised."""
+    transport = consumer.stomp._transportFactory.return_value
+    transport.messages.append(connected_frame)
+    mocker.patch.object(consumer.stomp, "subscribe", side_effect=StompProtocolError("denied"))
+    with pytest.raises(StompProtocolError, match="denied"):
+        consumer.consume()
+    consumer._heartbeat_scheduler.stop()
+
+
+def test_prefetch(consumer, connected_frame, message_frame):
+    transport = consumer.stomp._transportFactory.return_value
+    transport.messages.append(connected_frame)
+    transport.messages.append(message_frame)
+    consumer.consume()
+    sent_frames = [call[0][0] for call in transport.send.call_args_list]
+    assert sent_frames[1].command == StompSpec.SUBSCRIBE
+    assert sent_frames[1].headers["activemq.prefetchSize"] == "100"
+
+
+@pytest.fixture
+def pipelined_consumer(mocker, consumer_config, consumer):
+    consumer._workers = 2
+    transport = consumer.stomp._transportFactory.return_value
+
+    def _can_read(timeout=None):
+        if transport.messages:
+            return True
+        time.sleep(0.01)
+        return False
+
+    transport.canRead.side_effect = _can_read
+    return consumer
+
+
+def test_workers(pipelined_consumer, connected_frame):
+    consumer = pipelined_consumer
+    transport = consumer.stomp._transportFactory.return_value
+    transport.messages.append(connected_frame)
+    for msg_id in ("1", "2"):
+        transport.messages.append(
+            StompFrame(StompSpec.MESSAGE, {StompSpec.MESSAGE_ID_HEADER: msg_id}, b"true")
+        )
+    # The two messages can only be relayed if they are processed concurrently.
+    barrier = threading.Barrier(2, timeout=5)
+    relayed = []
+
+    def _on_message(body, headers, on_published):
+        barrier.wait()
+        relayed.append(headers[StompSpec.MESSAGE_ID_HEADER])
+        if len(relayed) == 2:
+            consumer.stop()
+        on_published(None)
+
+    consumer.relay.on_stomp_message.side_effect = _on_message
+    consumer.consume()
+    assert sorted(relayed) == ["1", "2"]
+    assert consumer._worker_threads == []
+    sent_frames = [call[0][0] for call in transport.send.call_args_list]
+    acked = [frame.headers["message-id"] for frame in sent_frames if frame.command == StompSpec.ACK]
+    assert sorted(acked) == ["1", "2"]
+
+
+def test_workers_ordering(pipelined_consumer, connected_frame):
+    """Check that the messages about the same bug are relayed in order, by the same worker."""
+    consumer = pipelined_consumer
+    transport = consumer.stomp._transportFactory.return_value
+    transport.messages.append(connected_frame)
+    for msg_id, bug_id in (("1a", 1), ("2", 2), ("1b", 1)):
+        transport.messages.append(
+            StompFrame(
+                StompSpec.MESSAGE,
+                {StompSpec.MESSAGE_ID_HEADER: msg_id},
+                b'{"event": {"bug_id": %d}}' % bug_id,
+            )
+        )
+    other_bug_relayed = threading.Event()
+    relayed = []
+
+    def _on_message(body, headers, on_published):
+        msg_id = headers[StompSpec.MESSAGE_ID_HEADER]
+        if msg_id == "1a":
+            # The other bug is relayed meanwhile, by the other worker
+            assert other_bug_relayed.wait(5)
+        elif msg_id == "2":
+            other_bug_relayed.set()
+        relayed.append((msg_id, threading.current_thread().name))
+        if len(relayed) == 3:
+            consumer.stop()
+        on_published(None)
+
+    consumer.relay.on_stomp_message.side_effect = _on_message
+    consumer.consume()
+    assert [msg_id for msg_id, _thread in relayed] == ["2", "1a", "1b"]
+    threads = dict(relayed)
+    assert threads["1a"] == threads["1b"] != threads["2"]
+    assert consumer.lane_depths() == [0, 0]
+
+
+def test_workers_nack(pipelined_consumer, connected_frame, message_frame_v12, caplog):
+    consumer = pipelined_consumer
+    transport = consumer.stomp._transportFactory.return_value
+    transport.messages.append(connected_frame)
+    transport.messages.append(message_frame_v12)
+
+    def _on_message(body, headers, on_published):
+        consumer.stop()
+        raise ValueError("oops")
+
+    consumer.relay.on_stomp_message.side_effect = _on_message
+    consumer.consume()
+    sent_frames = [call[0][0] for call in transport.send.call_args_list]
+    assert sent_frames[-2].command == StompSpec.NACK
+    assert "Exception when relaying the message" in caplog.text
+
+
+def test_workers_error(pipelined_consumer, connected_frame, caplog):
+    consumer = pipelined_consumer
+    transport = consumer.stomp._transportFactory.return_value
+    transport.messages.append(connected_frame)
+    transport.messages.append(
+        StompFrame(StompSpec.MESSAGE, {StompSpec.MESSAGE_ID_HEADER: "1312"}, b"not json")
+    )
+    transport.messages.append(
+        StompFrame(StompSpec.MESSAGE, {StompSpec.MESSAGE_ID_HEADER: "1313"}, b"true")
+    )
+    consumer.consume()
+    assert "Could not decode the message" in caplog.text
+    # Nacking fails without the STOMP 1.2 headers
+    assert "Could not process the frame" in caplog.text
+    consumer.relay.on_stomp_message.assert_called_once()
+    assert consumer.flow.in_flight == 0
+
+
+def test_decode_error(consumer, connected_frame, caplog):
+    """Check that a message that can't be decoded is nacked."""
+    transport = consumer.stomp._transportFactory.return_value
+    frame = StompFrame(
+        StompSpec.MESSAGE,
+        {
+            StompSpec.MESSAGE_ID_HEADER: "1312",
+            StompSpec.ACK_HEADER: "1312",
+            StompSpec.SUBSCRIPTION_HEADER: "0",
+        },
+        b"not json",
+        version=StompSpec.VERSION_1_2,
+    )
+    transport.messages.extend([connected_frame, frame])
+    consumer.relay.prefilter.side_effect = lambda headers, data: consumer.stop() or True
+    consumer.consume()
+    assert "Could not decode the message:" in caplog.messages
+    consumer.relay.on_stomp_message.assert_not_called()
+    sent_frames = [call[0][0] for call in transport.send.call_args_list]
+    assert sent_frames[-2].command == StompSpec.NACK
+    assert consumer.flow.in_flight == 0
+
+
+def test_publish_error(consumer, connected_frame, message_frame_v12, caplog):
+    transport = consumer.stomp._transportFactory.return_value
+    transport.messages.append(connected_frame)
+    transport.messages.append(message_frame_v12)
+
+    def _on_message(body, headers, on_published):
+        consumer.stop()
+        on_published(ValueError("oops"))
+
+    consumer.relay.on_stomp_message.side_effect = _on_message
+    consumer.consume()
+    sent_frames = [call[0][0] for call in transport.send.call_args_list]
+    assert sent_frames[-2].command == StompSpec.NACK
+    assert "Could not publish message with ID 1312: oops" in caplog.text
+
+
+def test_metrics(consumer, connected_frame, message_frame, message_frame_v12):
+    received = REGISTRY.get_sample_value("bugzilla2fedmsg_messages_received_total") or 0
+    acked = REGISTRY.get_sample_value("bugzilla2fedmsg_ack_latency_seconds_count") or 0
+    nacked = REGISTRY.get_sample_value("bugzilla2fedmsg_messages_nacked_total") or 0
+    in_flight = REGISTRY.get_sample_value("bugzilla2fedmsg_frames_in_flight")
+    transport = consumer.stomp._transportFactory.return_value
+    transport.messages.extend([connected_frame, message_frame, message_frame_v12])
+    results = [None, ValueError("oops")]
+
+    def _on_message(body, headers, on_published):
+        on_published(results.pop(0))
+        if not results:
+            consumer.stop()
+
+    consumer.relay.on_stomp_message.side_effect = _on_message
+    consumer.consume()
+    assert REGISTRY.get_sample_value("bugzilla2fedmsg_messages_received_total") == received + 2
+    assert REGISTRY.get_sample_value("bugzilla2fedmsg_ack_latency_seconds_count") == acked + 1
+    assert REGISTRY.get_sample_value("bugzilla2fedmsg_messages_nacked_total") == nacked + 1
+    assert REGISTRY.get_sample_value("bugzilla2fedmsg_frames_in_flight") == in_flight
+
+
+def test_tracing(consumer, connected_frame, message_frame, caplog):
+    caplog.set_level(logging.INFO)
+    consumer.tracer.enabled = True
+    transport = consumer.stomp._transportFactory.return_value
+    transport.messages.extend([connected_frame, message_frame])
+    consumer.consume()
+    assert "Message 1312 took" in caplog.text
+    assert "json_decode=" in caplog.text
+
+
+def test_heartbeat_only_when_idle(mocker):
+    stomp = mocker.Mock(name="stomp")
+    scheduler = HeartbeatScheduler(stomp, threading.Lock())
+    stomp.lastSent = 100
+    assert not scheduler.beat_if_idle(1, now=100.4)
+    stomp.beat.assert_not_called()
+    assert scheduler.beat_if_idle(1, now=100.5)
+    stomp.beat.assert_called_once_with()
+
+
+def test_heartbeat_thread(mocker):
+    stomp = mocker.Mock(name="stomp", clientHeartBeat=20, lastSent=None)
+    scheduler = HeartbeatScheduler(stomp, threading.Lock())
+    scheduler.start()
+    # Starting twice does not start another thread
+    scheduler.start()
+    time.sleep(0.1)
+    threads = [t for t in threading.enumerate() if t.name == "bz2fm-heartbeat"]
+    scheduler.stop()
+    assert len(threads) == 1
+    assert stomp.beat.call_count >= 2
+    assert not threads[0].is_alive()
+
+
+def test_heartbeat_disabled(mocker):
+    stomp = mocker.Mock(name="stomp", clientHeartBeat=0)
+    scheduler = HeartbeatScheduler(stomp, threading.Lock())
+    scheduler.start()
+    assert scheduler._thread is None
+    scheduler.stop()
+
+
+def test_heartbeat_thread_error(mocker, caplog):
+    stomp = mocker.Mock(name="stomp", clientHeartBeat=20, lastSent=None)
+    stomp.beat.side_effect = StompConnectionError("Not connected")
+    scheduler = HeartbeatScheduler(stomp, threading.Lock())
+    scheduler.start()
+    scheduler._thread.join(5)
+    assert not scheduler._thread.is_alive()
+    assert "Could not send a heartbeat: Not connected" in caplog.messages
+    scheduler.stop()
+
+
+def test_heartbeat_frame(consumer, connected_frame):
+    """Check that a heartbeat from the broker is read without stopping the consumer."""
+    transport = consumer.stomp._transportFactory.return_value
+    # The server heartbeats are not checked when they are disabled
+    connected_frame.headers["heart-beat"] = "0,0"
+    transport.messages.extend([connected_frame, StompHeartBeat()])
+
+    def _can_read(timeout=None):
+        if transport.messages:
+            return True
+        if timeout:
+            consumer.stop()
+        return False
+
+    transport.canRead.side_effect = _can_read
+    consumer.consume()
+    consumer.relay.on_stomp_message.assert_not_called()
+    assert consumer.stomp.session.serverHeartBeat == 0
+
+
+def test_server_heartbeat_timeout(consumer, connected_frame):
+    transport = consumer.stomp._transportFactory.return_value
+    transport.messages.append(connected_frame)
+
+    def _can_read(timeout=None):
+        if transport.messages:
+            return True
+        # The broker has been silent for a while
+        consumer.stomp.session._lastReceived = time.time() - 5
+        return False
+
+    transport.canRead.side_effect = _can_read
+    with pytest.raises(StompConnectionError, match="No heartbeat received"):
+        consumer.consume()
+    assert consumer._heartbeat_scheduler._thread is None
+    transport.disconnect.assert_called_once_with()
+
+
+def test_dedup(consumer_config, mocker, connected_frame):
+    consumer_config["dedup"] = {"window": 60}
+    consumer = BugzillaConsumer(consumer_config, mocker.Mock(name="relay"))
+    transport = mocker.Mock(name="transport")
+    transport.messages = [connected_frame] + [
+        StompFrame(StompSpec.MESSAGE, {StompSpec.MESSAGE_ID_HEADER: msg_id}, b"true")
+        for msg_id in ("1", "1", "2")
+    ]
+    transport.receive.side_effect = lambda: transport.messages.pop(0)
+    consumer.stomp._transportFactory = mocker.Mock(return_value=transport)
+
+    def _on_message(body, headers, on_published):
+        if headers[StompSpec.MESSAGE_ID_HEADER] == "2":
+            consumer.stop()
+        on_published(None)
+
+    consumer.relay.on_stomp_message.side_effect = _on_message
+    consumer.consume()
+    relayed = [
+        c[0][1][StompSpec.MESSAGE_ID_HEADER] for c in consumer.relay.on_stomp_message.call_args_list
+    ]
+    assert relayed == ["1", "2"]
+    sent_frames = [call[0][0] for call in transport.send.call_args_list]
+    acked = [frame.headers["message-id"] for frame in sent_frames if frame.command == StompSpec.ACK]
+    # The duplicate is acked anyway
+    assert acked == ["1", "1", "2"]
+
+
+@pytest.mark.parametrize("published", [True, False])
+def test_dedup_in_flight(consumer_config, mocker, published):
+    """Check that a copy of a message being published waits for it: it is acked if the
+    message is published, and relayed otherwise."""
+    consumer_config["dedup"] = {"window": 60}
+    mocker.patch("bugzilla2fedmsg.consumer.POLL_TIMEOUT", 0.01)
+    consumer = BugzillaConsumer(consumer_config, mocker.Mock(name="relay"))
+    consumer.stomp = mocker.Mock(name="stomp")
+    callbacks = []
+
+    def _on_message(body, headers, on_published):
+        callbacks.append(on_published)
+        # Only the first one is left waiting
+        if len(callbacks) > 1:
+            on_published(None)
+
+    consumer.relay.on_stomp_message.side_effect = _on_message
+    original, copy = (
+        StompFrame(StompSpec.MESSAGE, {StompSpec.MESSAGE_ID_HEADER: "1", "ack": ack}, b"true")
+        for ack in ("original", "copy")
+    )
+    for frame in (original, copy):
+        consumer.flow.acquire()
+        consumer._process(frame, time.monotonic())
+    # The copy is not settled while the original is being published
+    assert len(callbacks) == 1
+    callbacks[0](None if published else ValueError("Could not publish"))
+    consumer._drain()
+    if published:
+        assert len(callbacks) == 1
+        assert [c[0][0] for c in consumer.stomp.ack.call_args_list] == [copy, original]
+        consumer.stomp.nack.assert_not_called()
+    else:
+        # Relayed again from the receiving thread
+        assert len(callbacks) == 2
+        consumer.stomp.nack.assert_called_once_with(original)
+        consumer.stomp.ack.assert_called_once_with(copy)
+    assert consumer.flow.in_flight == 0
+
+
+def test_prefilter(consumer, connected_frame, message_frame, mocker):
+    """Check that the messages rejected from their headers are acked without being decoded."""
+    decode = mocker.patch.object(consumer, "_decode")
+
+    def _prefilter(headers, data):
+        consumer.stop()
+        return False
+
+    consumer.relay.prefilter.side_effect = _prefilter
+    transport = consumer.stomp._transportFactory.return_value
+    transport.messages.extend([connected_frame, message_frame])
+    consumer.consume()
+    consumer.relay.prefilter.assert_called_once_with(message_frame.headers, b"true")
+    decode.assert_not_called()
+    consumer.relay.on_stomp_message.assert_not_called()
+    sent_frames = [call[0][0] for call in transport.send.call_args_list]
+    assert sent_frames[2].command == StompSpec.ACK
+
+
+def test_backpressure(pipelined_consumer, connected_frame, mocker):
+    """Check that no message is received while too many are waiting to be published."""
+    # Check if the consumer must stop while it is paused
+    mocker.patch("bugzilla2fedmsg.consumer.POLL_TIMEOUT", 0.01)
+    consumer = pipelined_consumer
+    consumer.flow.high_water = 2
+    consumer.flow.low_water = 0
+    transport = consumer.stomp._transportFactory.return_value
+    transport.messages.append(connected_frame)
+    for msg_id in ("1", "2", "3"):
+        transport.messages.append(
+            StompFrame(StompSpec.MESSAGE, {StompSpec.MESSAGE_ID_HEADER: msg_id}, b"true")
+        )
+    pending = []
+    paused_with = []
+    both_received = threading.Event()
+
+    def _on_message(body, headers, on_published):
+        pending.append(on_published)
+        if len(pending) == 2:
+            both_received.set()
+        elif len(pending) == 3:
+            consumer.stop()
+            on_published(None)
+
+    def _publish_later():
+        assert both_received.wait(5)
+        time.sleep(0.1)
+        # The third message is still waiting in the socket
+        paused_with.append((consumer.flow.paused, len(transport.messages)))
+        for on_published in pending[:2]:
+            on_published(None)
+
+    consumer.relay.on_stomp_message.side_effect = _on_message
+    publisher = threading.Thread(target=_publish_later)
+    publisher.start()
+    consumer.consume()
+    publisher.join()
+    assert paused_with == [(True, 1)]
+    assert len(pending) == 3
+    assert not consumer.flow.paused
+
+
+def test_drain(consumer, connected_frame, message_frame_v12):
+    """Check that the messages in flight are acked before disconnecting when stopping."""
+    transport = consumer.stomp._transportFactory.return_value
+    transport.messages.extend([connected_frame, message_frame_v12])
+    publishers = []
+
+    def _on_message(body, headers, on_published):
+        consumer.stop()
+        publishers.append(threading.Timer(0.1, on_published, args=(None,)))
+        publishers[0].start()
+
+    consumer.relay.on_stomp_message.side_effect = _on_message
+    consumer.consume()
+    publishers[0].join()
+    sent_frames = [call[0][0] for call in transport.send.call_args_list]
+    assert [frame.command for frame in sent_frames[-2:]] == [StompSpec.ACK, StompSpec.DISCONNECT]
+    assert consumer.flow.in_flight == 0
+
+
+def test_drain_timeout(consumer, connected_frame, message_frame_v12, caplog):
+    """Check that the consumer disconnects anyway when the messages in flight take too long."""
+    consumer._drain_timeout = 0.1
+    transport = consumer.stomp._transportFactory.return_value
+    transport.messages.extend([connected_frame, message_frame_v12])
+
+    def _on_message(body, headers, on_published):
+        consumer.stop()
+
+    consumer.relay.on_stomp_message.side_effect = _on_message
+    consumer.consume()
+    sent_frames = [call[0][0] for call in transport.send.call_args_list]
+    assert StompSpec.ACK not in [frame.command for frame in sent_frames]
+    assert sent_frames[-1].command == StompSpec.DISCONNECT
+    assert "1 messages were not published after 0.1s" in caplog.text
+    # Don't leak the message in flight to the other tests
+    consumer.flow.release()
+
+
+def test_receive_lock(consumer, connected_frame, message_frame):
+    """Check that the socket is only read with the lock held, and polled without it."""
+    transport = consumer.stomp._transportFactory.return_value
+    transport.messages.extend([connected_frame, message_frame])
+    locked_when = {"poll": set(), "receive": set()}
+
+    def _can_read(timeout=None):
+        if timeout:
+            locked_when["poll"].add(consumer._stomp_lock.locked())
+        return True
+
+    def _receive():
+        frame = transport.messages.pop(0)
+        # The CONNECTED frame is read before the other threads start
+        if frame.command == StompSpec.MESSAGE:
+            locked_when["receive"].add(consumer._stomp_lock.locked())
+        return frame
+
+    transport.canRead.side_effect = _can_read
+    transport.receive.side_effect = _receive
+    consumer.consume()
+    assert locked_when == {"poll": {False}, "receive": {True}}
+
+
+def test_dump_profile(consumer, connected_frame, message_frame, mocker):
+    """Check that the profile is dumped from the receive loop after tracing is switched off."""
+    dump_profile = mocker.patch.object(consumer.tracer, "dump_profile")
+    consumer.tracer.toggle()
+    consumer.tracer.toggle()
+    dump_profile.assert_not_called()
+    transport = consumer.stomp._transportFactory.return_value
+    transport.messages.extend([connected_frame, message_frame])
+    consumer.consume()
+    dump_profile.assert_called_once_with()
+
+
+def test_ssl_context(mocker):
+    create_default_context = mocker.patch("ssl.create_default_context")
+    assert make_ssl_context({"ssl_crt": "/path/to/cert.crt"}) is None
+    context = make_ssl_context({"ssl_crt": "/path/to/cert.crt", "ssl_key": "/path/to/cert.key"})
+    assert context is create_default_context.return_value
+    context.load_cert_chain.assert_called_once_with("/path/to/cert.crt", "/path/to/cert.key")
@@ -0,0 +1,68 @@
+""" Tests for bugzilla2fedmsg.decode. """
+
+import importlib
+import json
+import sys
+import types
+
+import pytest
+
+import bugzilla2fedmsg.decode
+from bugzilla2fedmsg.decode import BACKENDS, find_bug_id, get_decoder
+
+
+@pytest.fixture
+def fake_msgspec(monkeypatch):
+    """Reload the decode module with a stand-in for msgspec, which isn't always installed."""
+
+    class DecodeError(Exception):
+        pass
+
+    def decode(data):
+        try:
+            return json.loads(data)
+        except json.JSONDecodeError as e:
+            raise DecodeError(str(e)) from None
+
+    msgspec = types.ModuleType("msgspec")
+    msgspec.DecodeError = DecodeError
+    msgspec.json = types.SimpleNamespace(decode=decode)
+    monkeypatch.setitem(sys.modules, "msgspec", msgspec)
+    yield importlib.reload(bugzilla2fedmsg.decode)
+    monkeypatch.undo()
+    importlib.reload(bugzilla2fedmsg.decode)
+
+
+@pytest.mark.parametrize("backend", list(BACKENDS))
+def test_decode(backend, bug_create_message):
+    decode = get_decoder(backend)
+    data = json.dumps(bug_create_message["body"]).encode()
+    assert decode(data) == bug_create_message["body"]
+    with pytest.raises(ValueError):
+        decode(b"{not json")
+
+
+def test_msgspec(fake_msgspec, bug_create_message):
+    decode = fake_msgspec.get_decoder("msgspec")
+    data = json.dumps(bug_create_message["body"]).encode()
+    assert decode(data) == bug_create_message["body"]
+    # The decoding errors are raised as ValueError like with the other backends
+    with pytest.raises(ValueError):
+        decode(b"{not json")
+
+
+def test_auto():
+    backends = bugzilla2fedmsg.decode.BACKENDS
+    assert bugzilla2fedmsg.decode.get_decoder() is next(iter(backends.values()))
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError, match="The 'dummy' JSON backend is not available"):
+        get_decoder("dummy")
+
+
+def test_find_bug_id(comment_create_message):
+    data = json.dumps(comment_create_message["body"]).encode()
+    assert find_bug_id(data) == 1691487
+    assert find_bug_id(b'{"event": {"bug_id" : 42}}') == 42
+    assert find_bug_id(b"true") is None
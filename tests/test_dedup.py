@@ -0,0 +1,125 @@
+""" Tests for bugzilla2fedmsg.dedup. """
+
+import pytest
+
+from bugzilla2fedmsg.dedup import CLAIMED, DedupIndex, IN_FLIGHT, RELAYED
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def _headers(msg_id, correlation_id=None):
+    headers = {"message-id": msg_id}
+    if correlation_id is not None:
+        headers["correlation-id"] = correlation_id
+    return headers
+
+
+def test_duplicate(clock):
+    index = DedupIndex(clock=clock)
+    assert index.claim(_headers("1")) == CLAIMED
+    # Being relayed
+    assert index.claim(_headers("1")) == IN_FLIGHT
+    index.release(_headers("1"), done=True)
+    # Relayed
+    assert index.claim(_headers("1")) == RELAYED
+    assert index.claim(_headers("2")) == CLAIMED
+
+
+def test_not_done(clock):
+    index = DedupIndex(clock=clock)
+    assert index.claim(_headers("1")) == CLAIMED
+    index.release(_headers("1"), done=False)
+    # The redelivery must be relayed
+    assert index.claim(_headers("1")) == CLAIMED
+    assert len(index) == 0
+
+
+@pytest.mark.parametrize("done", [True, False])
+def test_wait_in_flight(clock, done):
+    """Check that the copies of a message being relayed are told when it is released."""
+    index = DedupIndex(clock=clock)
+    released = []
+    assert index.claim(_headers("1")) == CLAIMED
+    assert index.claim(_headers("1"), on_released=released.append) == IN_FLIGHT
+    assert index.claim(_headers("1"), on_released=released.append) == IN_FLIGHT
+    assert released == []
+    index.release(_headers("1"), done=done)
+    assert released == [done, done]
+    assert index.claim(_headers("1")) == (RELAYED if done else CLAIMED)
+
+
+def test_correlation_id(clock):
+    index = DedupIndex(clock=clock)
+    assert index.claim(_headers("1", "event-1")) == CLAIMED
+    index.release(_headers("1", "event-1"), done=True)
+    # Same Bugzilla event, new message ID after a failover
+    assert index.claim(_headers("2", "event-1")) == RELAYED
+
+
+def test_no_key(clock):
+    index = DedupIndex(clock=clock)
+    assert index.claim({}) == CLAIMED
+    index.release({}, done=True)
+    assert index.claim({}) == CLAIMED
+
+
+def test_window(clock):
+    index = DedupIndex(window=60, clock=clock)
+    for msg_id in ("1", "2"):
+        index.claim(_headers(msg_id))
+        index.release(_headers(msg_id), done=True)
+        clock.now += 30
+    assert index.claim(_headers("2")) == RELAYED
+    # The first one has expired
+    assert index.claim(_headers("1")) == CLAIMED
+    assert len(index) == 1
+
+
+def test_size(clock):
+    index = DedupIndex(size=2, clock=clock)
+    for msg_id in ("1", "2", "3"):
+        index.claim(_headers(msg_id))
+        index.release(_headers(msg_id), done=True)
+    assert len(index) == 2
+    assert index.claim(_headers("1")) == CLAIMED
+    assert index.claim(_headers("3")) == RELAYED
+
+
+def test_persistence(clock, tmp_path):
+    path = str(tmp_path / "dedup.sqlite")
+    index = DedupIndex(window=60, path=path, clock=clock)
+    for msg_id in ("1", "2"):
+        index.claim(_headers(msg_id))
+        index.release(_headers(msg_id), done=True)
+        clock.now += 30
+    index.close()
+    index = DedupIndex(window=60, path=path, clock=clock)
+    assert len(index) == 1
+    assert index.claim(_headers("2")) == RELAYED
+    assert index.claim(_headers("1")) == CLAIMED
+    index.close()
+
+
+def test_prune(clock, tmp_path, monkeypatch):
+    """Check that the expired messages are deleted from the database now and then."""
+    monkeypatch.setattr("bugzilla2fedmsg.dedup.PRUNE_EVERY", 2)
+    index = DedupIndex(window=60, path=str(tmp_path / "dedup.sqlite"), clock=clock)
+    for msg_id in ("1", "2", "3", "4"):
+        index.claim(_headers(msg_id))
+        index.release(_headers(msg_id), done=True)
+        clock.now += 50
+    rows = index._db.execute("SELECT key FROM seen ORDER BY key").fetchall()
+    # Pruned when the 4th was added
+    assert rows == [("3",), ("4",)]
+    index.close()
@@ -0,0 +1,57 @@
+""" Tests for bugzilla2fedmsg.flow. """
+
+import threading
+
+import pytest
+from prometheus_client import REGISTRY
+
+from bugzilla2fedmsg.flow import FlowControl
+
+
+def _paused():
+    return REGISTRY.get_sample_value("bugzilla2fedmsg_receive_paused")
+
+
+def test_water_marks():
+    flow = FlowControl(high_water=3, low_water=1)
+    for _index in range(2):
+        flow.acquire()
+    assert not flow.paused
+    assert flow.wait(0)
+    flow.acquire()
+    assert flow.paused
+    assert _paused() == 1
+    assert not flow.wait(0)
+    flow.release()
+    # Still above the low water mark
+    assert flow.paused
+    flow.release()
+    assert not flow.paused
+    assert _paused() == 0
+    assert flow.in_flight == 1
+
+
+def test_wait():
+    flow = FlowControl(high_water=1, low_water=0)
+    flow.acquire()
+    timer = threading.Timer(0.05, flow.release)
+    timer.start()
+    assert flow.wait(5)
+    timer.join()
+
+
+def test_invalid_water_marks():
+    with pytest.raises(ValueError, match="must be lower than the high water mark"):
+        FlowControl(high_water=10, low_water=10)
+
+
+def test_drain():
+    flow = FlowControl(high_water=10, low_water=5)
+    assert flow.drain(0)
+    for _index in range(2):
+        flow.acquire()
+    assert not flow.drain(0)
+    timer = threading.Timer(0.05, lambda: [flow.release() for _index in range(2)])
+    timer.start()
+    assert flow.drain(5)
+    timer.join()
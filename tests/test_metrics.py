@@ -0,0 +1,177 @@
+""" Tests for bugzilla2fedmsg.metrics. """
+
+import os
+import subprocess
+import sys
+import time
+from unittest import mock
+
+import fedora_messaging.exceptions
+import prometheus_client
+import pytest
+from prometheus_client import REGISTRY
+
+import bugzilla2fedmsg.relay
+from bugzilla2fedmsg import metrics
+
+
+def _value(name, **labels):
+    return REGISTRY.get_sample_value(f"bugzilla2fedmsg_{name}", labels) or 0
+
+
+@pytest.fixture
+def testrelay(fakefasjson):
+    return bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+        }
+    )
+
+
+def test_relay_published(testrelay, fakepublish, bug_create_message):
+    published = _value("messages_published_total")
+    publish_count = _value("publish_seconds_count")
+    lookup_count = _value("fasjson_lookup_seconds_count")
+    testrelay.on_stomp_message(bug_create_message["body"], bug_create_message["headers"])
+    assert _value("messages_published_total") == published + 1
+    assert _value("publish_seconds_count") == publish_count + 1
+    assert _value("fasjson_lookup_seconds_count") == lookup_count + 2
+    assert _value("fasjson_cache_size") == 2
+
+
+def test_relay_dropped(testrelay, fakepublish, private_message, other_product_message):
+    private = _value("messages_dropped_total", reason="private")
+    product = _value("messages_dropped_total", reason="product")
+    testrelay.on_stomp_message(private_message["body"], private_message["headers"])
+    testrelay.on_stomp_message(other_product_message["body"], other_product_message["headers"])
+    assert _value("messages_dropped_total", reason="private") == private + 1
+    assert _value("messages_dropped_total", reason="product") == product + 1
+
+
+@pytest.mark.parametrize(
+    "error,metric",
+    [
+        (fedora_messaging.exceptions.PublishReturned("oops!"), "messages_rejected_total"),
+        (fedora_messaging.exceptions.ConnectionException("oops!"), "messages_failed_total"),
+    ],
+)
+def test_relay_publish_errors(testrelay, fakepublish, bug_create_message, error, metric):
+    fakepublish.side_effect = error
+    before = _value(metric)
+    published = _value("messages_published_total")
+    testrelay.on_stomp_message(bug_create_message["body"], bug_create_message["headers"])
+    assert _value(metric) == before + 1
+    assert _value("messages_published_total") == published
+
+
+def test_start_http_server():
+    with mock.patch("prometheus_client.start_http_server") as start_http_server:
+        metrics.start_http_server({})
+        start_http_server.assert_not_called()
+        metrics.start_http_server({"port": 9090, "address": "127.0.0.1"})
+    start_http_server.assert_called_once_with(9090, addr="127.0.0.1")
+
+
+def test_start_http_server_multiprocess(monkeypatch, tmp_path):
+    monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+    with pytest.raises(RuntimeError, match="PROMETHEUS_MULTIPROC_DIR"):
+        metrics.start_http_server({"port": 9090}, multiprocess_mode=True)
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    with mock.patch("prometheus_client.start_http_server") as start_http_server:
+        metrics.start_http_server({"port": 9090}, multiprocess_mode=True)
+    registry = start_http_server.call_args.kwargs["registry"]
+    assert registry is not prometheus_client.REGISTRY
+
+
+def test_mark_process_dead(tmp_path):
+    """Check that the gauges of a relay process that exited are discarded."""
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+    child = subprocess.run(  # noqa: S603
+        [
+            sys.executable,
+            "-c",
+            "import os; from bugzilla2fedmsg import metrics; "
+            "metrics.FRAMES_IN_FLIGHT.set(3); metrics.RECEIVE_PAUSED.set(1); print(os.getpid())",
+        ],
+        env=env,
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    pid = int(child.stdout)
+    registry = prometheus_client.CollectorRegistry()
+    prometheus_client.multiprocess.MultiProcessCollector(registry, path=str(tmp_path))
+    assert registry.get_sample_value("bugzilla2fedmsg_frames_in_flight") == 3
+    assert registry.get_sample_value("bugzilla2fedmsg_receive_paused") == 1
+    with mock.patch.dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path)):
+        metrics.mark_process_dead(pid)
+    assert registry.get_sample_value("bugzilla2fedmsg_frames_in_flight") is None
+    assert registry.get_sample_value("bugzilla2fedmsg_receive_paused") is None
+
+
+def test_set_function_multiprocess(tmp_path):
+    """Check that the gauges computed by a function are written in multiprocess mode."""
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+    subprocess.run(  # noqa: S603
+        [
+            sys.executable,
+            "-c",
+            "from bugzilla2fedmsg import metrics; "
+            "metrics.set_function(metrics.OUTBOX_DEPTH, lambda: 7); "
+            "metrics.set_function(metrics.WORKER_LANE_DEPTH.labels(lane='0'), lambda: 2); "
+            "metrics.sample_gauges()",
+        ],
+        env=env,
+        check=True,
+    )
+    registry = prometheus_client.CollectorRegistry()
+    prometheus_client.multiprocess.MultiProcessCollector(registry, path=str(tmp_path))
+    assert registry.get_sample_value("bugzilla2fedmsg_outbox_depth") == 7
+    assert registry.get_sample_value("bugzilla2fedmsg_worker_lane_depth", {"lane": "0"}) == 2
+
+
+def test_sampler(monkeypatch):
+    """Check that the gauges computed by a function are set by a thread in multiprocess mode."""
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", "/nonexistent")
+    monkeypatch.setattr(metrics, "SAMPLE_INTERVAL", 0.01)
+    monkeypatch.setattr(metrics, "_sampler", None)
+    monkeypatch.setattr(metrics, "_sampled_gauges", {})
+    registry = prometheus_client.CollectorRegistry()
+    gauge = prometheus_client.Gauge("test_sampler", "Test gauge", registry=registry)
+    metrics.set_function(gauge, lambda: 3)
+    deadline = time.monotonic() + 5
+    while registry.get_sample_value("test_sampler") != 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert registry.get_sample_value("test_sampler") == 3
+    assert metrics._sampler.name == "metrics"
+
+
+def test_sample_gauges_error(monkeypatch, caplog):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", "/nonexistent")
+    gauge = prometheus_client.Gauge("test_sampled", "Test gauge", registry=None)
+    # Don't start the sampling thread
+    monkeypatch.setattr(metrics, "_sampler", mock.Mock(**{"is_alive.return_value": True}))
+    monkeypatch.setattr(metrics, "_sampled_gauges", {})
+    metrics.set_function(gauge, lambda: 1 / 0)
+    metrics.sample_gauges()
+    assert "Could not compute a gauge" in caplog.text
+
+
+def test_mark_process_dead_single_process(monkeypatch):
+    monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+    with mock.patch("prometheus_client.multiprocess.mark_process_dead") as mark_process_dead:
+        metrics.mark_process_dead(1234)
+    mark_process_dead.assert_not_called()
+
+
+def test_noop_metric():
+    metric = metrics._NoopMetric()
+    assert metric.labels(reason="private") is metric
+    metric.inc()
+    metric.dec()
+    metric.set(1)
+    metric.set_function(len)
+    metric.observe(1)
+    with metric.time():
+        pass
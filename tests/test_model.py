@@ -0,0 +1,39 @@
+""" Tests for bugzilla2fedmsg.model. """
+
+from bugzilla2fedmsg.model import BugzillaMessage
+
+
+def test_from_stomp_bug(bug_create_message):
+    body = bug_create_message["body"]
+    message = BugzillaMessage.from_stomp("bug", body, bug_create_message["headers"])
+    assert message.bug is body["bug"]
+    assert message.event is body["event"]
+    assert message.payload is None
+
+
+def test_from_stomp_object(comment_create_message):
+    body = comment_create_message["body"]
+    bug = body["comment"]["bug"]
+    message = BugzillaMessage.from_stomp("comment", body, comment_create_message["headers"])
+    assert message.bug is bug
+    assert message.payload is body["comment"]
+    assert "bug" not in message.payload
+
+
+def test_to_body(comment_create_message):
+    message = BugzillaMessage.from_stomp(
+        "comment", comment_create_message["body"], comment_create_message["headers"]
+    )
+    message.agent_email = "smooge@redhat.com"
+    message.emails = ["awilliam@redhat.com", "unknown@example.com"]
+    assert message.all_emails == {
+        "smooge@redhat.com",
+        "awilliam@redhat.com",
+        "unknown@example.com",
+    }
+    body = message.to_body(
+        {"smooge@redhat.com": None, "awilliam@redhat.com": "adamw", "unknown@example.com": None}
+    )
+    assert list(body) == ["bug", "event", "headers", "comment", "agent_name", "usernames"]
+    assert body["agent_name"] is None
+    assert body["usernames"] == ["adamw"]
@@ -0,0 +1,103 @@
+""" Tests for bugzilla2fedmsg.outbox. """
+
+import time
+from unittest import mock
+
+import pytest
+from fedora_messaging.message import Message
+
+from bugzilla2fedmsg.outbox import Outbox, OutboxDrainer, OutboxFull
+
+
+def _message(index):
+    return Message(topic="bugzilla.bug.update", body={"index": index})
+
+
+def test_outbox(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"), max_size=2)
+    first, second = _message(1), _message(2)
+    outbox.append(first)
+    outbox.append(second)
+    assert len(outbox) == 2
+    with pytest.raises(OutboxFull):
+        outbox.append(_message(3))
+    rows = outbox.peek()
+    assert [message.id for _row_id, message in rows] == [first.id, second.id]
+    assert rows[0][1].body == {"index": 1}
+    outbox.remove(rows[0][0])
+    assert len(outbox) == 1
+    outbox.sync()
+    outbox.close()
+    # The messages are kept across restarts
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"))
+    assert len(outbox) == 1
+    assert outbox.peek()[0][1].id == second.id
+    outbox.close()
+
+
+def test_drain(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"))
+    messages = [_message(index) for index in range(5)]
+    for message in messages:
+        outbox.append(message)
+    published = []
+
+    def _publish(message):
+        if len(published) == 3 and not failed:
+            failed.append(message)
+            raise ConnectionError("The broker is down")
+        published.append(message.id)
+
+    failed = []
+    drainer = OutboxDrainer(outbox, _publish, batch_size=2)
+    # Stops at the first failure, and starts again with the same message
+    assert drainer.drain() == 3
+    assert len(outbox) == 2
+    assert drainer.drain() == 2
+    assert published == [message.id for message in messages]
+    assert len(outbox) == 0
+    outbox.close()
+
+
+def test_drainer_thread(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"))
+    outbox.append(_message(1))
+    publish = mock.Mock(name="publish")
+    drainer = OutboxDrainer(outbox, publish, interval=0.01)
+    drainer.start()
+    for _attempt in range(500):
+        if not len(outbox):
+            break
+        time.sleep(0.01)
+    drainer.stop()
+    publish.assert_called_once()
+    assert len(outbox) == 0
+    outbox.close()
+
+
+def test_drainer_stop(tmp_path):
+    """Check that draining stops in the middle of a batch when the drainer is stopped."""
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"))
+    for index in range(3):
+        outbox.append(_message(index))
+    drainer = OutboxDrainer(outbox, lambda message: drainer._stopping.set())
+    assert drainer.drain() == 1
+    assert len(outbox) == 2
+    # Stopping a drainer that wasn't started does nothing
+    drainer.stop()
+    outbox.close()
+
+
+def test_drainer_thread_error(caplog):
+    """Check that the drainer thread keeps running when the outbox fails."""
+    outbox = mock.Mock(name="outbox")
+    outbox.sync.side_effect = OSError("disk full")
+    drainer = OutboxDrainer(outbox, mock.Mock(name="publish"), interval=0.01)
+    drainer.start()
+    for _attempt in range(500):
+        if outbox.sync.call_count >= 2:
+            break
+        time.sleep(0.01)
+    drainer.stop()
+    assert outbox.sync.call_count >= 2
+    assert "Could not drain the outbox" in caplog.text
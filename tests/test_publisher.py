@@ -0,0 +1,99 @@
+""" Tests for bugzilla2fedmsg.publisher. """
+
+import contextvars
+import threading
+from unittest import mock
+
+import pytest
+
+from bugzilla2fedmsg.publisher import Publisher
+
+
+@pytest.fixture
+def publish():
+    return mock.Mock(name="publish")
+
+
+def test_publish(publish):
+    publisher = Publisher(publish, in_flight=2)
+    publisher.start()
+    callback = mock.Mock(name="callback")
+    publisher.submit("message", callback)
+    publisher.stop()
+    publish.assert_called_once_with("message")
+    callback.assert_called_once_with(None)
+
+
+def test_publish_error(publish):
+    error = ValueError("oops")
+    publish.side_effect = error
+    publisher = Publisher(publish, in_flight=1)
+    publisher.start()
+    callback = mock.Mock(name="callback")
+    publisher.submit("message", callback)
+    publisher.stop()
+    callback.assert_called_once_with(error)
+
+
+def test_publish_in_flight(publish):
+    # The two messages can only be published if they are waiting for each
+    # other at the same time.
+    barrier = threading.Barrier(2, timeout=5)
+    publish.side_effect = lambda message: barrier.wait()
+    publisher = Publisher(publish, in_flight=2)
+    publisher.start()
+    callback = mock.Mock(name="callback")
+    publisher.submit("message1", callback)
+    publisher.submit("message2", callback)
+    publisher.stop()
+    assert callback.call_args_list == [mock.call(None), mock.call(None)]
+
+
+def test_callback_error(publish, caplog):
+    publisher = Publisher(publish, in_flight=1)
+    publisher.start()
+    message = mock.Mock(name="message", id="msgid")
+    publisher.submit(message, mock.Mock(side_effect=ValueError("oops")))
+    callback = mock.Mock(name="callback")
+    publisher.submit(message, callback)
+    publisher.stop()
+    assert "Error in the callback for message msgid" in caplog.text
+    # The publisher is still working
+    callback.assert_called_once_with(None)
+
+
+def test_context(publish):
+    """Check that messages are published in the context they were submitted in."""
+    var = contextvars.ContextVar("var", default=None)
+    seen = []
+    publish.side_effect = lambda message: seen.append(var.get())
+    publisher = Publisher(publish, in_flight=1)
+    publisher.start()
+    var.set("value")
+    publisher.submit("message", lambda error: seen.append(var.get()))
+    publisher.stop()
+    assert seen == ["value", "value"]
+
+
+def test_publish_ordering(publish):
+    """Check that the messages with the same key are published in order."""
+    first_published = threading.Event()
+    published = []
+
+    def _publish(message):
+        if message == "bug1-a":
+            # The other key is published meanwhile
+            assert first_published.wait(5)
+        elif message == "bug2":
+            first_published.set()
+        published.append(message)
+
+    publish.side_effect = _publish
+    publisher = Publisher(publish, in_flight=2)
+    publisher.start()
+    callback = mock.Mock(name="callback")
+    publisher.submit("bug1-a", callback, key=1)
+    publisher.submit("bug2", callback, key=2)
+    publisher.submit("bug1-b", callback, key=1)
+    publisher.stop()
+    assert published == ["bug2", "bug1-a", "bug1-b"]
@@ -4,11 +4,22 @@ Authors:    Adam Williamson <awilliam@redhat.com>
 
 """
 
+import asyncio
+import copy
+import json
+import os
+import sqlite3
+import threading
+from unittest import mock
+
 import fedora_messaging.exceptions
 import pytest
 
+import bugzilla2fedmsg.outbox
 import bugzilla2fedmsg.relay
 
+from .conftest import FIXTURES_DIR, load_message
+
 
 @pytest.fixture
 def testrelay(fakefasjson):
@@ -126,6 +137,7 @@ def test_private_drop(testrelay, fakepublish, private_message):
     """Check that we drop (don't publish) a private message."""
     testrelay.on_stomp_message(private_message["body"], private_message["headers"])
     assert fakepublish.call_count == 0
+    assert testrelay.dropped == {"private": 1}
 
 
 def test_other_product_drop(testrelay, fakepublish, other_product_message):
@@ -136,6 +148,17 @@ def test_other_product_drop(testrelay, fakepublish, other_product_message):
     """
     testrelay.on_stomp_message(other_product_message["body"], other_product_message["headers"])
     assert fakepublish.call_count == 0
+    assert testrelay.dropped == {"product": 1}
+
+
+def test_other_product_drop_early(testrelay, fakepublish, other_product_message, mocker):
+    """Check that messages for other products are dropped before their
+    dates are converted.
+    """
+    convert_datetimes = mocker.patch("bugzilla2fedmsg.relay.convert_datetimes")
+    testrelay.on_stomp_message(other_product_message["body"], other_product_message["headers"])
+    assert fakepublish.call_count == 0
+    convert_datetimes.assert_not_called()
 
 
 def test_bz4_compat(
@@ -241,3 +264,591 @@ def test_needinfo_bad(testrelay, fakepublish, bug_modify_message_four_changes):
     except IndexError as e:
         pytest.fail(e)
     assert fakepublish.call_count == 1
+
+
+def test_fasjson_cache(testrelay, fakepublish, fakefasjson, bug_create_message):
+    """Check that FASJSON lookups are cached between messages."""
+    second_message = copy.deepcopy(bug_create_message)
+    testrelay.on_stomp_message(bug_create_message["body"], bug_create_message["headers"])
+    assert fakefasjson.search.call_count == 2
+    fakefasjson.search.reset_mock()
+    testrelay.on_stomp_message(second_message["body"], second_message["headers"])
+    assert fakefasjson.search.call_count == 0
+    assert fakepublish.call_count == 2
+    assert fakepublish.call_args[0][0].body["usernames"] == ["dgunchev", "lv"]
+    assert testrelay._fasjson_cache.hits == 2
+
+
+def test_fasjson_concurrent_lookups(fakefasjson, fakepublish, bug_create_message):
+    """Check that the FASJSON lookups for a message are run concurrently."""
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "fasjson_workers": 2,
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+        }
+    )
+    # The two lookups (reporter and assignee) can only succeed if they are
+    # waiting for each other at the same time.
+    barrier = threading.Barrier(2, timeout=5)
+    search = fakefasjson.search.side_effect
+
+    def _search(rhbzemail):
+        barrier.wait()
+        return search(rhbzemail)
+
+    fakefasjson.search.side_effect = _search
+    relay.on_stomp_message(bug_create_message["body"], bug_create_message["headers"])
+    assert fakefasjson.search.call_count == 2
+    assert fakepublish.call_count == 1
+    message = fakepublish.call_args[0][0]
+    assert message.body["agent_name"] == "dgunchev"
+    assert message.body["usernames"] == ["dgunchev", "lv"]
+
+
+def test_fasjson_sequential_lookups(fakefasjson, fakepublish, bug_create_message):
+    """Check that the FASJSON lookups can be run without a thread pool."""
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "fasjson_workers": 1,
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+        }
+    )
+    assert relay._fasjson_pool is None
+    relay.on_stomp_message(bug_create_message["body"], bug_create_message["headers"])
+    assert fakepublish.call_count == 1
+    message = fakepublish.call_args[0][0]
+    assert message.body["usernames"] == ["dgunchev", "lv"]
+
+
+@pytest.fixture
+def asyncrelay(fakefasjson):
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+            "publisher": {"in_flight": 2},
+        }
+    )
+    yield relay
+    relay.close()
+
+
+def test_async_publish(asyncrelay, fakepublish, bug_create_message):
+    """Check that messages can be published in another thread."""
+    published = threading.Event()
+    on_published = mock.Mock(side_effect=lambda error: published.set())
+    asyncrelay.on_stomp_message(
+        bug_create_message["body"], bug_create_message["headers"], on_published=on_published
+    )
+    assert published.wait(5)
+    assert fakepublish.call_count == 1
+    on_published.assert_called_once_with(None)
+
+
+def test_async_publish_error(asyncrelay, fakepublish, bug_create_message):
+    """Check that publishing errors are passed to the callback."""
+    error = fedora_messaging.exceptions.PublishTimeout("oops!")
+    fakepublish.side_effect = error
+    on_published = mock.Mock()
+    asyncrelay.on_stomp_message(
+        bug_create_message["body"], bug_create_message["headers"], on_published=on_published
+    )
+    asyncrelay.close()
+    on_published.assert_called_once_with(error)
+
+
+def test_async_publish_drop(asyncrelay, fakepublish, private_message):
+    """Check that dropped messages are reported as done straight away."""
+    on_published = mock.Mock()
+    asyncrelay.on_stomp_message(
+        private_message["body"], private_message["headers"], on_published=on_published
+    )
+    on_published.assert_called_once_with(None)
+    assert fakepublish.call_count == 0
+
+
+def test_sync_publish_callback(testrelay, fakepublish, bug_create_message):
+    """Check that the callback is called before returning without a publisher."""
+    on_published = mock.Mock()
+    testrelay.on_stomp_message(
+        bug_create_message["body"], bug_create_message["headers"], on_published=on_published
+    )
+    assert fakepublish.call_count == 1
+    on_published.assert_called_once_with(None)
+
+
+def test_on_stomp_message_async(testrelay, fakepublish, fakefasjson, bug_create_message):
+    """Check that the asyncio variant publishes the same message."""
+    asyncio.run(
+        testrelay.on_stomp_message_async(bug_create_message["body"], bug_create_message["headers"])
+    )
+    assert fakepublish.call_count == 1
+    message = fakepublish.call_args[0][0]
+    assert message.topic == "bugzilla.bug.new"
+    assert message.body["agent_name"] == "dgunchev"
+    assert message.body["usernames"] == ["dgunchev", "lv"]
+    assert fakefasjson.search.call_count == 2
+
+
+def test_on_stomp_message_async_drop(testrelay, fakepublish, private_message):
+    """Check that the asyncio variant drops the messages that are out of scope."""
+    asyncio.run(
+        testrelay.on_stomp_message_async(private_message["body"], private_message["headers"])
+    )
+    assert fakepublish.call_count == 0
+    assert testrelay.dropped["private"] == 1
+
+
+def test_on_stomp_message_async_fasjson_down(
+    testrelay, fakepublish, fakefasjson, bug_create_message
+):
+    """Check that the asyncio variant flags the messages whose users could not be looked up."""
+    fakefasjson.search.side_effect = ValueError("FASJSON is down")
+    asyncio.run(
+        testrelay.on_stomp_message_async(bug_create_message["body"], bug_create_message["headers"])
+    )
+    message = fakepublish.call_args[0][0]
+    assert message.body["usernames"] == []
+    assert message._headers[bugzilla2fedmsg.relay.DEGRADED_HEADER] is True
+
+
+def test_on_stomp_message_async_cached(testrelay, fakepublish, fakefasjson, bug_create_message):
+    """Check that cached addresses are not looked up again."""
+    testrelay.on_stomp_message(
+        copy.deepcopy(bug_create_message["body"]), bug_create_message["headers"]
+    )
+    fakefasjson.search.reset_mock()
+    asyncio.run(
+        testrelay.on_stomp_message_async(bug_create_message["body"], bug_create_message["headers"])
+    )
+    assert fakefasjson.search.call_count == 0
+    assert fakepublish.call_args[0][0].body["usernames"] == ["dgunchev", "lv"]
+
+
+def test_fasjson_cache_persistent(fakefasjson, fakepublish, bug_create_message, tmp_path):
+    """Check that the lookups survive a restart."""
+    config = {
+        "fasjson_url": "https://fasjson.example.com",
+        "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+        "fasjson_cache": {"path": str(tmp_path / "cache.sqlite")},
+    }
+    relay = bugzilla2fedmsg.relay.MessageRelay(config)
+    relay.on_stomp_message(copy.deepcopy(bug_create_message["body"]), bug_create_message["headers"])
+    relay.close()
+    assert fakefasjson.search.call_count == 2
+    fakefasjson.search.reset_mock()
+    relay = bugzilla2fedmsg.relay.MessageRelay(config)
+    relay.on_stomp_message(bug_create_message["body"], bug_create_message["headers"])
+    relay.close()
+    assert fakefasjson.search.call_count == 0
+    assert fakepublish.call_args[0][0].body["usernames"] == ["dgunchev", "lv"]
+
+
+def test_fasjson_cache_refresh(fakefasjson, fakepublish, bug_create_message):
+    """Check that the cache can be filled in the background."""
+    fakefasjson.list_all_entities.return_value = [
+        {"username": "dgunchev", "rhbzemail": "dgunchev@gmail.com"},
+        {"username": "lv", "rhbzemail": "lvrabec@redhat.com"},
+    ]
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+            "fasjson_cache": {"refresh_interval": 3000},
+        }
+    )
+    # Wait for the first refresh
+    relay._cache_refresher.stop()
+    relay.on_stomp_message(bug_create_message["body"], bug_create_message["headers"])
+    relay.close()
+    assert fakefasjson.search.call_count == 0
+    assert fakepublish.call_args[0][0].body["usernames"] == ["dgunchev", "lv"]
+
+
+def test_fasjson_cache_refresh_processes(fakefasjson, monkeypatch):
+    """Check that only the first relay process refreshes the cache."""
+    monkeypatch.setenv("BUGZILLA2FEDMSG_PROCESS", "1")
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "fasjson_cache": {"refresh_interval": 3000},
+        }
+    )
+    relay.close()
+    assert relay._cache_refresher is None
+    fakefasjson.list_all_entities.assert_not_called()
+
+
+def test_fasjson_down(fakefasjson, fakepublish, bug_create_message, tmp_path):
+    """Check that messages are published from the cache when FASJSON fails."""
+    store = bugzilla2fedmsg.relay.EmailStore(str(tmp_path / "cache.sqlite"))
+    # A lookup that expired long ago
+    store.update([("dgunchev@gmail.com", "dgunchev")])
+    store._db.execute("UPDATE emails SET updated_at = 0")
+    store.close()
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+            "fasjson_cache": {"path": str(tmp_path / "cache.sqlite"), "max_age": 10**10},
+            "fasjson_breaker": {"failure_threshold": 2},
+        }
+    )
+    fakefasjson.search.side_effect = ValueError("FASJSON is down")
+    relay.on_stomp_message(copy.deepcopy(bug_create_message["body"]), bug_create_message["headers"])
+    assert fakepublish.call_count == 1
+    message = fakepublish.call_args[0][0]
+    assert message.body["agent_name"] == "dgunchev"
+    assert message.body["usernames"] == ["dgunchev"]
+    assert message._headers[bugzilla2fedmsg.relay.DEGRADED_HEADER] is True
+    # The circuit is now open, FASJSON is not called anymore
+    assert fakefasjson.search.call_count == 2
+    relay.on_stomp_message(bug_create_message["body"], bug_create_message["headers"])
+    assert fakefasjson.search.call_count == 2
+    assert fakepublish.call_count == 2
+    relay.close()
+
+
+def test_fasjson_cache_error(fakefasjson, fakepublish, bug_create_message, tmp_path, caplog):
+    """Check that failing to store a lookup doesn't count as a FASJSON failure."""
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+            "fasjson_cache": {"path": str(tmp_path / "cache.sqlite")},
+            "fasjson_breaker": {"failure_threshold": 1},
+        }
+    )
+    store = relay._fasjson_cache.store
+    db = store._db
+
+    def _execute(sql, *args):
+        if sql.startswith("INSERT"):
+            raise sqlite3.OperationalError("database is locked")
+        return db.execute(sql, *args)
+
+    store._db = mock.Mock(wraps=db)
+    store._db.execute.side_effect = _execute
+    relay.on_stomp_message(bug_create_message["body"], bug_create_message["headers"])
+    message = fakepublish.call_args[0][0]
+    assert message.body["usernames"] == ["dgunchev", "lv"]
+    assert bugzilla2fedmsg.relay.DEGRADED_HEADER not in message._headers
+    assert relay._fasjson_breaker.is_closed
+    assert "Could not store the FAS username of" in caplog.text
+    relay.close()
+
+
+def test_fasjson_down_in_memory(fakefasjson, fakepublish, bug_create_message):
+    """Check that the expired lookups kept in memory are used when FASJSON fails."""
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+        }
+    )
+    relay.on_stomp_message(copy.deepcopy(bug_create_message["body"]), bug_create_message["headers"])
+    # The lookups expire
+    entries = relay._fasjson_cache._entries
+    for email, (username, _expires_at) in list(entries.items()):
+        entries[email] = (username, 0)
+    fakefasjson.search.side_effect = ValueError("FASJSON is down")
+    relay.on_stomp_message(bug_create_message["body"], bug_create_message["headers"])
+    message = fakepublish.call_args[0][0]
+    assert message.body["usernames"] == ["dgunchev", "lv"]
+    assert message._headers[bugzilla2fedmsg.relay.DEGRADED_HEADER] is True
+    relay.close()
+
+
+def test_fasjson_recovers(fakefasjson, fakepublish, bug_create_message):
+    """Check that FASJSON is used again once it recovers."""
+    # Sequential lookups: the other ones fail fast while the first one probes FASJSON
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+            "fasjson_workers": 1,
+        }
+    )
+    breaker = relay._fasjson_breaker
+    breaker.state = breaker.OPEN
+    breaker._opened_at = 0
+    relay.on_stomp_message(bug_create_message["body"], bug_create_message["headers"])
+    assert breaker.is_closed
+    message = fakepublish.call_args[0][0]
+    assert message.body["usernames"] == ["dgunchev", "lv"]
+    assert bugzilla2fedmsg.relay.DEGRADED_HEADER not in message._headers
+
+
+def test_coalesce(fakepublish, fakefasjson, bug_modify_message, comment_create_message):
+    """Check that messages about the same bug are relayed together, looking users up once."""
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+            "coalesce": {"window": 60000},
+        }
+    )
+    comment_create_message["body"]["comment"]["bug"] = copy.deepcopy(
+        bug_modify_message["body"]["bug"]
+    )
+    on_published = mock.Mock(name="on_published")
+    relay.on_stomp_message(bug_modify_message["body"], bug_modify_message["headers"], on_published)
+    relay.on_stomp_message(
+        comment_create_message["body"], comment_create_message["headers"], on_published
+    )
+    # Nothing is published before the window is over
+    assert fakepublish.call_count == 0
+    relay.close()
+
+    assert on_published.call_args_list == [mock.call(None), mock.call(None)]
+    topics = [call[0][0].body["event"]["routing_key"] for call in fakepublish.call_args_list]
+    assert topics == ["bug.modify", "comment.create"]
+    searched = [call.kwargs["rhbzemail"] for call in fakefasjson.search.call_args_list]
+    assert len(searched) == len(set(searched))
+
+
+def test_coalesce_publisher(fakepublish, fakefasjson, bug_modify_message):
+    """Check that the coalesced messages go through the publisher."""
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+            "coalesce": {"window": 60000},
+            "publisher": {"in_flight": 2},
+        }
+    )
+    on_published = mock.Mock(name="on_published")
+    relay.on_stomp_message(bug_modify_message["body"], bug_modify_message["headers"], on_published)
+    relay.close()
+    on_published.assert_called_once_with(None)
+    assert fakepublish.call_count == 1
+
+
+def test_relay_group_errors(
+    testrelay, fakepublish, fakefasjson, bug_modify_message, private_message
+):
+    """Check that each message of a group is reported as dropped or failed on its own."""
+    broken_message = copy.deepcopy(bug_modify_message)
+    del broken_message["body"]["event"]["user"]
+    error = fedora_messaging.exceptions.PublishTimeout("oops!")
+    fakepublish.side_effect = error
+    callbacks = [mock.Mock(name=f"on_published_{index}") for index in range(3)]
+    testrelay._relay_group(
+        [
+            (private_message["body"], private_message["headers"], callbacks[0]),
+            (broken_message["body"], broken_message["headers"], callbacks[1]),
+            (bug_modify_message["body"], bug_modify_message["headers"], callbacks[2]),
+        ]
+    )
+    callbacks[0].assert_called_once_with(None)
+    assert testrelay.dropped["private"] == 1
+    assert isinstance(callbacks[1].call_args[0][0], KeyError)
+    callbacks[2].assert_called_once_with(error)
+
+
+def test_coalesce_merge_cc(fakepublish, fakefasjson, bug_modify_message, private_message):
+    """Check that consecutive CC changes are published as one message."""
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+            "coalesce": {"window": 60000, "merge_cc": True},
+        }
+    )
+    second = copy.deepcopy(bug_modify_message)
+    second["body"]["event"]["changes"] = [
+        {"field": "cc", "added": "lvrabec@redhat.com", "removed": ""}
+    ]
+    on_published = mock.Mock(name="on_published")
+    relay.on_stomp_message(bug_modify_message["body"], bug_modify_message["headers"], on_published)
+    relay.on_stomp_message(second["body"], second["headers"], on_published)
+    # Private messages are dropped straight away
+    relay.on_stomp_message(private_message["body"], private_message["headers"], on_published)
+    assert on_published.call_count == 1
+    relay.close()
+
+    assert on_published.call_count == 3
+    assert fakepublish.call_count == 1
+    message = fakepublish.call_args[0][0]
+    assert message.body["event"]["changes"] == [
+        {
+            "field": "cc",
+            "field_name": "cc",
+            "added": "awilliam@redhat.com, lvrabec@redhat.com",
+            "removed": "",
+        }
+    ]
+
+
+def test_coalesce_group_error(fakepublish, fakefasjson, bug_modify_message, private_message):
+    """Check that the messages of a group that can't be relayed are all reported as failed."""
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+            "coalesce": {"window": 60000, "merge_cc": True},
+        }
+    )
+    second = copy.deepcopy(bug_modify_message)
+    # A CC change without the added addresses can't be merged
+    second["body"]["event"]["changes"] = [{"field": "cc", "removed": "lvrabec@redhat.com"}]
+    callbacks = [mock.Mock(name=f"on_published_{index}") for index in range(2)]
+    relay.on_stomp_message(bug_modify_message["body"], bug_modify_message["headers"], callbacks[0])
+    relay.on_stomp_message(second["body"], second["headers"], callbacks[1])
+    relay.close()
+
+    fakepublish.assert_not_called()
+    for callback in callbacks:
+        callback.assert_called_once()
+        assert isinstance(callback.call_args[0][0], KeyError)
+
+
+def test_relay_group_lookup_error(testrelay, fakepublish, private_message, bug_modify_message):
+    """Check that each message of a group is called back once when the lookups fail."""
+    callbacks = [mock.Mock(name=f"on_published_{index}") for index in range(2)]
+    error = OSError("disk I/O error")
+    with mock.patch.object(testrelay, "_emails_to_fas", side_effect=error):
+        testrelay._relay_group(
+            [
+                (private_message["body"], private_message["headers"], callbacks[0]),
+                (bug_modify_message["body"], bug_modify_message["headers"], callbacks[1]),
+            ]
+        )
+    fakepublish.assert_not_called()
+    for callback in callbacks:
+        callback.assert_called_once_with(error)
+
+
+def test_prefilter(testrelay, bug_create_message, other_product_message):
+    """Check that messages for other products are dropped from their raw body."""
+    data = json.dumps(bug_create_message["body"]).encode()
+    assert testrelay.prefilter(bug_create_message["headers"], data)
+    data = json.dumps(other_product_message["body"]).encode()
+    assert not testrelay.prefilter(other_product_message["headers"], data)
+    assert testrelay.dropped == {"product": 1}
+
+
+def test_prefilter_destination(testrelay, bug_create_message):
+    """Check that messages from other topics are dropped from their headers."""
+    headers = dict(bug_create_message["headers"], destination="/topic/VirtualTopic.eng.other")
+    assert not testrelay.prefilter(headers, b"{}")
+    assert testrelay.dropped == {"destination": 1}
+
+
+def test_prefilter_private(testrelay, private_message):
+    data = json.dumps(private_message["body"]).encode()
+    assert not testrelay.prefilter(private_message["headers"], data)
+    assert testrelay.dropped == {"private": 1}
+
+
+def test_prefilter_escaped_products(fakefasjson, bug_create_message):
+    """Check that the raw body is not filtered when the product names could be escaped."""
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "bugzilla": {"products": ["Fedora", "Fedora/Rawhide"]},
+        }
+    )
+    assert relay.prefilter(bug_create_message["headers"], b'{"bug": {}}')
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        "attachment_create",
+        "attachment_modify",
+        "bug_create",
+        "bug_modify",
+        "bug_modify_four_changes",
+        "comment_create",
+    ],
+)
+@pytest.mark.parametrize("bz4compat", [True, False])
+def test_published_body(fakefasjson, fakepublish, name, bz4compat):
+    """Check that the published bodies match the recorded ones, down to the order of the keys."""
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"], "bz4compat": bz4compat},
+        }
+    )
+    message = load_message(name)
+    relay.on_stomp_message(message["body"], message["headers"])
+    with open(os.path.join(FIXTURES_DIR, "published", f"{name}.json")) as f:
+        expected = json.load(f)["bz4compat" if bz4compat else "bz5"]
+    assert json.dumps(fakepublish.call_args[0][0].body) == json.dumps(expected)
+
+
+@pytest.fixture
+def outbox_relay(fakefasjson, tmp_path):
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+            # Only drain the outbox when the tests ask for it
+            "outbox": {"path": str(tmp_path / "outbox.sqlite"), "retry_interval": 3600},
+        }
+    )
+    yield relay
+    relay.close()
+
+
+def test_outbox(outbox_relay, fakepublish, bug_create_message, bug_modify_message):
+    """Check that messages are kept in the outbox while the broker is down, and published
+    in order once it is back.
+    """
+    fakepublish.side_effect = fedora_messaging.exceptions.ConnectionException("oops!")
+    outbox_relay.on_stomp_message(bug_create_message["body"], bug_create_message["headers"])
+    fakepublish.side_effect = None
+    # The broker is back, but the outbox must be emptied first
+    later_message = copy.deepcopy(bug_modify_message)
+    outbox_relay.on_stomp_message(bug_modify_message["body"], bug_modify_message["headers"])
+    assert fakepublish.call_count == 1
+    assert len(outbox_relay._outbox) == 2
+
+    assert outbox_relay._outbox_drainer.drain() == 2
+    topics = [call[0][0].topic for call in fakepublish.call_args_list[1:]]
+    assert topics == ["bugzilla.bug.new", "bugzilla.bug.update"]
+    assert len(outbox_relay._outbox) == 0
+    outbox_relay.on_stomp_message(later_message["body"], later_message["headers"])
+    assert fakepublish.call_count == 4
+
+
+def test_outbox_publish_timeout(outbox_relay, fakepublish, bug_create_message):
+    """Check that the message is kept in the outbox when publishing times out, as when the
+    broker is down.
+    """
+    fakepublish.side_effect = fedora_messaging.exceptions.PublishTimeout("oops!")
+    on_published = mock.Mock(name="on_published")
+    outbox_relay.on_stomp_message(
+        bug_create_message["body"], bug_create_message["headers"], on_published
+    )
+    on_published.assert_called_once_with(None)
+    assert len(outbox_relay._outbox) == 1
+    fakepublish.side_effect = None
+    assert outbox_relay._outbox_drainer.drain() == 1
+    assert fakepublish.call_args[0][0].topic == "bugzilla.bug.new"
+
+
+def test_outbox_rejected(outbox_relay, fakepublish, bug_create_message):
+    """Check that a message of the outbox that the broker rejects is dropped from it."""
+    fakepublish.side_effect = fedora_messaging.exceptions.ConnectionException("oops!")
+    outbox_relay.on_stomp_message(bug_create_message["body"], bug_create_message["headers"])
+    assert len(outbox_relay._outbox) == 1
+    fakepublish.side_effect = fedora_messaging.exceptions.PublishReturned("rejected")
+    assert outbox_relay._outbox_drainer.drain() == 1
+    assert len(outbox_relay._outbox) == 0
+
+
+def test_outbox_full(outbox_relay, fakepublish, bug_create_message):
+    """Check that the message is not acked when the outbox is full."""
+    outbox_relay._outbox.max_size = 0
+    fakepublish.side_effect = fedora_messaging.exceptions.ConnectionException("oops!")
+    on_published = mock.Mock(name="on_published")
+    with pytest.raises(bugzilla2fedmsg.outbox.OutboxFull):
+        outbox_relay.on_stomp_message(
+            bug_create_message["body"], bug_create_message["headers"], on_published
+        )
+    on_published.assert_not_called()
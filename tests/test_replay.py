@@ -0,0 +1,90 @@
+""" Tests for bugzilla2fedmsg.replay and the replay command. """
+
+import io
+import json
+
+import pytest
+from click.testing import CliRunner
+from fedora_messaging.message import loads
+
+import bugzilla2fedmsg.relay
+from bugzilla2fedmsg import cli
+from bugzilla2fedmsg.replay import FileSink, replay, ReplayStats
+
+
+CONFIG = """
+[consumer_config]
+fasjson_url = "https://fasjson.example.com"
+
+[consumer_config.bugzilla]
+products = ["Fedora", "Fedora EPEL"]
+"""
+
+
+@pytest.fixture
+def dump(bug_create_message, comment_create_message, private_message):
+    lines = [
+        json.dumps(message)
+        for message in (bug_create_message, comment_create_message, private_message)
+    ]
+    return "\n".join(lines) + "\n"
+
+
+@pytest.fixture
+def config_file(tmp_path, mocker):
+    # Don't let the command reconfigure the logging of the test session
+    mocker.patch("fedora_messaging.config.conf.setup_logging")
+    path = tmp_path / "config.toml"
+    path.write_text(CONFIG)
+    return str(path)
+
+
+def test_replay(fakefasjson, dump):
+    output = io.StringIO()
+    relay = bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+        },
+        sink=FileSink(output),
+    )
+    stats = replay(relay, io.StringIO(dump + "\nnot json\n"))
+    assert stats.read == 4
+    assert stats.dropped == 1
+    assert stats.errors == 1
+    assert stats.rate > 0
+    assert str(stats).startswith("Replayed 4 messages in ")
+    messages = loads(output.getvalue())
+    assert [message.topic for message in messages] == ["bugzilla.bug.new", "bugzilla.bug.update"]
+    assert messages[0].body["usernames"] == ["dgunchev", "lv"]
+
+
+def test_replay_stats_empty(fakefasjson):
+    relay = bugzilla2fedmsg.relay.MessageRelay({"fasjson_url": "https://fasjson.example.com"})
+    stats = replay(relay, [])
+    assert stats.read == 0
+    assert stats.rate == 0
+    # Nothing was timed yet
+    assert ReplayStats().rate == 0
+
+
+def test_replay_command(fakefasjson, fakepublish, config_file, dump, tmp_path):
+    input_path = tmp_path / "dump.jsonl"
+    input_path.write_text(dump)
+    output_path = tmp_path / "messages.jsonl"
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["-c", config_file, "replay", str(input_path), "-o", str(output_path)]
+    )
+    assert result.exit_code == 0, result.output
+    assert "Replayed 3 messages" in result.output
+    assert "1 dropped, 0 errors" in result.output
+    assert len(loads(output_path.read_text())) == 2
+    assert fakepublish.call_count == 0
+
+
+def test_replay_command_publish(fakefasjson, fakepublish, config_file, dump):
+    runner = CliRunner()
+    result = runner.invoke(cli, ["-c", config_file, "replay"], input=dump)
+    assert result.exit_code == 0, result.output
+    assert fakepublish.call_count == 2
@@ -0,0 +1,107 @@
+""" Tests for bugzilla2fedmsg.supervisor. """
+
+import os
+import signal
+import threading
+import time
+
+from bugzilla2fedmsg.supervisor import _run_child, process_slot, Supervisor
+
+
+def _record_pid(path):
+    with open(path, "a") as f:
+        f.write(f"{os.getpid()}\n")
+
+
+def test_restart(tmp_path):
+    """Check that the processes that exit are started again."""
+    pids_path = tmp_path / "pids"
+    exited = []
+
+    def _on_exit(pid):
+        exited.append(pid)
+        if len(exited) == 4:
+            supervisor.stop()
+
+    supervisor = Supervisor(
+        lambda: _record_pid(pids_path), processes=2, restart_delay=0, on_exit=_on_exit
+    )
+    supervisor.run()
+    started = [int(pid) for pid in pids_path.read_text().split()]
+    assert len(started) >= 4
+    assert len(set(started)) == len(started)
+    # The processes that were stopped may have been terminated before recording their pid
+    assert set(exited[:4]) <= set(started)
+
+
+def test_restart_delay(tmp_path):
+    """Check that the processes that exit are started again after the restart delay."""
+    exited_at = []
+
+    def _on_exit(pid):
+        exited_at.append(time.monotonic())
+        if len(exited_at) == 2:
+            supervisor.stop()
+
+    supervisor = Supervisor(lambda: None, processes=1, restart_delay=0.5, on_exit=_on_exit)
+    supervisor.run()
+    assert exited_at[1] - exited_at[0] >= 0.5
+
+
+def test_run_child(monkeypatch):
+    """Check that the relay process stops quietly on Ctrl-C, and knows its slot."""
+    monkeypatch.setenv("BUGZILLA2FEDMSG_PROCESS", "")
+    assert process_slot() == 0
+    previous_handlers = {
+        signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+    slots = []
+
+    def _target():
+        slots.append(process_slot())
+        assert signal.getsignal(signal.SIGTERM) is signal.default_int_handler
+        raise KeyboardInterrupt
+
+    try:
+        _run_child(_target, 3)
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+    assert slots == [3]
+
+
+def test_sigterm(tmp_path):
+    """Check that the processes are stopped when the supervisor receives SIGTERM."""
+    pids_path = tmp_path / "pids"
+
+    def _target():
+        _record_pid(pids_path)
+        time.sleep(60)
+
+    exited = []
+    supervisor = Supervisor(_target, processes=2, on_exit=exited.append)
+    timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM))
+    timer.start()
+    start = time.monotonic()
+    supervisor.run()
+    timer.join()
+    assert time.monotonic() - start < 10
+    assert sorted(exited) == sorted(int(pid) for pid in pids_path.read_text().split())
+    # The signal handlers are restored
+    assert signal.getsignal(signal.SIGTERM) is signal.SIG_DFL
+
+
+def test_kill(caplog):
+    """Check that the processes that don't stop in time are killed."""
+
+    def _target():
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        time.sleep(60)
+
+    supervisor = Supervisor(_target, processes=1, stop_timeout=0.2)
+    timer = threading.Timer(0.5, supervisor.stop)
+    timer.start()
+    supervisor.run()
+    timer.join()
+    assert "Relay process 0" in caplog.text
+    assert "did not stop, killing it" in caplog.text
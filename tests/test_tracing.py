@@ -0,0 +1,103 @@
+""" Tests for bugzilla2fedmsg.tracing. """
+
+import logging
+import pstats
+
+import pytest
+
+import bugzilla2fedmsg.relay
+from bugzilla2fedmsg.tracing import span, Tracer
+
+
+@pytest.fixture
+def testrelay(fakefasjson):
+    return bugzilla2fedmsg.relay.MessageRelay(
+        {
+            "fasjson_url": "https://fasjson.example.com",
+            "bugzilla": {"products": ["Fedora", "Fedora EPEL"]},
+        }
+    )
+
+
+def test_disabled():
+    tracer = Tracer({})
+    assert tracer.begin("msgid") is None
+    with tracer.activate(None):
+        with span("stage"):
+            pass
+
+
+def test_spans(testrelay, fakepublish, bug_create_message, caplog):
+    caplog.set_level(logging.INFO)
+    tracer = Tracer({"enabled": True})
+    trace = tracer.begin("msgid")
+    with tracer.activate(trace):
+        testrelay.on_stomp_message(bug_create_message["body"], bug_create_message["headers"])
+    # Outside of the trace
+    with span("other"):
+        pass
+    trace.finish()
+    assert [name for name, _duration in trace.spans] == [
+        "convert_datetimes",
+        "bz4_compat_transform",
+        "fasjson",
+        "publish",
+    ]
+    assert "Message msgid took" in caplog.text
+    assert "convert_datetimes=" in caplog.text
+
+
+def test_slow_threshold(caplog):
+    caplog.set_level(logging.INFO)
+    tracer = Tracer({"enabled": True, "slow_threshold": 60000})
+    tracer.begin("msgid").finish()
+    assert caplog.text == ""
+
+
+def test_toggle(tmp_path):
+    tracer = Tracer({"profile_every": 1, "profile_dir": str(tmp_path)})
+    tracer.toggle()
+    assert tracer.enabled
+    trace = tracer.begin("msgid")
+    with tracer.activate(trace):
+        sum(range(10))
+    assert list(tmp_path.iterdir()) == []
+    # Disabling tracing writes the profile, but not from the signal handler
+    tracer.toggle()
+    assert not tracer.enabled
+    assert list(tmp_path.iterdir()) == []
+    assert tracer.dump_if_requested() is not None
+    assert len(list(tmp_path.iterdir())) == 1
+    assert tracer.dump_if_requested() is None
+
+
+def test_profile(tmp_path):
+    tracer = Tracer(
+        {
+            "enabled": True,
+            "profile_every": 2,
+            "profile_dir": str(tmp_path),
+            "profile_dump_every": 2,
+        }
+    )
+    for _i in range(4):
+        trace = tracer.begin("msgid")
+        with tracer.activate(trace):
+            sorted(range(10))
+    profiles = list(tmp_path.iterdir())
+    assert len(profiles) == 1
+    stats = pstats.Stats(str(profiles[0]))
+    assert any(function[2] == "<built-in method builtins.sorted>" for function in stats.stats)
+    # Nothing left to dump
+    assert tracer.dump_profile() is None
+
+
+def test_profile_one_at_a_time(tmp_path):
+    tracer = Tracer({"enabled": True, "profile_every": 1, "profile_dir": str(tmp_path)})
+    first = tracer.begin("first")
+    second = tracer.begin("second")
+    with tracer.activate(first):
+        # The second message is not profiled while the first one is
+        with tracer.activate(second):
+            pass
+    assert tracer._profiled == 1
@@ -0,0 +1,122 @@
+""" Tests for bugzilla2fedmsg.utils. """
+
+import copy
+import datetime
+from unittest import mock
+
+import pytest
+import pytz
+
+from bugzilla2fedmsg.cache import EmailCache
+from bugzilla2fedmsg.utils import (
+    cached_email_to_fas,
+    convert_datetimes,
+    email_to_fas,
+    open_database,
+)
+
+
+def _reference_convert_datetimes(obj):
+    """The original, recursive implementation of convert_datetimes, that
+    the current one must stay equivalent to.
+    """
+    if isinstance(obj, list):
+        return [_reference_convert_datetimes(item) for item in obj]
+    elif isinstance(obj, dict):
+        return dict([(k, _reference_convert_datetimes(v)) for k, v in obj.items()])
+    else:
+        try:
+            ourdate = datetime.datetime.strptime(obj, "%Y-%m-%dT%H:%M:%S")
+            ourdate = ourdate.replace(tzinfo=pytz.UTC)
+            return ourdate.timestamp()
+        except (ValueError, TypeError):
+            return obj
+
+
+@pytest.mark.parametrize(
+    "fixture_name",
+    [
+        "bug_create_message",
+        "bug_modify_message",
+        "bug_modify_message_four_changes",
+        "comment_create_message",
+        "attachment_create_message",
+        "attachment_modify_message",
+        "private_message",
+        "other_product_message",
+    ],
+)
+def test_convert_datetimes_equivalence(request, fixture_name):
+    message = request.getfixturevalue(fixture_name)
+    expected = _reference_convert_datetimes(copy.deepcopy(message))
+    assert convert_datetimes(message) == expected
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "2019-04-18T20:27:01",
+        "2019-4-8T1:2:3",
+        "2019-04-18T20:27",
+        "2019-04-18 20:27:01",
+        "2019-04-18T20:27:01Z",
+        "2019-04-18T24:27:01",
+        "2019-04-18T20:27:60",
+        "2019-02-30T20:27:01",
+        "2019-00-18T20:27:01",
+        "\uff12\uff10\uff11\uff19-04-18T20:27:01",
+        "2019-04-18T20:27:0\uff11",
+        "+019-04-18T20:27:01",
+        "abcd-efgh-ijklmnopq",
+        "short",
+        "",
+        12,
+        1.5,
+        None,
+        True,
+        ("2019-04-18T20:27:01",),
+    ],
+)
+def test_convert_datetimes_values(value):
+    assert convert_datetimes({"value": value}) == _reference_convert_datetimes({"value": value})
+    assert convert_datetimes([value]) == _reference_convert_datetimes([value])
+    assert convert_datetimes(value) == _reference_convert_datetimes(value)
+
+
+def test_convert_datetimes_in_place(bug_create_message):
+    bug = bug_create_message["body"]["bug"]
+    keywords = bug["keywords"]
+    result = convert_datetimes(bug)
+    assert result is bug
+    assert result["keywords"] is keywords
+    assert bug["creation_time"] == 1555619221.0
+
+
+def test_email_to_fas():
+    fasjson = mock.Mock(name="fasjson")
+    fasjson.search.return_value.result = [{"username": "dgunchev"}]
+    cache = EmailCache()
+    assert email_to_fas("dgunchev@gmail.com", fasjson, cache) == "dgunchev"
+    # The second time it comes from the cache
+    assert email_to_fas("dgunchev@gmail.com", fasjson, cache) == "dgunchev"
+    fasjson.search.assert_called_once_with(rhbzemail="dgunchev@gmail.com")
+    assert email_to_fas("dgunchev@fedoraproject.org", fasjson) == "dgunchev"
+
+
+def test_cached_email_to_fas_without_cache():
+    with pytest.raises(KeyError):
+        cached_email_to_fas("dgunchev@gmail.com")
+
+
+def test_open_database(tmp_path):
+    path = str(tmp_path / "test.sqlite")
+    db = open_database(path, "CREATE TABLE IF NOT EXISTS test (value TEXT)")
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    # NORMAL
+    assert db.execute("PRAGMA synchronous").fetchone()[0] == 1
+    db.execute("INSERT INTO test VALUES ('written')")
+    db.close()
+    # Committed without a transaction, and the schema can be applied again
+    db = open_database(path, "CREATE TABLE IF NOT EXISTS test (value TEXT)")
+    assert db.execute("SELECT value FROM test").fetchall() == [("written",)]
+    db.close()